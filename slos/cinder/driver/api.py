@@ -1,166 +1,161 @@
 """
 Contains the Utilities required by SoftLayer Driver
 """
-import copy
 import string
-import time
 
 import cinder.exception as exception
 import cinder.utils as utils
 
-from cinder import db
-from cinder import context
 from cinder.openstack.common.gettextutils import _
 from cinder.openstack.common import lockutils
 from cinder.openstack.common import log as logging
+from cinder.openstack.common import loopingcall
+
+from eventlet import greenpool
+from eventlet import greenthread
 
 import SoftLayer
 from SoftLayer.exceptions import SoftLayerAPIError
 from SoftLayer.utils import query_filter, NestedDict
 
+from .cache import FreePoolIndex, TTLCache
+from .client import ApiClient, BackoffWaiter, ProductCatalog
+from .client import use_keepalive_transport
+from .tracing import TRACER, traced
+
 LOG = logging.getLogger(__name__)
 
+# Fields of the iSCSI volume required by MetadataManager.serialize
+VOLUME_FIELDS = ('id', 'capacityGb', 'username', 'password',
+                 'serviceResourceBackendIpAddress', 'billingItem.id')
 
-class MetadataManager(object):
-    """
-    Manages the admin metadata representation of
-    SoftLayer volumes.
-    """
+# Values of the `sl_written` admin metadata of the pool volumes,
+# recording if the volume has been written since allocated
+UNWRITTEN = 'none'
+WRITTEN = 'all'
 
-    def _local_volume_references(self, cntx):
-        """
-        Get IDs of all volumes in Cinder.
-        """
-        all_vols = db.volume_get_all(
-            cntx, marker=None, limit=None,
-            sort_key='created_at', sort_dir='desc')
-        return [vol['id'] for vol in all_vols]
+# Added to the notes of the pool volumes which are waiting to be wiped
+DIRTY_NOTE = 'cinder:scrub-pending'
 
-    def all_imported(self):
-        """
-        Returns ID of all imported volumes
-        :returns: list of external vol's id
-        """
-        cntx = context.get_admin_context()
-        local_volumes = self._local_volume_references(cntx)
-        sl_volumes = []
-        for vol in local_volumes:
-            sl_vol = self.deserialize(vol)
-            if not sl_vol:
-                continue
-            sl_volumes.append(sl_vol['id'])
-        return sl_volumes
 
-    def get_all(self, vol_id):
-        """
-        Retrives the user metadata of the volume.
-
-        :param vol_id: OpenStack Volume ID.
-        """
-        admin_context = context.get_admin_context()
-        metadata = db.volume_admin_metadata_get(admin_context, vol_id)
-        return metadata
-
-    def deserialize(self, vol_id):
-        """
-        Convertes the database representation of the volume
-        into SoftLayer Volume object
-        """
-        meta = copy.deepcopy(self.get_all(vol_id))
-        if 'sl_id' not in meta:
-            return None
-        for int_field in ('sl_id', 'billing_item_id', 'capacityGb'):
-            meta[int_field] = int(meta[int_field])
-        meta['billingItem'] = {'id': meta.get('billing_item_id')}
-        meta['serviceResourceBackendIpAddress'] = meta['portal']
-        meta['id'] = meta['sl_id']
-        del meta['billing_item_id']
-        del meta['portal']
-        del meta['sl_id']
-        return meta
-
-    def serialize(self, vol_id, sl_vol):
-        """
-        Converts and stores the SoftLayer volume object
-        into database as admin metadata.
-        """
-        defaults = {
-            'sl_id': str(sl_vol['id']),
-            'billing_item_id': str(sl_vol['billingItem']['id']),
-            'portal': sl_vol['serviceResourceBackendIpAddress'],
-            'capacityGb': str(sl_vol['capacityGb']),
-            'username': sl_vol['username'],
-            'password': sl_vol['password'],
-        }
-        self.update_meta(vol_id, defaults)
-
-    def delete_all(self, vol_id):
-        """
-        Delete the admin_metadata created for given volume.
-
-        :param vol_id: OpenStack Volume ID.
+def object_mask(*fields):
+    """
+    Builds the object mask selecting the given fields. Relational
+    fields are written with dots, e.g. `object_mask('id', 'billingItem.id')`
+    returns `mask[id,billingItem[id]]`.
+    """
+    tree = []
+    for field in fields:
+        node = tree
+        for name in field.split('.'):
+            children = None
+            for child_name, child in node:
+                if child_name == name:
+                    children = child
+                    break
+            if children is None:
+                children = []
+                node.append((name, children))
+            node = children
+
+    def render(node):
+        return ','.join(
+            '%s[%s]' % (name, render(children)) if children else name
+            for name, children in node)
+    return 'mask[%s]' % render(tree)
+
+
+class WarmPoolManager(object):
+    """
+    Keeps ordered, active volumes in the free pool for the configured
+    sizes. A looping call checks the stock and orders volumes in
+    green threads when it falls below the low-water mark.
+    """
 
+    def __init__(self, vol_mgr, meta_mgr, stock, interval):
         """
-        admin_context = context.get_admin_context()
-        admin_meta = self.get_all(vol_id)
-        for key in admin_meta.keys():
-            db.volume_admin_metadata_delete(admin_context, vol_id, key)
-
-    def delete_entry(self, volume, entry):
+        :param vol_mgr: IscsiVolumeManager with free pool index enabled.
+        :param meta_mgr: MetadataManager.
+        :param stock: dict of (low-water mark, target) keyed by size.
+        :param interval: seconds between the stock checks.
         """
-        Remove snapshot's ID from the volume's admin metadata
+        self.vol_mgr = vol_mgr
+        self.meta_mgr = meta_mgr
+        self.stock = stock
+        self.interval = interval
+        self.pending = dict((size, 0) for size in stock)
+        self._timer = None
 
-        :param volume: OpenStack Volume Object.
-        :param entry: OpenStack Volume ID.
+    @staticmethod
+    def parse_stock(entries):
         """
-        admin_context = context.get_admin_context()
-        metadata = db.volume_admin_metadata_get(admin_context, volume['id'])
-        if entry in metadata:
-            del metadata[entry]
-            db.volume_admin_metadata_update(
-                admin_context, volume['id'], metadata, delete=True)
+        Parses `size:low_water[:target]` entries.
 
-    def update_meta(self, _id, admin_meta):
+        :returns: dict of (low-water mark, target) keyed by size.
         """
-        Update the admin metadata
-        """
-        admin_context = context.get_admin_context()
-        db.volume_admin_metadata_update(
-            admin_context, _id, admin_meta, False)
+        stock = {}
+        for entry in entries or []:
+            try:
+                values = [int(value) for value in entry.split(':')]
+            except ValueError:
+                values = []
+            if len(values) not in (2, 3):
+                raise exception.InvalidConfigurationValue(
+                    option='sl_pool_warm_stock', value=entry)
+            size, low_water = values[:2]
+            target = values[2] if len(values) == 3 else low_water
+            stock[size] = (low_water, max(low_water, target))
+        return stock
 
-    def get(self, vol_id, entry):
+    def start(self):
         """
-        Finds the corresponding SoftLayer SnapshotID of
-        given OpenStack Snapshot.
-
-        :param vol_id: OpenStack Volume ID.
-
+        Start checking the stock periodically.
         """
-        admin_context = context.get_admin_context()
-        metadata = db.volume_admin_metadata_get(admin_context, vol_id)
-        return metadata.get(entry, None)
+        self._timer = loopingcall.FixedIntervalLoopingCall(self.replenish)
+        self._timer.start(interval=self.interval)
 
-    def get_user_meta(self, vol_id):
+    def stop(self):
         """
-        Retrive the user metadata of the volume.
-
-        :param vol_id: OpenStack Volume ID.
+        Stop checking the stock, orders in progress are not affected.
         """
-        admin_context = context.get_admin_context()
-        metadata = db.volume_metadata_get(admin_context, vol_id)
-        return metadata
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
 
-    def update_user_meta(self, vol_id, metadata, delete=False):
+    def replenish(self):
         """
-        Update the user metadata of the given volume
-
-        :param vol_id: OpenStack volume ID.
-        :param metadata: dict containing metadata to be updated
-        :param delete: True if update should result in deletion of existing
+        Order volumes for the sizes below their low-water mark.
         """
-        admin_context = context.get_admin_context()
-        db.volume_metadata_update(admin_context, vol_id,
-                                  metadata, delete)
+        free_pool = self.vol_mgr.free_pool
+        if free_pool.expired():
+            try:
+                self.vol_mgr.refresh_free_pool(self.meta_mgr.in_use())
+            except SoftLayerAPIError as ex:
+                LOG.warn(_("Unable to refresh free pool: %s" % ex))
+                return
+        free = free_pool.free_count()
+        for size, (low_water, target) in self.stock.items():
+            available = free.get(size, 0) + self.pending[size]
+            if available >= low_water:
+                continue
+            LOG.info(_("Ordering %s volumes of size %s for the pool" %
+                       (target - available, size)))
+            for unused in range(target - available):
+                self.pending[size] += 1
+                greenthread.spawn_n(self._order, size)
+
+    def _order(self, size):
+        # no deadline, a placed order which timed out would no
+        # longer be pending and the volume would be bought again
+        try:
+            self.vol_mgr.free_pool.put(
+                self.vol_mgr.order_volume(size, False, float('inf')))
+        except (exception.VolumeBackendAPIException,
+                SoftLayerAPIError) as ex:
+            LOG.error(_("Unable to order pool volume of size %s: %s" %
+                        (size, ex)))
+        finally:
+            self.pending[size] -= 1
 
 
 class IscsiVolumeManager(object):
@@ -169,12 +164,34 @@ class IscsiVolumeManager(object):
     Cinder Driver for SoftLayer helper module
     """
 
+    VOLUME_MASK = object_mask(*VOLUME_FIELDS)
+    SNAPSHOT_MASK = object_mask(*(VOLUME_FIELDS + ('snapshotCapacityGb',)))
+    POOL_MASK = object_mask(*(VOLUME_FIELDS + ('notes',)))
+
     def __init__(self, configuration={}):
         self.configuration = configuration
-        self.client = SoftLayer.Client(
-            username=configuration.sl_username,
-            api_key=self.configuration.sl_api_key)
+        if configuration.sl_api_keepalive_pool and \
+                not use_keepalive_transport(
+                    configuration.sl_api_keepalive_pool):
+            LOG.warn(_("Unable to enable keep-alive for SoftLayer API."))
+        self.client = ApiClient(
+            SoftLayer.Client(
+                username=configuration.sl_username,
+                api_key=self.configuration.sl_api_key,
+                timeout=configuration.sl_api_timeout or None),
+            concurrency=configuration.sl_api_concurrency or 0,
+            retries=configuration.sl_api_retries or 0,
+            retry_interval=configuration.sl_api_retry_interval or 1)
         self.product_order = self.client['Product_Order']
+        self.catalog = ProductCatalog(
+            self.client, ttl=self.configuration.sl_catalog_cache_ttl or 0)
+        self.waiter = BackoffWaiter(
+            initial=self.configuration.sl_wait_initial_interval or 1.0)
+        self.free_pool = FreePoolIndex(
+            ttl=self.configuration.sl_pool_index_ttl or 0)
+        self.discovery_cache = TTLCache(
+            ttl=self.configuration.sl_discovery_cache_ttl or 0)
+        self.dirty = set()
         self.location = None
 
     def check_dc(self):
@@ -186,12 +203,22 @@ class IscsiVolumeManager(object):
         for datacenter in datacenters:
             if datacenter['name'] == self.configuration.sl_datacenter:
                 self.location = datacenter['id']
+                self.catalog.warm(('iscsi', 'iscsi_snapshot_space'))
                 return
         err_msg = (_('Invalid username password and datacenter '
                      'combination. Valid usename and api_key'
                      ' along with datacenter location must be specified.'))
         raise exception.InvalidInput(reason=err_msg)
 
+    def stats(self):
+        """
+        Stats of the API calls and of the polling waits.
+
+        :returns: the stats of the client, with the wait time histograms
+                  of the polling phases under *waits*.
+        """
+        return dict(self.client.stats(), waits=self.waiter.stats())
+
     def _find_item(self, size, category_code, ceil):
         """
         Find the item_price IDs for the iSCSIs of given size
@@ -201,27 +228,7 @@ class IscsiVolumeManager(object):
                   the given volume size or first large enough size, if the
                  `sl_vol_order_ceil` configuration value is se
         """
-        _filter = NestedDict({})
-        _filter[
-            'items'][
-            'categories'][
-            'categoryCode'] = query_filter(category_code)
-        if ceil:
-            _filter['items'][
-                'capacity'] = query_filter('>=%s' % size)
-        else:
-            _filter['items']['capacity'] = query_filter(size)
-        iscsi_item_prices = self.client['Product_Package'].getItems(
-            id=0,
-            mask=','.join(('id', 'prices', 'capacity')),
-            filter=_filter.to_dict())
-        if len(iscsi_item_prices) == 0:
-            return None
-        iscsi_item_prices = sorted(
-            iscsi_item_prices,
-            key=lambda x: float(x['capacity']))
-
-        return iscsi_item_prices[0]['prices'][0]['id']
+        return self.catalog.find(size, category_code, ceil)
 
     def create_volume(self, volume):
         """
@@ -235,21 +242,34 @@ class IscsiVolumeManager(object):
         LOG.debug(
             _("Create volume called with name: %s, size: %s, id: %s" %
               (volume['display_name'], volume['size'], volume['id'])))
-        item = self._find_item(volume['size'],
-                               'iscsi',
-                               self.configuration.sl_vol_order_ceil)
+        return self.order_volume(volume['size'],
+                                 self.configuration.sl_vol_order_ceil)
+
+    @traced('order')
+    def order_volume(self, size, ceil, deadline=None):
+        """
+        Orders a new volume and waits for it to become active.
+
+        :param size: volume size.
+        :param ceil: order first larger size if size is not available.
+        :param deadline: seconds to wait for the volume to become
+                         active, `sl_vol_active_retry` times
+                         `sl_vol_active_wait` by default.
+        """
+        item = self._find_item(size, 'iscsi', ceil)
         if not item:
-            LOG.error(_("No item found for size %s" % volume['size']))
+            LOG.error(_("No item found for size %s" % size))
             raise exception.VolumeBackendAPIException(
                 data="iSCSI storage of %s size is not supported" %
-                volume['size'])
-        return self._order_iscsi(item)
+                size)
+        return self._order_iscsi(item, deadline)
 
-    def _order_iscsi(self, item):
+    def _order_iscsi(self, item, deadline=None):
         """
         Places an order for volume.
 
         :param item: item price id to be used to order
+        :param deadline: seconds to wait for the volume to become active.
         """
         iscsi_order = self._build_order(item)
         try:
@@ -263,18 +283,19 @@ class IscsiVolumeManager(object):
         billing_item_id = order['placedOrder']['items'][0]['id']
         LOG.debug(_("Billing item id: %s associated" % billing_item_id))
         billing_svc = self.client['Billing_Order_Item']
-        for retry in xrange(self.configuration.sl_vol_active_retry):
-            billing_item = billing_svc.getBillingItem(
-                id=billing_item_id)
-            if billing_item and \
-                    billing_item.get('notes'):
+
+        def poll():
+            billing_item = billing_svc.getBillingItem(id=billing_item_id)
+            if billing_item and billing_item.get('notes'):
                 # iscsi is available
-                break
-            LOG.debug("Ordered volume is not in active state, "
-                      "sleeping after %s retries" % retry)
-            time.sleep(self.configuration.sl_vol_active_wait)
+                return billing_item
+            return None
 
-        if not billing_item.get('notes'):
+        wait = self.configuration.sl_vol_active_wait
+        if deadline is None:
+            deadline = self.configuration.sl_vol_active_retry * wait
+        billing_item = self.waiter.wait('order_active', poll, deadline, wait)
+        if not billing_item:
             raise exception.VolumeBackendAPIException(
                 data="Unable to retrive the "
                 "billing item for the order placed. "
@@ -288,7 +309,7 @@ class IscsiVolumeManager(object):
             'username'] = query_filter(
             user_name)
         result = self.client['Account'].\
-            getIscsiNetworkStorage(mask='mask[billingItem[id]]',
+            getIscsiNetworkStorage(mask=self.VOLUME_MASK,
                                    filter=_filter.to_dict())
         sl_vol = result[0]
         return sl_vol
@@ -310,7 +331,7 @@ class IscsiVolumeManager(object):
         }
         return order
 
-    def _get_vol(self, sl_vol_id, mask='mask[billingItem[id]]'):
+    def _get_vol(self, sl_vol_id, mask=VOLUME_MASK):
         """
         Search the SoftLayer volume object using ID
 
@@ -339,11 +360,38 @@ class IscsiVolumeManager(object):
             "No longer needed",
             id=billing_item_id)
 
-    @lockutils.synchronized('run_iscsiadm', 'cinder-', False)
+    def _discovery_key(self, sl_vol):
+        return (sl_vol['serviceResourceBackendIpAddress'], sl_vol['username'])
+
+    @traced('discovery')
     def run_iscsiadm(self, sl_vol):
         """
         Run `iscsiadm` command on SoftLayer iSCSI target
         to fetch IQN and other details of the target.
+        Results are served from the discovery cache when possible.
+        """
+        key = self._discovery_key(sl_vol)
+        out = self.discovery_cache.get(key)
+        if out is not None:
+            return out
+        if self.configuration.sl_discovery_mode == 'discoverydb':
+            out = self._discover_db(sl_vol)
+        else:
+            out = self._discover(sl_vol)
+        self.discovery_cache.set(key, out)
+        return out
+
+    def invalidate_discovery(self, sl_vol):
+        """
+        Forget the cached discovery result of the volume.
+        """
+        self.discovery_cache.invalidate(self._discovery_key(sl_vol))
+
+    @lockutils.synchronized('run_iscsiadm', 'cinder-', False)
+    def _discover(self, sl_vol):
+        """
+        Put the CHAP credentials in iscsid.conf and run the
+        sendtargets discovery on the portal of the volume.
         """
         # modify the iscsid.conf
         # first remove and then insert, makes sure we always will have new
@@ -369,6 +417,35 @@ class IscsiVolumeManager(object):
                 data="Error while 'discovery' on iSCSI details. %s" % err)
         return out
 
+    def _discoverydb(self, portal, *args):
+        return utils.execute(
+            'iscsiadm', '-m', 'discoverydb', '-t', 'sendtargets',
+            '-p', portal, *args, run_as_root=True)
+
+    def _discover_db(self, sl_vol):
+        """
+        Run the sendtargets discovery with the CHAP credentials stored
+        in the discovery record of the portal, iscsid.conf is not
+        modified. Only discoveries on the same portal are serialized.
+        """
+        portal = sl_vol['serviceResourceBackendIpAddress']
+        with lockutils.lock('discoverydb-%s' % portal, 'cinder-', False):
+            self._discoverydb(portal, '-o', 'new')
+            for name, value in (
+                    ('discovery.sendtargets.auth.authmethod', 'CHAP'),
+                    ('discovery.sendtargets.auth.username',
+                     sl_vol['username']),
+                    ('discovery.sendtargets.auth.password',
+                     sl_vol['password'])):
+                self._discoverydb(portal, '-o', 'update',
+                                  '-n', name, '-v', value)
+            (out, err) = self._discoverydb(portal, '--discover',
+                                           '-o', 'new')
+        if err and len(err) != 0:
+            raise exception.VolumeBackendAPIException(
+                data="Error while 'discovery' on iSCSI details. %s" % err)
+        return out
+
     def _create_properties(self, iscsi_detail, sl_vol):
         """
         Build properties data from the volume detail.
@@ -401,7 +478,24 @@ class IscsiVolumeManager(object):
         if not item_price:
             raise exception.VolumeBackendAPIException(
                 data="Snapshot space having size %s not found." % capacity)
-        snap_space_order = {
+        snap_space_order = self._build_snapshot_space_order(sl_vol_id,
+                                                            item_price)
+        try:
+            self.product_order.verifyOrder(snap_space_order)
+            LOG.debug(_("Order verified successfully"))
+            self.product_order.placeOrder(snap_space_order)
+        except SoftLayerAPIError as ex:
+            LOG.debug(_("Cannot place order: %s" % ex.message))
+            raise exception.VolumeBackendAPIException(data=ex.message)
+
+    def _build_snapshot_space_order(self, sl_vol_id, item_price):
+        """
+        Build snapshot space order structure required by placeOrder
+
+        :param sl_vol_id: SoftLayer iSCSI volume ID.
+        :param item_price: item price ID of the snapshot space.
+        """
+        return {
             'complexType':
             'SoftLayer_Container_Product_Order_'
             'Network_Storage_Iscsi_SnapshotSpace',
@@ -410,13 +504,6 @@ class IscsiVolumeManager(object):
             'prices': [{'id': item_price}],
             'quantity': 1,
             'volumeId': sl_vol_id}
-        try:
-            self.product_order.verifyOrder(snap_space_order)
-            LOG.debug(_("Order verified successfully"))
-            self.product_order.placeOrder(snap_space_order)
-        except SoftLayerAPIError as ex:
-            LOG.debug(_("Cannot place order: %s" % ex.message))
-            raise exception.VolumeBackendAPIException(data=ex.message)
 
     def _wait_for_space(self,
                         sl_vol_id,
@@ -425,18 +512,15 @@ class IscsiVolumeManager(object):
         """
         Wait for snapshot space to become available.
         """
-        space_allocated = False
-        for retry in xrange(retry_limit):
+        def poll():
             vol = self.client['Network_Storage_Iscsi'].getObject(
                 id=sl_vol_id,
                 mask='mask[snapshotCapacityGb]')
             new_capacity = int(vol.get('snapshotCapacityGb', '0'))
-            space_allocated = new_capacity > current_capacity
-            if space_allocated:
-                break
-            LOG.debug("Snapshot space not activated, "
-                      "sleeping after %s retries" % retry)
-            time.sleep(sleep)
+            return new_capacity > current_capacity
+
+        space_allocated = self.waiter.wait(
+            'snapshot_space', poll, retry_limit * sleep, sleep)
         if not space_allocated:
             raise exception.VolumeBackendAPIException(
                 data="Unable to reserve space for volume.")
@@ -450,11 +534,14 @@ class IscsiVolumeManager(object):
             'Insufficient snapshot reserve space to ' \
             'create a snapshot for the volume' in message
 
-    def create_snapshot(self, sl_vol, snapshot):
+    def create_snapshot(self, sl_vol, snapshot, order_space=True):
         """
         Create snapshot for volume, if required inflate the snapshot space.
+
+        :param order_space: allow ordering snapshot space, as per
+                            `sl_order_snap_space`.
         """
-        sl_vol = self._get_vol(sl_vol['id'])
+        sl_vol = self._get_vol(sl_vol['id'], mask=self.SNAPSHOT_MASK)
         if sl_vol['capacityGb'] == 1:
             raise exception.VolumeBackendAPIException(
                 data="1 GB Snapshot is not supported")
@@ -463,7 +550,7 @@ class IscsiVolumeManager(object):
                 '',
                 id=sl_vol['id'])
         except SoftLayerAPIError as ex:
-            if not self.space_needed(ex.message) or \
+            if not self.space_needed(ex.message) or not order_space or \
                     not self.configuration.sl_order_snap_space:
                 LOG.error(_("Unable to create snapshot of the given volume."))
                 raise exception.VolumeBackendAPIException(
@@ -488,9 +575,166 @@ class IscsiVolumeManager(object):
                                  current_capacity,
                                  sleep=sleep)
             # space increased try creating snapshot again.
-            return self.create_snapshot(sl_vol, snapshot)
+            return self.create_snapshot(sl_vol, snapshot, order_space)
         return sl_snapshot
 
+    def _get_vols(self, sl_vol_ids, mask=VOLUME_MASK):
+        """
+        Fetch the SoftLayer volumes with a single account query.
+
+        :param sl_vol_ids: SoftLayer iSCSI volume IDs.
+        :param mask: fields from the volumes to be retrived
+        :returns: dict of the volumes found keyed by ID.
+        """
+        _filter = {'iscsiNetworkStorage': {'id': {
+            'operation': 'in',
+            'options': [{'name': 'data',
+                         'value': [int(sl_vol_id)
+                                   for sl_vol_id in sl_vol_ids]}]}}}
+        sl_vols = self.client['Account'].getIscsiNetworkStorage(
+            mask=mask, filter=_filter)
+        return dict((int(sl_vol['id']), sl_vol) for sl_vol in sl_vols)
+
+    def create_snapshots(self, sl_vol_ids, concurrency=8):
+        """
+        Create a snapshot of each of the volumes. The volumes are
+        fetched with one account query and the snapshots created
+        `concurrency` at a time. Snapshot space for all volumes
+        lacking it is ordered at once, their snapshots are retried
+        once the space is available.
+
+        :param sl_vol_ids: SoftLayer iSCSI volume IDs.
+        :param concurrency: number of snapshots created at a time.
+        :returns: dict keyed by volume ID of the results, each with
+                  `snapshot` (SoftLayer snapshot object or None) and
+                  `error` (None or the error message).
+        """
+        results = {}
+        sl_vols = self._get_vols(sl_vol_ids, mask=self.SNAPSHOT_MASK)
+        pending = []
+        for sl_vol_id in sl_vol_ids:
+            sl_vol = sl_vols.get(int(sl_vol_id))
+            if sl_vol is None:
+                self._snapshot_failed(
+                    results, sl_vol_id,
+                    "Volume not found on the SoftLayer account.")
+            elif int(sl_vol['capacityGb']) == 1:
+                self._snapshot_failed(results, sl_vol_id,
+                                      "1 GB Snapshot is not supported")
+            else:
+                pending.append(sl_vol)
+        need_space = self._snapshot_all(pending, results, concurrency)
+        if need_space and self.configuration.sl_order_snap_space:
+            ordered = self._order_snapshot_spaces(need_space, results)
+            need_space = self._snapshot_all(
+                self._wait_for_spaces(ordered, results), results,
+                concurrency)
+        for sl_vol in need_space:
+            self._snapshot_failed(results, sl_vol['id'],
+                                  "Insufficient snapshot reserve space.")
+        return results
+
+    def _snapshot_failed(self, results, sl_vol_id, message):
+        LOG.error(_("Unable to create snapshot of the volume %s. %s" %
+                    (sl_vol_id, message)))
+        results[int(sl_vol_id)] = {'snapshot': None, 'error': message}
+
+    def _snapshot_all(self, sl_vols, results, concurrency):
+        """
+        Create the snapshots of the volumes concurrently.
+
+        :returns: the volumes lacking snapshot space.
+        """
+        trace_context = TRACER.current()
+
+        def snapshot(sl_vol):
+            # errors are returned, the hub would log them otherwise
+            try:
+                with TRACER.resume(trace_context):
+                    return sl_vol, self.client[
+                        'Network_Storage_Iscsi'].createSnapshot(
+                        '', id=sl_vol['id']), None
+            except SoftLayerAPIError as ex:
+                return sl_vol, None, ex
+
+        need_space = []
+        pool = greenpool.GreenPool(max(1, concurrency))
+        for sl_vol, sl_snap, ex in pool.imap(snapshot, sl_vols):
+            if ex is None:
+                results[int(sl_vol['id'])] = {'snapshot': sl_snap,
+                                              'error': None}
+            elif self.space_needed(ex.message):
+                need_space.append(sl_vol)
+            else:
+                self._snapshot_failed(results, sl_vol['id'], ex.message)
+        return need_space
+
+    def _order_snapshot_spaces(self, sl_vols, results):
+        """
+        Order more snapshot space for all the volumes in one order.
+
+        :returns: the volumes the space is ordered for.
+        """
+        containers = []
+        ordered = []
+        for sl_vol in sl_vols:
+            current = int(sl_vol.get('snapshotCapacityGb') or 0)
+            capacity = current + 1 if current else int(sl_vol['capacityGb'])
+            item_price = self._find_item(capacity, 'iscsi_snapshot_space',
+                                         True)
+            if not item_price:
+                self._snapshot_failed(
+                    results, sl_vol['id'],
+                    "Snapshot space having size %s not found." % capacity)
+                continue
+            containers.append(
+                self._build_snapshot_space_order(sl_vol['id'], item_price))
+            ordered.append(sl_vol)
+        if not containers:
+            return []
+        order = {'orderContainers': containers}
+        try:
+            self.product_order.verifyOrder(order)
+            LOG.debug(_("Order verified successfully"))
+            self.product_order.placeOrder(order)
+        except SoftLayerAPIError as ex:
+            LOG.debug(_("Cannot place order: %s" % ex.message))
+            for sl_vol in ordered:
+                self._snapshot_failed(results, sl_vol['id'], ex.message)
+            return []
+        return ordered
+
+    def _wait_for_spaces(self, sl_vols, results):
+        """
+        Wait for the snapshot space ordered for the volumes, polling
+        all of them with one account query.
+
+        :returns: the volumes whose snapshot space is available.
+        """
+        current = dict((int(sl_vol['id']),
+                        int(sl_vol.get('snapshotCapacityGb') or 0))
+                       for sl_vol in sl_vols)
+        ready = set()
+
+        def poll():
+            waiting = set(current) - ready
+            for sl_vol_id, sl_vol in self._get_vols(
+                    waiting, mask='mask[id,snapshotCapacityGb]').items():
+                if int(sl_vol.get('snapshotCapacityGb') or 0) > \
+                        current[sl_vol_id]:
+                    ready.add(sl_vol_id)
+            return len(ready) == len(current)
+
+        if sl_vols:
+            sleep = self.configuration.sl_snap_space_active_wait
+            self.waiter.wait(
+                'snapshot_space', poll,
+                self.configuration.sl_snap_space_active_retry * sleep, sleep)
+        for sl_vol_id in set(current) - ready:
+            self._snapshot_failed(results, sl_vol_id,
+                                  "Unable to reserve space for volume.")
+        return [sl_vol for sl_vol in sl_vols if int(sl_vol['id']) in ready]
+
     def restore_snapshot(self, sl_snap_id, sl_volume):
         """
         restore the volume to snapshot state
@@ -499,6 +743,32 @@ class IscsiVolumeManager(object):
             restoreFromSnapshot(sl_snap_id,
                                 id=sl_volume['id'])
 
+    def wait_for_transactions(self, sl_vol):
+        """
+        Wait for the transaction just requested for the volume, e.g.
+        restore from snapshot, to complete. SoftLayer registers the
+        transaction with a delay, so no active transaction counts as
+        complete only once a transaction has been seen.
+        """
+        started = []
+
+        def poll():
+            vol = self.client['Network_Storage_Iscsi'].getObject(
+                id=sl_vol['id'],
+                mask='mask[activeTransactionCount]')
+            if int(vol.get('activeTransactionCount', 0)) > 0:
+                started.append(True)
+                return False
+            return bool(started)
+
+        wait = self.configuration.sl_vol_active_wait
+        if not self.waiter.wait(
+                'transactions', poll,
+                self.configuration.sl_vol_active_retry * wait, wait):
+            raise exception.VolumeBackendAPIException(
+                data="Transactions of volume %s did not complete." %
+                sl_vol['id'])
+
     def delete_snapshot(self, snap_id):
         """
         Delete the snapshot
@@ -521,36 +791,117 @@ class IscsiVolumeManager(object):
         iscsi_detail = self.run_iscsiadm(sl_vol)
         return self._create_properties(iscsi_detail, sl_vol)
 
-    def find_free_volume(self, size, imported):
+    def _list_pool_volumes(self, capacity=None):
         """
-        Find a volume in the pool of the given size.
-
-        :param size: size to search for.
-        :param imported: list of imported volumes
+        List the volumes of the account in the configured datacenter.
 
-        :returns: sl_vol: SoftLayer iSCSI volume representation
+        :param capacity: optional capacity filter.
         """
         _filter = NestedDict({})
-        if self.configuration.sl_vol_order_ceil:
+        if capacity is not None:
             _filter['iscsiNetworkStorage'][
-                'capacityGb'] = query_filter('>=%s' % size)
-        else:
-            _filter['iscsiNetworkStorage']['capacityGb'] = query_filter(size)
+                'capacityGb'] = query_filter(capacity)
         _filter['iscsiNetworkStorage'][
             'billingItem'][
             'location'][
             'id'] = query_filter(self.location)
         sl_volumes = self.client['Account'].getIscsiNetworkStorage(
-            mask='mask[id,capacityGb,'
-            'username,password,billingItem[id]]',
+            mask=self.POOL_MASK,
             filter=_filter.to_dict())
+        return [sl_vol for sl_vol in sl_volumes if not self.is_dirty(sl_vol)]
+
+    def list_dirty(self):
+        """
+        List the pool volumes marked to be wiped.
+        """
+        _filter = NestedDict({})
+        _filter['iscsiNetworkStorage']['notes'] = {
+            'operation': '*= %s' % DIRTY_NOTE}
+        _filter['iscsiNetworkStorage'][
+            'billingItem'][
+            'location'][
+            'id'] = query_filter(self.location)
+        return self.client['Account'].getIscsiNetworkStorage(
+            mask=self.POOL_MASK,
+            filter=_filter.to_dict())
+
+    def is_dirty(self, sl_vol):
+        """
+        Checks if the volume is waiting to be wiped.
+        """
+        return int(sl_vol['id']) in self.dirty or \
+            DIRTY_NOTE in (sl_vol.get('notes') or '')
+
+    def _get_notes(self, sl_vol):
+        sl_vol = self._get_vol(sl_vol['id'], mask='mask[notes]')
+        return sl_vol.get('notes') or ''
+
+    def mark_dirty(self, sl_vol):
+        """
+        Mark the volume to be wiped, the mark is added to the notes of
+        the volume so it survives restarts of the service.
+        """
+        self.dirty.add(int(sl_vol['id']))
+        notes = self._get_notes(sl_vol)
+        if DIRTY_NOTE not in notes:
+            self.client['Network_Storage_Iscsi'].editObject(
+                {'notes': ('%s %s' % (notes, DIRTY_NOTE)).lstrip()},
+                id=sl_vol['id'])
+
+    def mark_clean(self, sl_vol):
+        """
+        Remove the wipe mark of the volume, other notes are kept.
+        """
+        notes = self._get_notes(sl_vol)
+        if DIRTY_NOTE in notes:
+            notes = notes.replace(' ' + DIRTY_NOTE, '').replace(DIRTY_NOTE, '')
+            self.client['Network_Storage_Iscsi'].editObject(
+                {'notes': notes}, id=sl_vol['id'])
+        self.dirty.discard(int(sl_vol['id']))
+
+    def refresh_free_pool(self, imported):
+        """
+        Rebuild the free pool index from the account's volumes.
+
+        :param imported: IDs of the volumes used by Cinder.
+        """
+        self.free_pool.load(self._list_pool_volumes(), imported)
+
+    def find_free_volume(self, size, reserve, load_imported=set):
+        """
+        Find a volume in the pool of the given size. When the free
+        pool index is enabled it is used instead of listing the
+        account's volumes, the index is rebuilt once expired.
+
+        :param size: size to search for.
+        :param reserve: callable reserving the SoftLayer volume ID,
+                        returns False if the volume is already in use.
+        :param load_imported: callable returning the IDs of the volumes
+                              used by Cinder, called when the index
+                              is rebuilt.
+
+        :returns: sl_vol: SoftLayer iSCSI volume representation
+        """
+        ceil = self.configuration.sl_vol_order_ceil
+        if self.free_pool.ttl > 0:
+            if self.free_pool.expired():
+                self.refresh_free_pool(load_imported())
+            sl_vol = self.free_pool.take(size, ceil, reserve)
+            if sl_vol:
+                return sl_vol
+            LOG.warn(_("No free volume found of size %s" % size))
+            return None
+        if ceil:
+            sl_volumes = self._list_pool_volumes('>=%s' % size)
+        else:
+            sl_volumes = self._list_pool_volumes(size)
         if len(sl_volumes) == 0:
             return None
         sl_volumes = sorted(sl_volumes, key=lambda x: int(x['capacityGb']))
         for sl_vol in sl_volumes:
-            if sl_vol['id'] in imported:
+            if not reserve(sl_vol['id']):
                 continue
-            return self._get_vol(sl_vol['id'])
+            return sl_vol
         LOG.warn(_("No free volume found of size %s" % size))
         return None
 
@@ -563,7 +914,11 @@ class IscsiVolumeManager(object):
 
         :returns: sl_vol: SoftLayer iSCSI volume representation
         """
-        sl_vol = self._get_vol(sl_vol_id)
+        sl_vol = self._get_vol(sl_vol_id, mask=self.POOL_MASK)
+        if self.is_dirty(sl_vol):
+            raise exception.InvalidVolume(
+                reason="Requested SL volume (%s) is being wiped." %
+                sl_vol['id'])
         if int(sl_vol['capacityGb']) == int(size):
             # User has request volume of same size of the id specified.
             return sl_vol
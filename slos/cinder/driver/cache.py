@@ -0,0 +1,239 @@
+"""
+Caches used by the SoftLayer Driver
+"""
+import bisect
+import collections
+import time
+
+
+class LRUCache(object):
+    """
+    Dictionary keeping the `size` most recently used entries.
+    A `size` of 0 disables the cache.
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self._entries = {}
+        # (tick, key) in the order of use, stale once the key is reused
+        # or invalidated
+        self._order = collections.deque()
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _use(self, key, value):
+        self._tick += 1
+        self._entries[key] = (self._tick, value)
+        self._order.append((self._tick, key))
+        if len(self._order) > 2 * self.size + 16:
+            self._order = collections.deque(sorted(
+                (tick, key) for key, (tick, _value) in self._entries.items()))
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, `default` if missing.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._use(key, entry[1])
+        return entry[1]
+
+    def set(self, key, value):
+        """
+        Store the value for key, dropping the least recently used
+        entry if the cache is full.
+        """
+        if self.size <= 0:
+            return
+        self._use(key, value)
+        while len(self._entries) > self.size:
+            tick, old_key = self._order.popleft()
+            # skip the keys reused or invalidated since
+            entry = self._entries.get(old_key)
+            if entry is not None and entry[0] == tick:
+                del self._entries[old_key]
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry of key, or all entries if no key given.
+        """
+        if key is None:
+            self._entries.clear()
+            self._order.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class TTLCache(object):
+    """
+    Dictionary whose entries expire `ttl` seconds after being set.
+    A `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, `default` if missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        stored_at, value = entry
+        if time.time() - stored_at >= self.ttl:
+            self._entries.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value):
+        """
+        Store the value for key.
+        """
+        if self.ttl > 0:
+            self._entries[key] = (time.time(), value)
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry of key, or all entries if no key given.
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class FreePoolIndex(object):
+    """
+    Index of unused pool volumes. Volumes are kept in a deque per
+    capacity and the capacities in a sorted list, so the best fitting
+    volume is found with bisect.
+
+    The index also counts all the volumes of the pool per capacity,
+    used or not, to report the capacity of the pool.
+    """
+
+    def __init__(self, ttl=0):
+        """
+        :param ttl: seconds after which the index should be rebuilt,
+                    0 disables the index.
+        """
+        self.ttl = ttl
+        self.loaded_at = None
+        self._capacities = []
+        self._buckets = {}
+        self._ids = set()
+        self._totals = collections.defaultdict(int)
+        self._all_ids = set()
+
+    def expired(self):
+        """
+        Checks if the index should be rebuilt.
+        """
+        return self.loaded_at is None or \
+            time.time() - self.loaded_at >= self.ttl
+
+    def load(self, sl_volumes, imported):
+        """
+        Replace the index contents.
+
+        :param sl_volumes: SoftLayer volumes in the pool.
+        :param imported: IDs of the volumes used by Cinder.
+        """
+        self._capacities = []
+        self._buckets = {}
+        self._ids = set()
+        self._totals = collections.defaultdict(int)
+        self._all_ids = set()
+        for sl_vol in sl_volumes:
+            if int(sl_vol['id']) in imported:
+                self.track(sl_vol)
+            else:
+                self.put(sl_vol)
+        self.loaded_at = time.time()
+
+    def track(self, sl_vol):
+        """
+        Count the volume in the capacity of the pool, without
+        making it available.
+
+        :param sl_vol: SoftLayer volume, requires `id` and `capacityGb`.
+        """
+        sl_vol_id = int(sl_vol['id'])
+        if sl_vol_id not in self._all_ids:
+            self._all_ids.add(sl_vol_id)
+            self._totals[int(sl_vol['capacityGb'])] += 1
+
+    def put(self, sl_vol):
+        """
+        Add a free volume to the index.
+
+        :param sl_vol: SoftLayer volume, requires `id` and `capacityGb`.
+        """
+        sl_vol_id = int(sl_vol['id'])
+        if sl_vol_id in self._ids:
+            return
+        self.track(sl_vol)
+        capacity = int(sl_vol['capacityGb'])
+        if capacity not in self._buckets:
+            bisect.insort(self._capacities, capacity)
+            self._buckets[capacity] = collections.deque()
+        self._buckets[capacity].append(sl_vol)
+        self._ids.add(sl_vol_id)
+
+    def take(self, size, ceil, reserve):
+        """
+        Remove and return the smallest free volume of the given size,
+        or of the first larger size when `ceil` is set. Volumes which
+        cannot be reserved are dropped from the index.
+
+        :param size: required capacity.
+        :param ceil: allow larger volumes.
+        :param reserve: callable reserving the SoftLayer volume ID.
+        """
+        size = int(size)
+        index = bisect.bisect_left(self._capacities, size)
+        while index < len(self._capacities):
+            capacity = self._capacities[index]
+            if capacity != size and not ceil:
+                return None
+            bucket = self._buckets[capacity]
+            found = None
+            while bucket and not found:
+                sl_vol = bucket.popleft()
+                self._ids.discard(int(sl_vol['id']))
+                if reserve(sl_vol['id']):
+                    found = sl_vol
+            if not bucket:
+                del self._buckets[capacity]
+                del self._capacities[index]
+            if found:
+                return found
+        return None
+
+    def free_count(self):
+        """
+        Returns number of free volumes per capacity.
+        """
+        return dict((capacity, len(bucket))
+                    for capacity, bucket in self._buckets.items())
+
+    def total_count(self):
+        """
+        Returns number of volumes in the pool per capacity.
+        """
+        return dict(self._totals)
+
+    def capacity(self):
+        """
+        Returns (total, free) capacity of the pool in GB.
+        """
+        total = sum(capacity * count
+                    for capacity, count in self._totals.items())
+        free = sum(capacity * len(bucket)
+                   for capacity, bucket in self._buckets.items())
+        return total, free
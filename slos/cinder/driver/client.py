@@ -0,0 +1,378 @@
+"""
+SoftLayer API client used by the SoftLayer Driver
+"""
+import bisect
+import collections
+import contextlib
+import json
+import os
+import random
+import time
+
+from cinder.openstack.common.gettextutils import _
+from cinder.openstack.common import log as logging
+
+from eventlet import corolocal
+from eventlet import greenthread
+from eventlet import semaphore
+
+from SoftLayer.exceptions import SoftLayerAPIError, TransportError
+from SoftLayer.utils import query_filter, NestedDict
+
+from .tracing import LatencyHistogram, TRACER, traced
+
+LOG = logging.getLogger(__name__)
+
+
+class _SessionRequests(object):
+    """
+    Stands in for the `requests` module in the SoftLayer transport,
+    so the API calls go through one keep-alive session.
+    """
+
+    def __init__(self, requests, pool_size):
+        self.HTTPError = requests.HTTPError
+        self.RequestException = requests.RequestException
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.post = self.session.post
+        self.request = self.session.request
+
+
+# Modules of the SoftLayer library versions posting the API calls
+# through their `requests` global
+TRANSPORT_MODULES = ('SoftLayer.transports', 'SoftLayer.transport')
+
+
+def use_keepalive_transport(pool_size):
+    """
+    Make the SoftLayer transport reuse HTTP connections, the
+    SoftLayer library opens a new connection for every call.
+
+    :param pool_size: connections kept open to the endpoint.
+    :returns: False if the transport of the installed SoftLayer
+              library cannot be replaced.
+    """
+    try:
+        import requests
+    except ImportError:
+        return False
+    for name in TRANSPORT_MODULES:
+        try:
+            transport = __import__(name, fromlist=['requests'])
+        except ImportError:
+            continue
+        if not hasattr(transport, 'requests'):
+            continue
+        if not isinstance(transport.requests, _SessionRequests):
+            transport.requests = _SessionRequests(requests, pool_size)
+        return True
+    return False
+
+
+class ApiClient(object):
+    """
+    Wraps the SoftLayer client to limit the calls in flight, retry
+    read only calls on transient errors and time every method.
+
+    Calls are also counted per driver operation, see `operation`.
+    """
+
+    RETRY_PREFIXES = ('get', 'verify')
+
+    def __init__(self, client, concurrency=8, retries=3, retry_interval=1):
+        """
+        :param client: SoftLayer client.
+        :param concurrency: maximum calls in flight, 0 for no limit.
+        :param retries: retries of a read only call on a 5xx
+                        response, timeout or connection error.
+        :param retry_interval: first sleep between the retries,
+                               doubled after every retry.
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self._semaphore = semaphore.Semaphore(concurrency) \
+            if concurrency > 0 else None
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.histograms = {}
+        self.errors = collections.defaultdict(int)
+        self.operations = {}
+        self._local = corolocal.local()
+
+    def __getitem__(self, service):
+        return ApiService(self, service)
+
+    def _transient(self, method, ex):
+        if not method.startswith(self.RETRY_PREFIXES):
+            return False
+        return isinstance(ex, TransportError) and \
+            (ex.faultCode == 0 or int(ex.faultCode) >= 500)
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """
+        Context manager counting the calls made by the current green
+        thread as made by the operation. Nested operations are
+        counted as part of the outermost one.
+        """
+        if getattr(self._local, 'operation', None):
+            yield
+            return
+        stats = self.operations.setdefault(name, {'count': 0, 'calls': 0})
+        stats['count'] += 1
+        self._local.operation = stats
+        try:
+            yield
+        finally:
+            self._local.operation = None
+
+    def _call_once(self, service, method, args, kwargs):
+        key = '%s.%s' % (service, method)
+        operation = getattr(self._local, 'operation', None)
+        if operation:
+            operation['calls'] += 1
+        start = time.time()
+        try:
+            with TRACER.span('api', method=key):
+                return getattr(self.client[service], method)(
+                    *args, **kwargs)
+        except Exception:
+            self.errors[key] += 1
+            raise
+        finally:
+            self.histograms.setdefault(
+                key, LatencyHistogram()).record(time.time() - start)
+
+    def call(self, service, method, *args, **kwargs):
+        """
+        Call the method of the SoftLayer service, waiting for a free
+        slot when `concurrency` calls are in flight.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self._semaphore is None:
+                    return self._call_once(service, method, args, kwargs)
+                with self._semaphore:
+                    return self._call_once(service, method, args, kwargs)
+            except SoftLayerAPIError as ex:
+                if attempt >= self.retries or \
+                        not self._transient(method, ex):
+                    raise
+                LOG.warn(_("Retrying %s.%s after error: %s" %
+                           (service, method, ex)))
+            greenthread.sleep(self.retry_interval * 2 ** attempt)
+            attempt += 1
+
+    def stats(self):
+        """
+        Returns the calls per service method, with their errors and
+        latencies, and the calls made per operation.
+        """
+        methods = {}
+        for key, histogram in self.histograms.items():
+            methods[key] = histogram.to_dict()
+            methods[key]['errors'] = self.errors.get(key, 0)
+        operations = {}
+        for name, stats in self.operations.items():
+            operations[name] = dict(stats)
+            operations[name]['calls_per_operation'] = \
+                float(stats['calls']) / stats['count']
+        return {'methods': methods, 'operations': operations}
+
+    def dump(self, path, stats=None):
+        """
+        Write the stats as JSON to the file, replaced atomically.
+
+        :param stats: stats to write, the stats of the client if not
+                      given.
+        """
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as stats_file:
+            json.dump(stats or self.stats(), stats_file, indent=2,
+                      sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+class ApiService(object):
+    """
+    SoftLayer service whose methods are called through `ApiClient`.
+    """
+
+    def __init__(self, api_client, name):
+        self.api_client = api_client
+        self.name = name
+
+    def __getattr__(self, method):
+        def call_handler(*args, **kwargs):
+            return self.api_client.call(self.name, method, *args, **kwargs)
+        return call_handler
+
+
+class BackoffWaiter(object):
+    """
+    Polls until a condition is met, sleeping with exponential
+    backoff and jitter between the polls, until the deadline
+    passes. Time spent waiting is recorded per phase.
+    """
+
+    def __init__(self, initial=1.0, factor=2.0, jitter=0.2):
+        """
+        :param initial: first sleep interval in seconds.
+        :param factor: multiplier applied to the interval after each poll.
+        :param jitter: fraction of the interval randomly removed from it.
+        """
+        self.initial = initial
+        self.factor = factor
+        self.jitter = jitter
+        self.histograms = {}
+
+    def wait(self, phase, poll, deadline, max_interval):
+        """
+        Call `poll` until it returns a true value. `poll` is always
+        called at least once.
+
+        :param phase: name under which the wait time is recorded.
+        :param poll: callable without arguments.
+        :param deadline: total seconds to keep polling.
+        :param max_interval: upper limit of a single sleep.
+        :returns: last value returned by `poll`
+        """
+        with TRACER.span('wait', phase=phase):
+            return self._wait(phase, poll, deadline, max_interval)
+
+    def _wait(self, phase, poll, deadline, max_interval):
+        start = time.time()
+        interval = self.initial
+        attempt = 0
+        while True:
+            result = poll()
+            if result:
+                break
+            remaining = deadline - (time.time() - start)
+            if remaining <= 0:
+                break
+            delay = min(interval, max_interval, remaining)
+            delay -= delay * random.uniform(0, self.jitter)
+            attempt += 1
+            LOG.debug("Waiting for %s, sleeping %.2f seconds after %s "
+                      "attempts" % (phase, delay, attempt))
+            time.sleep(delay)
+            interval *= self.factor
+        self.histograms.setdefault(
+            phase, LatencyHistogram()).record(time.time() - start)
+        return result
+
+    def stats(self):
+        """
+        Returns the recorded wait times per phase.
+        """
+        return dict((phase, histogram.to_dict())
+                    for phase, histogram in self.histograms.items())
+
+
+class ProductCatalog(object):
+    """
+    Caches item prices of the storage package, indexed by
+    category code and capacity.
+    """
+
+    def __init__(self, client, ttl=0):
+        """
+        :param client: SoftLayer client.
+        :param ttl: seconds a category stays cached, 0 disables caching.
+        """
+        self.client = client
+        self.ttl = ttl
+        self._categories = {}
+
+    def _load(self, category_code):
+        """
+        Fetch the items of the category and build capacity index.
+
+        :param category_code: SoftLayer item category code.
+        """
+        _filter = NestedDict({})
+        _filter[
+            'items'][
+            'categories'][
+            'categoryCode'] = query_filter(category_code)
+        items = self.client['Product_Package'].getItems(
+            id=0,
+            mask=','.join(('id', 'prices', 'capacity')),
+            filter=_filter.to_dict())
+        prices = {}
+        for item in items:
+            if not item.get('prices'):
+                continue
+            prices.setdefault(float(item['capacity']),
+                              item['prices'][0]['id'])
+        entry = {'loaded_at': time.time(),
+                 'capacities': sorted(prices.keys()),
+                 'prices': prices}
+        if self.ttl > 0:
+            self._categories[category_code] = entry
+        return entry
+
+    def _expired(self, entry):
+        return time.time() - entry['loaded_at'] >= self.ttl
+
+    def _get(self, category_code):
+        entry = self._categories.get(category_code)
+        if entry is None or self._expired(entry):
+            entry = self._load(category_code)
+        return entry
+
+    @traced('catalog')
+    def find(self, size, category_code, ceil):
+        """
+        Find the item price ID for the given capacity.
+
+        :param size: required capacity.
+        :param category_code: SoftLayer item category code.
+        :param ceil: when True first large enough capacity is used.
+        :returns: item price ID or None
+        """
+        entry = self._get(category_code)
+        size = float(size)
+        if not ceil:
+            return entry['prices'].get(size)
+        index = bisect.bisect_left(entry['capacities'], size)
+        if index == len(entry['capacities']):
+            return None
+        return entry['prices'][entry['capacities'][index]]
+
+    def warm(self, category_codes):
+        """
+        Load the given categories into the cache.
+        """
+        if self.ttl <= 0:
+            return
+        for category_code in category_codes:
+            self._load(category_code)
+
+    def refresh(self):
+        """
+        Reload the expired categories. Errors are logged and
+        the stale entries are kept, lookups reload them on demand.
+        """
+        for category_code, entry in self._categories.items():
+            if not self._expired(entry):
+                continue
+            try:
+                self._load(category_code)
+            except SoftLayerAPIError as ex:
+                LOG.warn(_("Unable to refresh product catalog: %s" % ex))
+
+    def invalidate(self, category_code=None):
+        """
+        Drop the cached category, or all categories if none given.
+        """
+        if category_code is None:
+            self._categories.clear()
+        else:
+            self._categories.pop(category_code, None)
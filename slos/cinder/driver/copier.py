@@ -0,0 +1,125 @@
+"""
+Block device copy used by the SoftLayer Driver
+"""
+import collections
+import io
+import mmap
+import os
+import stat
+import time
+
+import cinder.exception as exception
+
+from eventlet import greenpool
+from eventlet import tpool
+
+MiB = 1024 * 1024
+
+try:
+    _view = buffer
+except NameError:  # pragma: no cover
+    def _view(buf, offset, size):
+        return memoryview(buf)[offset:offset + size]
+
+
+class BlockCopier(object):
+    """
+    Copies the contents of one block device to another.
+
+    The device is split into one range per worker and every range
+    is copied by its own native thread through a reusable page
+    aligned buffer, so O_DIRECT can be used. Source blocks which are
+    all zero can be skipped when the destination is known to read
+    as zeros.
+    """
+
+    ALIGNMENT = 4096
+
+    def __init__(self, block_size_kb=1024, workers=1, direct_io=False,
+                 skip_zero=False):
+        """
+        :param block_size_kb: size of the single read/write in KiB,
+                              multiple of 4KiB.
+        :param workers: number of ranges copied concurrently.
+        :param direct_io: open the block devices with O_DIRECT.
+        :param skip_zero: do not write the all zero blocks.
+        """
+        self.block_size = block_size_kb * 1024
+        if self.block_size <= 0 or self.block_size % self.ALIGNMENT:
+            raise exception.InvalidConfigurationValue(
+                option='sl_copy_block_size', value=block_size_kb)
+        self.workers = max(1, workers)
+        self.direct_io = direct_io
+        self.skip_zero = skip_zero
+        self._buffers = collections.deque()
+        self._zero = b'\0' * self.block_size
+
+    def _ranges(self, size):
+        blocks = -(-size // self.block_size)
+        per_worker = -(-blocks // self.workers) * self.block_size
+        return [(offset, min(per_worker, size - offset))
+                for offset in range(0, size, per_worker)]
+
+    def copy(self, src_path, dest_path, size_mb, skip_zero=None):
+        """
+        Copy `size_mb` MiB from the source to the destination.
+
+        :param skip_zero: overrides `skip_zero` of the copier.
+        :returns: dict with the bytes written, skipped and the
+                  seconds taken.
+        """
+        if skip_zero is None:
+            skip_zero = self.skip_zero
+        start = time.time()
+        pool = greenpool.GreenPool(self.workers)
+        stats = {'written': 0, 'skipped': 0}
+
+        def copy_range(offset_length):
+            buf = self._buffers.popleft() if self._buffers else \
+                mmap.mmap(-1, self.block_size)
+            try:
+                return tpool.execute(self._copy_range, src_path, dest_path,
+                                     offset_length[0], offset_length[1],
+                                     buf, skip_zero)
+            finally:
+                self._buffers.append(buf)
+
+        for written, skipped in pool.imap(copy_range,
+                                          self._ranges(size_mb * MiB)):
+            stats['written'] += written
+            stats['skipped'] += skipped
+        stats['seconds'] = time.time() - start
+        return stats
+
+    def _open(self, path, mode):
+        flags = os.O_RDONLY if mode == 'r' else os.O_WRONLY
+        # only block devices, /dev/zero rejects O_DIRECT
+        if self.direct_io and stat.S_ISBLK(os.stat(path).st_mode):
+            flags |= os.O_DIRECT
+        return io.FileIO(os.open(path, flags), mode)
+
+    def _copy_range(self, src_path, dest_path, offset, length, buf,
+                    skip_zero):
+        written = skipped = 0
+        with self._open(src_path, 'r') as src:
+            with self._open(dest_path, 'w') as dest:
+                src.seek(offset)
+                dest.seek(offset)
+                while length > 0:
+                    size = src.readinto(buf)
+                    if not size:
+                        raise IOError("Unexpected end of %s at %s" %
+                                      (src_path, src.tell()))
+                    size = min(size, length)
+                    if skip_zero and \
+                            _view(buf, 0, size) == _view(self._zero, 0, size):
+                        dest.seek(size, os.SEEK_CUR)
+                        skipped += size
+                    else:
+                        done = 0
+                        while done < size:
+                            done += dest.write(
+                                _view(buf, done, size - done))
+                        written += size
+                    length -= size
+        return written, skipped
@@ -6,6 +6,10 @@ Cinder driver for SoftLayer storage systems.
 
 """
 
+import collections
+import functools
+import os
+
 from cinder import exception
 from cinder import utils
 from cinder.volume import driver
@@ -13,13 +17,17 @@ from cinder.volume import utils as volume_utils
 from cinder.openstack.common.gettextutils import _
 from cinder.openstack.common import log as logging
 from cinder.openstack.common import processutils as proc_utils
-from cinder.openstack.common import lockutils
 
+from eventlet import greenpool
+from eventlet import greenthread
 from oslo.config import cfg
 
 from SoftLayer.exceptions import SoftLayerAPIError
 
 from . import api as api
+from .copier import BlockCopier
+from .metadata import MetadataManager, SnapshotIndex
+from .tracing import JsonLinesTraceSink, PhaseTimer, TRACER, log_trace, traced
 
 LOG = logging.getLogger(__name__)
 
@@ -51,7 +59,8 @@ SL_OPTS = [
     cfg.StrOpt('sl_pool_volume_clear',
                default='zero',
                help='How to erase contents of the volume when deleted. '
-                    'Possible values: zero, shred or none'),
+                    'Possible values: zero, shred, discard, zero-written '
+                    'or none'),
     cfg.IntOpt('sl_snap_space_active_retry',
                default=10,
                help='Retry count to check snapshot space is active'),
@@ -64,6 +73,123 @@ SL_OPTS = [
     cfg.IntOpt('sl_vol_active_retry',
                default=10,
                help='Retry count to check volume is active'),
+    cfg.FloatOpt('sl_wait_initial_interval',
+                 default=1.0,
+                 help='First sleep in seconds while waiting for ordered '
+                      'volume or snapshot space. Sleep doubles after '
+                      'every check, up to sl_vol_active_wait or '
+                      'sl_snap_space_active_wait'),
+    cfg.IntOpt('sl_discovery_cache_ttl',
+               default=600,
+               help='Seconds the iSCSI discovery result of a portal and '
+                    'username is cached. 0 disables the cache'),
+    cfg.StrOpt('sl_discovery_mode',
+               default='iscsid_conf',
+               help='How CHAP credentials are passed to iSCSI discovery. '
+                    "Possible values: iscsid_conf or discoverydb. "
+                    "'iscsid_conf' writes them to /etc/iscsi/iscsid.conf "
+                    "and serializes all discoveries, 'discoverydb' stores "
+                    "them in the discovery record of the portal"),
+    cfg.StrOpt('sl_startup_export',
+               default='bulk',
+               help='How exports are verified when cinder-volume starts. '
+                    'Possible values: bulk, lazy or serial'),
+    cfg.IntOpt('sl_discovery_concurrency',
+               default=8,
+               help='Number of portals discovered in parallel '
+                    'during bulk operations. Only used when '
+                    'sl_discovery_mode is discoverydb'),
+    cfg.IntOpt('sl_pool_index_ttl',
+               default=300,
+               help='Seconds after which the index of free pool volumes '
+                    'is rebuilt from the account. 0 disables the index'),
+    cfg.IntOpt('sl_pool_scrub_workers',
+               default=0,
+               help='Number of volumes wiped in parallel in the background '
+                    'after deletion. 0 wipes the volume while deleting it'),
+    cfg.ListOpt('sl_pool_warm_stock',
+                default=[],
+                help='Sizes for which the pool driver keeps ordered '
+                     'volumes ready, as size:low_water[:target] entries. '
+                     'When fewer than low_water volumes of the size are '
+                     'free, volumes are ordered up to target'),
+    cfg.IntOpt('sl_pool_warm_interval',
+               default=60,
+               help='Seconds between the checks of the warm pool stock'),
+    cfg.IntOpt('sl_catalog_cache_ttl',
+               default=3600,
+               help='Seconds the SoftLayer product catalog is cached. '
+                    '0 disables the cache'),
+    cfg.StrOpt('sl_clone_strategy',
+               default='snapshot',
+               help='How volumes are cloned. Possible values: snapshot or '
+                    "copy. 'snapshot' restores a temporary snapshot of "
+                    'the source onto the new volume on the storage, and '
+                    "falls back to 'copy' when that is not possible. "
+                    "'copy' copies the data through this host"),
+    cfg.StrOpt('sl_copy_engine',
+               default='dd',
+               help='How volume data is copied on the host. Possible '
+                    "values: dd or native. 'native' copies ranges of the "
+                    'volume in parallel within the driver'),
+    cfg.IntOpt('sl_copy_block_size',
+               default=1024,
+               help='Size in KiB of a single read and write of the native '
+                    'copy engine, multiple of 4'),
+    cfg.IntOpt('sl_copy_workers',
+               default=4,
+               help='Number of ranges of the volume copied in parallel by '
+                    'the native copy engine'),
+    cfg.BoolOpt('sl_copy_direct_io',
+                default=True,
+                help='Bypass the page cache of the host with O_DIRECT in '
+                     'the native copy engine'),
+    cfg.BoolOpt('sl_copy_skip_zero',
+                default=False,
+                help='Skip writing all zero blocks while copying with the '
+                     'native copy engine. Only safe when new volumes read '
+                     'as zeros'),
+    cfg.FloatOpt('sl_api_timeout',
+                 default=60,
+                 help='Seconds after which a SoftLayer API call times out. '
+                      '0 waits forever'),
+    cfg.IntOpt('sl_api_concurrency',
+               default=8,
+               help='Maximum number of SoftLayer API calls in flight. '
+                    '0 disables the limit'),
+    cfg.IntOpt('sl_api_retries',
+               default=3,
+               help='Retries of read only SoftLayer API calls failing '
+                    'with a server error, timeout or connection error'),
+    cfg.FloatOpt('sl_api_retry_interval',
+                 default=1.0,
+                 help='Seconds before the first retry of a SoftLayer API '
+                      'call, doubled for every next retry'),
+    cfg.IntOpt('sl_api_keepalive_pool',
+               default=8,
+               help='Number of HTTP connections to the SoftLayer API '
+                    'kept open for reuse. 0 opens a connection per call'),
+    cfg.StrOpt('sl_api_stats_file',
+               default=None,
+               help='File the SoftLayer API call statistics are written '
+                    'to as JSON, on every volume stats update'),
+    cfg.BoolOpt('sl_trace_log',
+                default=False,
+                help='Log the trace of every driver operation, with the '
+                     'duration of its phases, as JSON'),
+    cfg.StrOpt('sl_trace_file',
+               default=None,
+               help='File the trace of every driver operation is '
+                    'appended to, one JSON document per line'),
+    cfg.IntOpt('sl_volume_cache_size',
+               default=1024,
+               help='Number of volumes whose admin metadata is cached '
+                    'in memory, attaches and deletes of cached volumes '
+                    'skip the database read. 0 disables the cache'),
+    cfg.IntOpt('sl_snapshot_batch_concurrency',
+               default=8,
+               help='Number of snapshots created at a time when the '
+                    'snapshots of many volumes are created at once'),
     cfg.StrOpt('sl_username',
                default=None,
                help='SoftLayer username'),
@@ -73,6 +199,30 @@ SL_OPTS = [
                secret=True)]
 
 
+def driver_operation(func):
+    """
+    Trace the driver method and count the SoftLayer API calls it
+    makes, both under the name of the method. The admin metadata
+    changes of the method are written once it completes, except
+    the SoftLayer volumes serialized, see `MetadataManager.serialize`.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        tags = {}
+        # volumes and snapshots are DB models, not dicts
+        try:
+            tags['id'] = args[0]['id']
+        except (TypeError, KeyError, IndexError):
+            pass
+        with TRACER.trace(func.__name__, self.trace_sinks, **tags):
+            with self.meta_mgr.unit_of_work():
+                if self.vol_mgr is None:
+                    return func(self, *args, **kwargs)
+                with self.vol_mgr.client.operation(func.__name__):
+                    return func(self, *args, **kwargs)
+    return wrapper
+
+
 class SoftLayerISCSIDriver(driver.ISCSIDriver):
 
     """SoftLayer iSCSI volume driver. Implements the driver API
@@ -84,8 +234,14 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         super(SoftLayerISCSIDriver, self).__init__(*args, **kwargs)
         self.configuration.append_config_values(SL_OPTS)
         self.vol_mgr = None
-        self.meta_mgr = api.MetadataManager()
+        self.meta_mgr = MetadataManager(
+            self.configuration.sl_volume_cache_size or 0)
+        self.snapshots = SnapshotIndex(self.meta_mgr)
         self._stats = {}
+        self._startup_exports = None
+        self.copier = None
+        self.clone_timer = PhaseTimer()
+        self.trace_sinks = []
 
     def do_setup(self, _):
         """Setup the SoftLayer Volume driver.
@@ -94,6 +250,19 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         Create the softlayer client.
         """
         self.vol_mgr = api.IscsiVolumeManager(configuration=self.configuration)
+        self.trace_sinks = []
+        if self.configuration.sl_trace_log:
+            self.trace_sinks.append(log_trace)
+        if self.configuration.sl_trace_file:
+            self.trace_sinks.append(
+                JsonLinesTraceSink(self.configuration.sl_trace_file))
+        self.copier = None
+        if self.configuration.sl_copy_engine == 'native':
+            self.copier = BlockCopier(
+                self.configuration.sl_copy_block_size or 1024,
+                self.configuration.sl_copy_workers or 1,
+                bool(self.configuration.sl_copy_direct_io),
+                bool(self.configuration.sl_copy_skip_zero))
 
     def check_for_setup_error(self):
         """Check that the driver is working and can communicate.
@@ -101,6 +270,8 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         Invoke a web services API to make sure we can talk to the server.
         Also perform the datacenter value verification.
         """
+        if self.configuration.sl_discovery_mode == 'discoverydb':
+            return self.vol_mgr.check_dc()
         try:
             LOG.debug("Checking if sed is accessible as root")
             utils.execute('sed', '-e',
@@ -116,6 +287,7 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
             raise ex
         return self.vol_mgr.check_dc()
 
+    @driver_operation
     def create_volume(self, volume):
         """Driver entry point for creating a new volume.
 
@@ -166,6 +338,7 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
             model.update({'display_name': sl_vol['username']})
         return model
 
+    @driver_operation
     def delete_volume(self, volume):
         """Driver entry point for destroying existing volumes.
 
@@ -176,15 +349,76 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         self.vol_mgr.cancel(sl_vol)
         self.meta_mgr.delete_all(volume['id'])
 
-    def ensure_export(self, _, volume):
-        """Driver entry point to get the export info for an existing volume."""
+    @driver_operation
+    def ensure_export(self, context, volume):
+        """Driver entry point to get the export info for an existing volume.
+
+        Depending on `sl_startup_export` the first call discovers
+        all the volumes at once (bulk), nothing is done and discovery
+        is left to the attach (lazy) or each volume is discovered
+        on its own (serial).
+        """
+        mode = self.configuration.sl_startup_export or 'serial'
+        if mode not in ('bulk', 'lazy', 'serial'):
+            raise exception.InvalidConfigurationValue(
+                option='sl_startup_export', value=mode)
+        if mode == 'lazy':
+            LOG.debug(_("Discovery of volume %s deferred to attach" %
+                        volume['id']))
+            return None
+        if mode == 'bulk' and self._startup_exports is None:
+            self._startup_exports = self._discover_all()
+        if self._startup_exports and volume['id'] in self._startup_exports:
+            return {'provider_location':
+                    self._startup_exports.pop(volume['id'])}
+        return self._export(volume)
+
+    def _export(self, volume):
         sl_vol = self.meta_mgr.deserialize(volume['id'])
         return {'provider_location':
                 self.vol_mgr.run_iscsiadm(sl_vol)}
 
+    def _discover_all(self):
+        """
+        Discover all the SoftLayer volumes known to Cinder. Admin
+        metadata is read in one pass and volumes are grouped by portal.
+        In `discoverydb` mode portals are discovered in parallel, in
+        `iscsid_conf` mode every discovery holds the global iscsiadm
+        lock, so portals are discovered one after the other.
+
+        :returns: dict of discovery results keyed by OpenStack Volume ID.
+        """
+        by_portal = {}
+        for vol_id, sl_vol in self.meta_mgr.deserialize_all().items():
+            by_portal.setdefault(
+                sl_vol['serviceResourceBackendIpAddress'],
+                []).append((vol_id, sl_vol))
+        exports = {}
+
+        def discover(volumes):
+            for vol_id, sl_vol in volumes:
+                try:
+                    exports[vol_id] = self.vol_mgr.run_iscsiadm(sl_vol)
+                except (exception.VolumeBackendAPIException,
+                        proc_utils.ProcessExecutionError) as ex:
+                    LOG.warn(_("Discovery of volume %s failed: %s" %
+                               (vol_id, ex)))
+
+        concurrency = 1
+        if self.configuration.sl_discovery_mode == 'discoverydb':
+            concurrency = self.configuration.sl_discovery_concurrency or 1
+        pool = greenpool.GreenPool(concurrency)
+        for volumes in by_portal.values():
+            pool.spawn_n(discover, volumes)
+        pool.waitall()
+        LOG.debug(_("Discovered %s volumes on %s portals" %
+                    (len(exports), len(by_portal))))
+        return exports
+
+    @driver_operation
     def create_export(self, context, volume):
         """Driver entry point to get the export info for a new volume."""
-        return self.ensure_export(context, volume)
+        return self._export(volume)
 
     def remove_export(self, context, volume):
         """Driver exntry point to remove an export for a volume.
@@ -194,6 +428,7 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         """
         LOG.debug(_("remove_export called"))
 
+    @driver_operation
     def initialize_connection(self, volume, connector):
         """Driver entry point to attach a volume to an instance.
 
@@ -202,33 +437,81 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         target so that it can be used to attach.
         """
         sl_vol = self.meta_mgr.deserialize(volume['id'])
+        # writes of the instance cannot be tracked
+        self._mark_written(volume['id'], sl_vol)
         return self.vol_mgr.get_iscsi_properties(sl_vol)
 
+    def _mark_written(self, vol_id, sl_vol):
+        """
+        Record that the volume is written, only done for volumes
+        tracking it.
+
+        :param vol_id: OpenStack Volume ID.
+        :param sl_vol: SoftLayer volume object.
+        """
+        if sl_vol.get('sl_written') == api.UNWRITTEN:
+            self.meta_mgr.update_meta(vol_id, {'sl_written': api.WRITTEN})
+
     def terminate_connection(self, volume, connector, **kwargs):
         """Driver entry point to unattach a volume from an instance.
         """
         LOG.debug("Terminate Connection Called")
 
+    @driver_operation
     def create_snapshot(self, snapshot):
         """Driver entry point for creating a snapshot.
 
         If the iSCSI storage has space for new snapshots
         then create new snapshot. Otherwise, order
         snapshot space and then create snapshot.
+
+        :returns: model update holding the SoftLayer snapshot ID.
         """
         volume = snapshot['volume']
         sl_vol = self.meta_mgr.deserialize(volume['id'])
         sl_snap = self.vol_mgr.create_snapshot(sl_vol, snapshot)
-        self.meta_mgr.update_meta(volume['id'],
-                                  {snapshot['id']: sl_snap['id']})
-
+        return self.snapshots.model_update(sl_snap)
+
+    @driver_operation
+    def create_snapshots(self, snapshots):
+        """Create the snapshots of many volumes at once, e.g. for a
+        consistency point. Not part of the Cinder driver API, it is
+        meant for the tools driving the backend.
+
+        :param snapshots: OpenStack Snapshot Objects, at most one
+                          per volume.
+        :returns: dict keyed by snapshot ID of the results, each with
+                  `model_update` of the snapshot created or `error`.
+        """
+        sl_vol_ids = {}
+        for snapshot in snapshots:
+            sl_vol = self.meta_mgr.deserialize(snapshot['volume']['id'])
+            if sl_vol['id'] in sl_vol_ids.values():
+                raise exception.InvalidInput(
+                    reason="Only one snapshot per volume can be created "
+                           "at once, volume %s" % snapshot['volume']['id'])
+            sl_vol_ids[snapshot['id']] = sl_vol['id']
+        results = self.vol_mgr.create_snapshots(
+            list(sl_vol_ids.values()),
+            self.configuration.sl_snapshot_batch_concurrency or 1)
+        updates = {}
+        for snapshot_id, sl_vol_id in sl_vol_ids.items():
+            result = results[int(sl_vol_id)]
+            model_update = None
+            if result['snapshot']:
+                model_update = self.snapshots.model_update(result['snapshot'])
+            updates[snapshot_id] = {'model_update': model_update,
+                                    'error': result['error']}
+        return updates
+
+    @driver_operation
     def delete_snapshot(self, snapshot):
         """Driver entry point for deleting a snapshot."""
-        volume = snapshot['volume']
-        sl_snap_id = self.meta_mgr.get(volume['id'], snapshot['id'])
+        sl_snap_id = self.snapshots.lookup(snapshot)
         self.vol_mgr.delete_snapshot(sl_snap_id)
-        self.meta_mgr.delete_entry(volume, snapshot['id'])
+        self.snapshots.remove(snapshot)
 
+    @driver_operation
     def create_volume_from_snapshot(self, volume, snapshot):
         """Driver entry point for creating a new volume from a snapshot.
 
@@ -236,9 +519,9 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         we copy the contents into new volume.
         """
         model_update = self.create_volume(volume)
-        sl_snap_id = self.meta_mgr.get(snapshot['volume']['id'],
-                                       snapshot['id'])
+        sl_snap_id = self.snapshots.lookup(snapshot)
         sl_vol = self.meta_mgr.deserialize(volume['id'])
+        self._mark_written(volume['id'], sl_vol)
         try:
             self.vol_mgr.restore_snapshot(sl_snap_id, sl_vol)
         except SoftLayerAPIError as ex:
@@ -248,65 +531,180 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
             raise exception.VolumeBackendAPIException(data=ex.message)
         return model_update
 
-    def _attch(self, conn):
+    @traced('login')
+    def _attch(self, conn, sl_vol):
         """
         Creates the properties dict required by the brick utils
-        to attache the volume.
+        to attache the volume. If attach fails, cached discovery
+        details of the volume are dropped.
 
         :param conn: connection information retrived from SL/iSCSI tools.
+        :param sl_vol: SoftLayer volume the connection belongs to.
         """
         protocol = conn['driver_volume_type']
         LOG.debug("Attaching for protocol '%s'" % protocol)
         connector = utils.brick_get_connector(protocol)
-        device = connector.connect_volume(conn['data'])
-        host_device = device['path']
-        if not connector.check_valid_device(host_device):
-            raise exception.InvalidResults(
-                "Unable to get valid device %s" %
-                host_device)
+        try:
+            device = connector.connect_volume(conn['data'])
+            host_device = device['path']
+            if not connector.check_valid_device(host_device):
+                raise exception.InvalidResults(
+                    "Unable to get valid device %s" %
+                    host_device)
+        except Exception:
+            self.vol_mgr.invalidate_discovery(sl_vol)
+            raise
         return {'conn': conn, 'device': device, 'connector': connector}
 
+    @driver_operation
     def create_cloned_volume(self, volume, src_vref):
         """Creates clone of an existing volume.
 
         1. Create a new iSCSI storage.
-        2. Attach it.
-        3. Attach the source volume.
-        4. Copy source into new volume.
-        5. Detach both the volume.
+        2. Restore a snapshot of the source into it, if
+           `sl_clone_strategy` is snapshot. Otherwise,
+        3. Attach it.
+        4. Attach the source volume.
+        5. Copy source into new volume.
+        6. Detach both the volume.
         """
         self.create_volume(volume)
         new_sl_vol = self.meta_mgr.deserialize(volume['id'])
         src_sl_vol = self.meta_mgr.deserialize(src_vref['id'])
+        self._mark_written(volume['id'], new_sl_vol)
         try:
-            self._copy_volume(src_sl_vol, new_sl_vol)
+            if not self._clone_on_storage(src_sl_vol, new_sl_vol):
+                self._copy_volume(src_sl_vol, new_sl_vol)
         except:
             self.delete_volume(volume)
             raise
         return self._create_model(new_sl_vol, volume,
                                   source_volid=src_vref['id'])
 
+    def _clone_on_storage(self, src_sl_vol, new_sl_vol):
+        """
+        Clone the volume on the storage by restoring a temporary
+        snapshot of the source onto the new volume.
+
+        :returns: False if storage side clone is not possible and
+                  the data has to be copied.
+        """
+        if self.configuration.sl_clone_strategy != 'snapshot':
+            return False
+        if int(src_sl_vol['capacityGb']) != int(new_sl_vol['capacityGb']):
+            LOG.info(_("Source and new volume sizes differ, copying data."))
+            return False
+        try:
+            # copying is preferred to buying snapshot space of the source
+            sl_snap = self.vol_mgr.create_snapshot(src_sl_vol, None,
+                                                   order_space=False)
+        except exception.VolumeBackendAPIException as ex:
+            LOG.warn(_("Unable to snapshot the source volume, "
+                       "copying data. %s" % ex))
+            return False
+        try:
+            self.vol_mgr.restore_snapshot(sl_snap['id'], new_sl_vol)
+        except SoftLayerAPIError as ex:
+            LOG.warn(_("Unable to restore the snapshot, "
+                       "copying data. %s" % ex))
+            self._delete_clone_snapshot(sl_snap)
+            return False
+        try:
+            self.vol_mgr.wait_for_transactions(new_sl_vol)
+        finally:
+            self._delete_clone_snapshot(sl_snap)
+        LOG.info(_("Successfully cloned the volume on the storage"))
+        return True
+
+    def _delete_clone_snapshot(self, sl_snap):
+        try:
+            self.vol_mgr.delete_snapshot(sl_snap['id'])
+        except exception.VolumeBackendAPIException as ex:
+            LOG.warn(_("Unable to delete snapshot %s used for clone. %s" %
+                       (sl_snap['id'], ex)))
+
     def _copy_volume(self, src_sl_vol, new_sl_vol):
         """Creates a clone of the specified volume."""
-        dest_conn = self.vol_mgr.get_iscsi_properties(new_sl_vol)
-        dest_attach_info = self._attch(dest_conn)
-        source_conn = self.vol_mgr.get_iscsi_properties(src_sl_vol)
-        src_attach_info = self._attch(source_conn)
+        durations = {}
+        with self.clone_timer.time('attach', durations):
+            dest_attach_info, src_attach_info = self._attach_all(
+                [(new_sl_vol, 'attach_dest'), (src_sl_vol, 'attach_source')],
+                durations)
         LOG.debug("Both source and destination volumes "
                   "are attached successfully. Copying data.")
         size_in_mb = int(new_sl_vol['capacityGb']) * 1024
         try:
-            volume_utils.copy_volume(src_attach_info['device']['path'],
-                                     dest_attach_info['device']['path'],
-                                     size_in_mb)
-        except proc_utils.ProcessExecutionError:
+            with self.clone_timer.time('copy', durations):
+                self._copy_data(src_attach_info['device']['path'],
+                                dest_attach_info['device']['path'],
+                                size_in_mb)
+        except (proc_utils.ProcessExecutionError, EnvironmentError):
             LOG.error("Error while copying data.")
             raise
         finally:
-            self._detach_volume(dest_attach_info)
-            self._detach_volume(src_attach_info)
+            with self.clone_timer.time('detach', durations):
+                self._detach_volume(dest_attach_info)
+                self._detach_volume(src_attach_info)
         LOG.info("Successfully cloned the volume")
+        LOG.debug(_("Clone phase timings: %s") % ', '.join(
+            '%s %.3fs' % (phase, seconds)
+            for phase, seconds in sorted(durations.items())))
+
+    def _attach_all(self, volumes, durations=None):
+        """
+        Discover and attach the volumes in parallel. If any of the
+        attaches fails, the attached volumes are detached.
+
+        :param volumes: (SoftLayer volume object, phase) pairs, the
+                        attach of the volume is timed as phase.
+        :param durations: dict the attach times are added to.
+        :returns: attach info of the volumes, in the given order.
+        """
+        trace_context = TRACER.current()
+
+        def attach(sl_vol, phase):
+            # errors are returned, the hub would log them otherwise
+            try:
+                with TRACER.resume(trace_context):
+                    with self.clone_timer.time(phase, durations):
+                        conn = self.vol_mgr.get_iscsi_properties(sl_vol)
+                        return self._attch(conn, sl_vol), None
+            except Exception as ex:
+                LOG.error(_("Unable to attach volume %s. %s" %
+                            (sl_vol['id'], ex)))
+                return None, ex
+
+        threads = [greenthread.spawn(attach, sl_vol, phase)
+                   for sl_vol, phase in volumes]
+        attached = []
+        error = None
+        for thread in threads:
+            attach_info, ex = thread.wait()
+            if ex is None:
+                attached.append(attach_info)
+            error = error or ex
+        if error:
+            for attach_info in attached:
+                self._detach_volume(attach_info)
+            raise error
+        return attached
+
+    def _copy_data(self, src_path, dest_path, size_in_mb, skip_zero=None):
+        """
+        Copy the data between the attached devices with the engine
+        selected by `sl_copy_engine`.
 
+        :param skip_zero: overrides `sl_copy_skip_zero`.
+        """
+        if not self.copier:
+            volume_utils.copy_volume(src_path, dest_path, size_in_mb)
+            return
+        stats = self.copier.copy(src_path, dest_path, size_in_mb, skip_zero)
+        LOG.info(_("Copied %(size)s MiB in %(seconds).1fs, "
+                   "%(skipped)s bytes of zeros skipped") %
+                 dict(stats, size=size_in_mb))
+
+    @driver_operation
     def get_volume_stats(self, refresh=False):
         """Get volume status.
 
@@ -317,6 +715,8 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
             return self._stats
         # update the stats
         LOG.debug(_("Updating volume status"))
+        if self.vol_mgr:
+            self.vol_mgr.catalog.refresh()
         data = {}
         backend_name = self.configuration.safe_get('volume_backend_name')
         data["volume_backend_name"] = backend_name or 'SoftLayer_iSCSI'
@@ -328,9 +728,21 @@ class SoftLayerISCSIDriver(driver.ISCSIDriver):
         data['free_capacity_gb'] = 'infinite'
         data['reserved_percentage'] = 0
         data['QoS_support'] = False
+        if self.vol_mgr:
+            data['api_stats'] = self.vol_mgr.stats()
+            self._dump_api_stats(data['api_stats'])
         self._stats = data
         return self._stats
 
+    def _dump_api_stats(self, stats):
+        path = self.configuration.sl_api_stats_file
+        if not path:
+            return
+        try:
+            self.vol_mgr.client.dump(path, stats)
+        except EnvironmentError as ex:
+            LOG.warn(_("Unable to write API stats to %s: %s" % (path, ex)))
+
 
 class SoftLayerISCSIPoolDriver(SoftLayerISCSIDriver):
     """
@@ -338,73 +750,251 @@ class SoftLayerISCSIPoolDriver(SoftLayerISCSIDriver):
     tries to use existing volumes over ordering new ones.
     """
 
-    @lockutils.synchronized('sl_create_vol', 'cinder-', False)
+    SYS_BLOCK = '/sys/block'
+
+    def __init__(self, *args, **kwargs):
+        super(SoftLayerISCSIPoolDriver, self).__init__(*args, **kwargs)
+        self.warm_pool = None
+        self._scrub_pool = greenpool.GreenPool(0)
+        self._scrub_backlog = collections.deque()
+
+    @driver_operation
     def create_volume(self, volume):
         """
         Finds a free volume from pool to use,
         if not found new volume is created
         (if configuration also allows that)
 
+        The SoftLayer volume is reserved before it is used, so the
+        pool lock is only held while reserving and not during the
+        SoftLayer API calls or while the order becomes active. The
+        reservation is kept until the metadata of the operation is
+        stored.
+
         :param volume: OpenStack Volume Object.
         """
         metadata = self.meta_mgr.get_user_meta(volume['id'])
         LOG.debug(
             _("Create volume called with name: %s, size: %s, id: %s" %
               (volume['display_name'], volume['size'], volume['id'])))
-        sl_vol = None
-        imported = self.meta_mgr.all_imported()
-        if 'softlayer_volume_id' in metadata and \
-                int(metadata['softlayer_volume_id']) in imported:
-            raise exception.InvalidVolume(
-                reason="Volume requested is already is in use")
-        elif 'softlayer_volume_id' in metadata:
-            sl_vol = self.vol_mgr.use_exiting(
-                volume['size'], metadata['softlayer_volume_id'])
-        else:
-            sl_vol = self.vol_mgr.find_free_volume(volume['size'], imported)
+        extra = None
+        if self.configuration.sl_pool_volume_clear == 'zero-written':
+            extra = {'sl_written': api.UNWRITTEN}
+        sl_vol = self._allocate(volume, metadata, self.meta_mgr.reserve)
+        self.meta_mgr.serialize(volume['id'], sl_vol, extra)
+        return self._create_model(sl_vol, volume)
+
+    def check_for_setup_error(self):
+        """Check that the driver is working and can communicate.
+
+        Also queues the volumes left dirty to be wiped and
+        starts the warm pool if `sl_pool_warm_stock` is set.
+        """
+        result = super(SoftLayerISCSIPoolDriver, self).check_for_setup_error()
+        self._scrub_pool = greenpool.GreenPool(
+            self.configuration.sl_pool_scrub_workers or 0)
+        if self._scrub_pool.size > 0:
+            for sl_vol in self.vol_mgr.list_dirty():
+                self.vol_mgr.dirty.add(int(sl_vol['id']))
+                self._enqueue_scrub(sl_vol)
+        stock = api.WarmPoolManager.parse_stock(
+            self.configuration.sl_pool_warm_stock)
+        if not stock:
+            return result
+        if self.vol_mgr.free_pool.ttl <= 0:
+            LOG.warn(_("Warm pool requires the free pool index, "
+                       "set sl_pool_index_ttl to enable it."))
+            return result
+        if self.warm_pool:
+            self.warm_pool.stop()
+        self.warm_pool = api.WarmPoolManager(
+            self.vol_mgr, self.meta_mgr, stock,
+            self.configuration.sl_pool_warm_interval or 60)
+        self.warm_pool.start()
+        return result
+
+    def _allocate(self, volume, metadata, reserve):
+        """
+        Find and reserve the SoftLayer volume for the volume.
 
+        :param volume: OpenStack Volume Object.
+        :param metadata: user metadata of the volume.
+        :param reserve: callable reserving the SoftLayer volume ID.
+        """
+        if 'softlayer_volume_id' in metadata:
+            if not reserve(metadata['softlayer_volume_id']):
+                raise exception.InvalidVolume(
+                    reason="Volume requested is already is in use")
+            return self.vol_mgr.use_exiting(
+                volume['size'], metadata['softlayer_volume_id'])
+        sl_vol = self.vol_mgr.find_free_volume(
+            volume['size'], reserve, self.meta_mgr.in_use)
         if sl_vol:
-            self.meta_mgr.serialize(volume['id'], sl_vol)
-            return self._create_model(sl_vol, volume)
+            return sl_vol
         if not self.configuration.sl_pool_real_order:
             raise exception.VolumeBackendAPIException(
                 data="Storage pool has been fully utilized."
                 " Configuration does not allow driver to order new storage.")
         # here we have to order a new volume.
         sl_vol = self.vol_mgr.create_volume(volume)
-        self.meta_mgr.serialize(volume['id'], sl_vol)
-        return self._create_model(sl_vol, volume)
+        self.vol_mgr.free_pool.track(sl_vol)
+        if not reserve(sl_vol['id']):
+            raise exception.VolumeBackendAPIException(
+                data="Ordered volume %s has been used by another volume." %
+                sl_vol['id'])
+        return sl_vol
 
+    @driver_operation
     def delete_volume(self, volume):
         """
         Removes the data from volume and returns the volume to pool.
 
+        When scrub workers are configured the volume is marked dirty
+        and wiped in the background, it is returned to the pool once
+        wiped.
+
         :param volume: OpenStack Volume Object.
         """
         if self.configuration.sl_pool_volume_clear not in \
-                ("zero", "shred", "none"):
+                ("zero", "shred", "none", "discard", "zero-written"):
             raise exception.InvalidConfigurationValue(
                 option='volume_clear',
                 value=self.configuration.sl_pool_volume_clear)
 
         sl_vol = self.meta_mgr.deserialize(volume['id'])
+        if self.configuration.sl_pool_volume_clear != 'none' and \
+                self._scrub_pool.size > 0:
+            self.vol_mgr.mark_dirty(sl_vol)
+            self.meta_mgr.delete_all(volume['id'])
+            self._enqueue_scrub(sl_vol)
+            return
+        self._wipe(sl_vol, 1024 * volume['size'])
+        self.meta_mgr.delete_all(volume['id'])
+        self.vol_mgr.free_pool.put(sl_vol)
+
+    @traced('wipe')
+    def _wipe(self, sl_vol, size_in_mb):
+        """
+        Erase the contents of the volume as per `sl_pool_volume_clear`.
+
+        :param sl_vol: SoftLayer volume object.
+        :param size_in_mb: size of the volume.
+        """
         connection = self.vol_mgr.get_iscsi_properties(sl_vol)
-        attach_info = self._attch(connection)
-        size_in_mb = 1024 * volume['size']
+        attach_info = self._attch(connection, sl_vol)
 
+        path = attach_info['device']['path']
+        clear = self.configuration.sl_pool_volume_clear
         try:
-            if self.configuration.sl_pool_volume_clear == 'zero':
+            if clear == 'discard' and not self._discard(path):
+                clear = 'zero'
+            elif clear == 'zero-written':
+                if sl_vol.get('sl_written') == api.UNWRITTEN:
+                    LOG.info("Volume not written, nothing to erase")
+                else:
+                    clear = 'zero'
+            if clear == 'zero':
                 LOG.info("zeroing out volume")
-                volume_utils.copy_volume(
-                    '/dev/zero', attach_info['device']['path'], size_in_mb)
-            elif self.configuration.sl_pool_volume_clear == 'shred':
+                self._copy_data('/dev/zero', path, size_in_mb,
+                                skip_zero=False)
+            elif clear == 'shred':
                 LOG.info("Shredding volume")
-                utils.execute('shred', '-n3', '-s%dMiB' %
-                              size_in_mb, attach_info['device']['path'],
+                utils.execute('shred', '-n3', '-s%dMiB' % size_in_mb, path,
                               run_as_root=True)
-        except proc_utils.ProcessExecutionError as ex:
+        except (proc_utils.ProcessExecutionError, EnvironmentError) as ex:
             LOG.error(_("Error while swiping out data. %s" % ex))
             raise
         finally:
             self._detach_volume(attach_info)
-        self.meta_mgr.delete_all(volume['id'])
+
+    def _discard(self, path):
+        """
+        Discard all blocks of the device. Discarded blocks do not
+        necessarily read back as zeros, unless the device reports
+        so they are zeroed out by the device instead.
+
+        :returns: False if the device does not support discard.
+        """
+        LOG.info("Discarding volume")
+        args = ['blkdiscard', path]
+        if not self._discard_zeroes_data(path):
+            args.insert(1, '--zeroout')
+        try:
+            utils.execute(*args, run_as_root=True)
+        except proc_utils.ProcessExecutionError as ex:
+            LOG.warn(_("Discard not supported, zeroing out instead. %s" %
+                       ex))
+            return False
+        return True
+
+    def _discard_zeroes_data(self, path):
+        """
+        Checks if the discarded blocks of the device read as zeros.
+        """
+        name = os.path.basename(os.path.realpath(path))
+        try:
+            with open(os.path.join(self.SYS_BLOCK, name, 'queue',
+                                   'discard_zeroes_data')) as sys_file:
+                return sys_file.read().strip() == '1'
+        except EnvironmentError:
+            return False
+
+    def _enqueue_scrub(self, sl_vol):
+        """
+        Queue the dirty volume to be wiped, a worker is started if
+        the worker pool is not full.
+        """
+        self._scrub_backlog.append(sl_vol)
+        if self._scrub_pool.free():
+            self._scrub_pool.spawn_n(self._scrub_worker)
+
+    def _scrub_worker(self):
+        while self._scrub_backlog:
+            self._scrub(self._scrub_backlog.popleft())
+
+    def _scrub(self, sl_vol):
+        """
+        Wipe the dirty volume and return it to the pool. On failure
+        the volume stays dirty and is retried after restart.
+        """
+        try:
+            with TRACER.trace('scrub', self.trace_sinks, id=sl_vol['id']):
+                self._wipe(sl_vol, 1024 * int(sl_vol['capacityGb']))
+                self.vol_mgr.mark_clean(sl_vol)
+        except Exception as ex:
+            LOG.error(_("Unable to wipe volume %s: %s" % (sl_vol['id'], ex)))
+            return
+        self.vol_mgr.free_pool.put(sl_vol)
+
+    @driver_operation
+    def get_volume_stats(self, refresh=False):
+        """Get volume status.
+
+        Rebuilds the free pool index when it has expired, between
+        the rebuilds the index is kept up to date by the driver.
+        The capacity of the pool is reported from the index, unless
+        the driver is allowed to order new volumes.
+        """
+        free_pool = self.vol_mgr.free_pool if self.vol_mgr else None
+        if refresh and free_pool and free_pool.ttl > 0 and \
+                free_pool.expired():
+            try:
+                self.vol_mgr.refresh_free_pool(self.meta_mgr.in_use())
+            except SoftLayerAPIError as ex:
+                LOG.warn(_("Unable to refresh free pool: %s" % ex))
+        stats = super(SoftLayerISCSIPoolDriver, self).get_volume_stats(
+            refresh=refresh)
+        if not refresh or not free_pool or free_pool.loaded_at is None:
+            return stats
+        free_count = free_pool.free_count()
+        stats['free_volumes'] = dict(
+            (str(capacity), count) for capacity, count in free_count.items())
+        stats['total_volumes'] = dict(
+            (str(capacity), count)
+            for capacity, count in free_pool.total_count().items())
+        stats['largest_free_volume_gb'] = max(free_count or [0])
+        if not self.configuration.sl_pool_real_order:
+            total, free = free_pool.capacity()
+            stats['total_capacity_gb'] = total
+            stats['free_capacity_gb'] = free
+        return stats
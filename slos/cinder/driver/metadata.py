@@ -0,0 +1,632 @@
+"""
+Admin metadata representation of the SoftLayer volumes
+"""
+import contextlib
+import functools
+
+from cinder import db
+from cinder import context
+from cinder.openstack.common.gettextutils import _
+from cinder.openstack.common import lockutils
+from cinder.openstack.common import log as logging
+
+from eventlet import corolocal
+
+from .cache import LRUCache
+from .tracing import traced
+
+LOG = logging.getLogger(__name__)
+
+
+class VolumeRecord(object):
+    """
+    Immutable SoftLayer volume parsed from its admin metadata. It is
+    read like the SoftLayer API volume object, e.g. `record['id']`
+    or `record['billingItem']['id']`, other admin metadata entries,
+    e.g. `sl_written`, by their key.
+
+    The admin metadata is kept as is, it must not be changed once
+    the record is built.
+    """
+
+    __slots__ = ('id', 'billing_item_id', 'capacity_gb', 'portal',
+                 'username', 'password', 'meta')
+
+    # SoftLayer volume keys read from the fields
+    FIELDS = {'id': 'id',
+              'capacityGb': 'capacity_gb',
+              'serviceResourceBackendIpAddress': 'portal',
+              'username': 'username',
+              'password': 'password'}
+    # admin metadata keys only available through the fields
+    HIDDEN = frozenset(('sl_id', 'billing_item_id', 'portal'))
+
+    def __init__(self, meta):
+        """
+        :param meta: admin metadata of the volume.
+        """
+        init = functools.partial(object.__setattr__, self)
+        init('id', int(meta['sl_id']))
+        init('billing_item_id', int(meta['billing_item_id']))
+        init('capacity_gb', int(meta['capacityGb']))
+        init('portal', meta['portal'])
+        init('username', meta.get('username'))
+        init('password', meta.get('password'))
+        init('meta', meta)
+
+    @classmethod
+    def from_sl_vol(cls, sl_vol, extra=None):
+        """
+        Build the record of a SoftLayer API volume object.
+
+        :param extra: other admin metadata of the volume.
+        """
+        meta = {
+            'sl_id': str(sl_vol['id']),
+            'billing_item_id': str(sl_vol['billingItem']['id']),
+            'portal': sl_vol['serviceResourceBackendIpAddress'],
+            'capacityGb': str(sl_vol['capacityGb']),
+            'username': sl_vol['username'],
+            'password': sl_vol['password'],
+        }
+        meta.update(extra or {})
+        return cls(meta)
+
+    def to_admin_meta(self):
+        """
+        Returns the admin metadata of the volume, not a copy.
+        """
+        return self.meta
+
+    def __setattr__(self, name, value):
+        raise AttributeError("VolumeRecord is immutable")
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, key):
+        field = self.FIELDS.get(key)
+        if field is not None:
+            return getattr(self, field)
+        if key == 'billingItem':
+            return {'id': self.billing_item_id}
+        if key in self.HIDDEN:
+            raise KeyError(key)
+        return self.meta[key]
+
+    def __contains__(self, key):
+        return key in self.FIELDS or key == 'billingItem' or \
+            (key in self.meta and key not in self.HIDDEN)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '<VolumeRecord %s>' % self.id
+
+
+class MetadataUnitOfWork(object):
+    """
+    Admin metadata changes made during one driver operation. The
+    changes are kept per volume and written by
+    `MetadataManager.flush`, a single update per volume. The
+    SoftLayer volumes reserved during the operation are released
+    once the changes are written.
+    """
+
+    def __init__(self):
+        self._context = None
+        self.stored = {}
+        self.changes = {}
+        self.reserved = []
+
+    @property
+    def context(self):
+        """
+        Admin context shared by the database calls of the operation.
+        """
+        if self._context is None:
+            self._context = context.get_admin_context()
+        return self._context
+
+    def _change(self, vol_id):
+        return self.changes.setdefault(
+            vol_id, {'replace': False, 'values': {}, 'removed': set()})
+
+    def update(self, vol_id, metadata):
+        change = self._change(vol_id)
+        change['values'].update(metadata)
+        change['removed'].difference_update(metadata)
+
+    def remove(self, vol_id, key):
+        change = self._change(vol_id)
+        change['values'].pop(key, None)
+        if not change['replace']:
+            change['removed'].add(key)
+
+    def clear(self, vol_id):
+        self.changes[vol_id] = {
+            'replace': True, 'values': {}, 'removed': set()}
+
+    def apply(self, vol_id, metadata):
+        """
+        Returns the metadata with the pending changes of the volume.
+
+        :param metadata: admin metadata stored in the database.
+        """
+        change = self.changes.get(vol_id)
+        if change is None:
+            return metadata
+        if change['replace']:
+            metadata = {}
+        else:
+            metadata = dict((key, value) for key, value in metadata.items()
+                            if key not in change['removed'])
+        metadata.update(change['values'])
+        return metadata
+
+
+class MetadataManager(object):
+    """
+    Manages the admin metadata representation of
+    SoftLayer volumes.
+
+    Inside `unit_of_work` the changes are collected and written
+    once the outermost unit completes, reads see the pending
+    changes. `serialize` is written at once, so the SoftLayer
+    volume is seen as imported by the other green threads while
+    the operation continues.
+
+    Deserialized volumes are cached, every write of the admin
+    metadata drops the volume from the cache and increases the
+    generation.
+    """
+
+    def __init__(self, cache_size=0):
+        """
+        :param cache_size: number of deserialized volumes kept,
+                           0 disables the cache.
+        """
+        self._imported = None
+        # IDs serialized by each rebuild of the imported index in progress
+        self._loading = []
+        self._reserved = set()
+        self._local = corolocal.local()
+        self._records = LRUCache(cache_size)
+        self._generation = 0
+
+    def _unit(self):
+        return getattr(self._local, 'unit', None)
+
+    def _context(self):
+        unit = self._unit()
+        if unit is not None:
+            return unit.context
+        return context.get_admin_context()
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """
+        Context manager collecting the admin metadata changes of the
+        current green thread. Nested units are part of the outermost
+        one. The changes are flushed also when the block fails, they
+        record what has already been done on SoftLayer. The volumes
+        reserved in the unit are released after the flush.
+        """
+        unit = self._unit()
+        if unit is not None:
+            yield unit
+            return
+        unit = MetadataUnitOfWork()
+        self._local.unit = unit
+        try:
+            try:
+                yield unit
+            except Exception:
+                self._local.unit = None
+                self.flush(unit, ignore_errors=True)
+                raise
+            self._local.unit = None
+            self.flush(unit)
+        finally:
+            for sl_vol_id in unit.reserved:
+                self.release(sl_vol_id)
+
+    @traced('db.flush')
+    def flush(self, unit, ignore_errors=False):
+        """
+        Write the changes of the unit, one update per volume. Keys
+        removed from a volume are dropped by replacing its metadata.
+
+        :param unit: `MetadataUnitOfWork` to write.
+        :param ignore_errors: log the failed updates instead of raising.
+        """
+        for vol_id, change in unit.changes.items():
+            try:
+                self._write(unit, vol_id, change)
+            except Exception as ex:
+                # the imported index may list volumes not stored
+                self._imported = None
+                if not ignore_errors:
+                    raise
+                LOG.error(_("Unable to store admin metadata of volume "
+                            "%s: %s" % (vol_id, ex)))
+            finally:
+                self._invalidate(vol_id)
+        unit.changes.clear()
+
+    def _write(self, unit, vol_id, change):
+        if change['replace']:
+            db.volume_admin_metadata_update(
+                unit.context, vol_id, change['values'], True)
+        elif change['removed']:
+            db.volume_admin_metadata_update(
+                unit.context, vol_id,
+                unit.apply(vol_id, self._stored(vol_id, unit)), True)
+        elif change['values']:
+            db.volume_admin_metadata_update(
+                unit.context, vol_id, change['values'], False)
+
+    def _write_through(self, unit, vol_id):
+        """
+        Write the pending changes of the volume before the unit
+        completes.
+        """
+        try:
+            self._write(unit, vol_id, unit.changes[vol_id])
+            del unit.changes[vol_id]
+            unit.stored.pop(vol_id, None)
+        finally:
+            self._invalidate(vol_id)
+
+    def _invalidate(self, vol_id):
+        """
+        Drop the cached volume, called after its metadata is written.
+        Reads started before are not cached, see `deserialize`.
+        """
+        self._generation += 1
+        self._records.invalidate(vol_id)
+
+    def _local_volume_references(self, cntx):
+        """
+        Get all volumes in Cinder.
+        """
+        return db.volume_get_all(
+            cntx, marker=None, limit=None,
+            sort_key='created_at', sort_dir='desc')
+
+    def _all_admin_meta(self):
+        """
+        Returns admin metadata of all volumes in Cinder keyed by volume ID.
+
+        Volumes fetched with admin context carry their admin metadata
+        rows, so all of them are read from the single `volume_get_all`
+        query. Per volume lookup is used only when the rows are not
+        part of the result.
+        """
+        cntx = self._context()
+        all_meta = {}
+        for vol in self._local_volume_references(cntx):
+            if 'volume_admin_metadata' not in vol:
+                all_meta[vol['id']] = self.get_all(vol['id'])
+                continue
+            all_meta[vol['id']] = dict(
+                (item['key'], item['value'])
+                for item in vol['volume_admin_metadata']
+                if not item.get('deleted', False))
+        return all_meta
+
+    def _load_imported(self):
+        """
+        Builds the index of imported SoftLayer volume IDs. Volumes
+        serialized while the database is read are added, the read may
+        have missed them.
+        """
+        serialized = set()
+        self._loading.append(serialized)
+        try:
+            imported = set(int(meta['sl_id'])
+                           for meta in self._all_admin_meta().values()
+                           if 'sl_id' in meta)
+        finally:
+            self._loading.remove(serialized)
+        return imported | serialized
+
+    def all_imported(self, refresh=False):
+        """
+        Returns ID of all imported volumes
+
+        :param refresh: rebuild the index from the database.
+        :returns: set of external vol's id
+        """
+        if self._imported is None or refresh:
+            self._imported = self._load_imported()
+        return self._imported
+
+    def in_use(self):
+        """
+        Returns the IDs of the imported and the reserved volumes, the
+        imported index is rebuilt from the database. A reserved volume
+        may not be stored yet.
+        """
+        return self.all_imported(refresh=True) | self._reserved
+
+    def is_imported(self, sl_vol_id):
+        """
+        Checks if the SoftLayer volume is used by any Cinder volume.
+
+        :param sl_vol_id: SoftLayer iSCSI volume ID.
+        """
+        return int(sl_vol_id) in self.all_imported()
+
+    @lockutils.synchronized('sl_create_vol', 'cinder-', False)
+    def reserve(self, sl_vol_id):
+        """
+        Claims the SoftLayer volume for a volume being created.
+        Inside a unit of work the reservation is kept until the unit
+        is flushed, otherwise until `release` is called.
+
+        :param sl_vol_id: SoftLayer iSCSI volume ID.
+        :returns: False if the volume is imported or already reserved.
+        """
+        sl_vol_id = int(sl_vol_id)
+        if sl_vol_id in self._reserved or self.is_imported(sl_vol_id):
+            return False
+        self._reserved.add(sl_vol_id)
+        unit = self._unit()
+        if unit is not None:
+            unit.reserved.append(sl_vol_id)
+        return True
+
+    def release(self, sl_vol_id):
+        """
+        Drops the reservation of the SoftLayer volume.
+
+        :param sl_vol_id: SoftLayer iSCSI volume ID.
+        """
+        self._reserved.discard(int(sl_vol_id))
+
+    def _stored(self, vol_id, unit=None):
+        """
+        Reads the admin metadata of the volume from the database, the
+        unit of work reads it once.
+        """
+        if unit is None:
+            return db.volume_admin_metadata_get(self._context(), vol_id)
+        if vol_id not in unit.stored:
+            unit.stored[vol_id] = db.volume_admin_metadata_get(
+                unit.context, vol_id)
+        return unit.stored[vol_id]
+
+    def get_all(self, vol_id):
+        """
+        Retrives the user metadata of the volume.
+
+        :param vol_id: OpenStack Volume ID.
+        """
+        unit = self._unit()
+        metadata = self._stored(vol_id, unit)
+        if unit is not None:
+            return unit.apply(vol_id, metadata)
+        return metadata
+
+    @traced('db.deserialize')
+    def deserialize(self, vol_id):
+        """
+        Convertes the database representation of the volume
+        into SoftLayer Volume object. Cached volumes are returned
+        without reading the database, unless the unit of work has
+        pending changes of the volume.
+        """
+        unit = self._unit()
+        if unit is None or vol_id not in unit.changes:
+            record = self._records.get(vol_id)
+            if record is not None:
+                return record
+        # a write during the read makes the result stale to cache
+        generation = self._generation
+        return self._to_sl_vol(self.get_all(vol_id), vol_id, generation)
+
+    def deserialize_all(self):
+        """
+        Convertes the database representation of all volumes
+        into SoftLayer Volume objects.
+
+        :returns: dict of SoftLayer volume objects keyed by
+                  OpenStack Volume ID.
+        """
+        sl_vols = {}
+        generation = self._generation
+        for vol_id, meta in self._all_admin_meta().items():
+            sl_vol = self._to_sl_vol(meta, vol_id, generation)
+            if sl_vol:
+                sl_vols[vol_id] = sl_vol
+        return sl_vols
+
+    def _to_sl_vol(self, meta, vol_id=None, generation=None):
+        """
+        Build SoftLayer Volume record from the admin metadata. The
+        record parsed last for the volume is reused if its metadata
+        did not change.
+
+        :param vol_id: OpenStack Volume ID the metadata belongs to.
+        :param generation: generation the metadata was read at, the
+                           record is cached only if still current.
+        """
+        if 'sl_id' not in meta:
+            return None
+        record = self._records.get(vol_id) if vol_id else None
+        if record is not None and record.meta == meta:
+            return record
+        record = VolumeRecord(meta)
+        if vol_id and generation == self._generation:
+            unit = self._unit()
+            if unit is None or vol_id not in unit.changes:
+                self._records.set(vol_id, record)
+        return record
+
+    @traced('db.serialize')
+    def serialize(self, vol_id, sl_vol, extra=None):
+        """
+        Converts and stores the SoftLayer volume object
+        into database as admin metadata. Inside a unit of work the
+        pending changes of the volume are written along at once.
+
+        :param extra: other admin metadata to be stored along.
+        """
+        record = VolumeRecord.from_sl_vol(sl_vol, extra)
+        self.update_meta(vol_id, record.to_admin_meta())
+        unit = self._unit()
+        if unit is not None:
+            self._write_through(unit, vol_id)
+        sl_vol_id = int(sl_vol['id'])
+        for serialized in self._loading:
+            serialized.add(sl_vol_id)
+        if self._imported is not None:
+            self._imported.add(sl_vol_id)
+
+    @traced('db.delete_all')
+    def delete_all(self, vol_id):
+        """
+        Delete the admin_metadata created for given volume.
+
+        :param vol_id: OpenStack Volume ID.
+
+        """
+        admin_meta = self.get_all(vol_id)
+        unit = self._unit()
+        if unit is not None:
+            unit.clear(vol_id)
+        else:
+            admin_context = context.get_admin_context()
+            for key in admin_meta.keys():
+                db.volume_admin_metadata_delete(admin_context, vol_id, key)
+        self._invalidate(vol_id)
+        if self._imported is not None and 'sl_id' in admin_meta:
+            self._imported.discard(int(admin_meta['sl_id']))
+
+    def delete_entry(self, volume, entry):
+        """
+        Remove snapshot's ID from the volume's admin metadata
+
+        :param volume: OpenStack Volume Object.
+        :param entry: OpenStack Volume ID.
+        """
+        unit = self._unit()
+        if unit is not None:
+            if entry in self.get_all(volume['id']):
+                unit.remove(volume['id'], entry)
+                self._invalidate(volume['id'])
+            return
+        admin_context = context.get_admin_context()
+        metadata = db.volume_admin_metadata_get(admin_context, volume['id'])
+        if entry in metadata:
+            del metadata[entry]
+            db.volume_admin_metadata_update(
+                admin_context, volume['id'], metadata, delete=True)
+            self._invalidate(volume['id'])
+
+    @traced('db.update_meta')
+    def update_meta(self, _id, admin_meta):
+        """
+        Update the admin metadata
+        """
+        unit = self._unit()
+        if unit is not None:
+            unit.update(_id, admin_meta)
+            self._invalidate(_id)
+            return
+        admin_context = context.get_admin_context()
+        db.volume_admin_metadata_update(
+            admin_context, _id, admin_meta, False)
+        self._invalidate(_id)
+
+    def get(self, vol_id, entry):
+        """
+        Finds the corresponding SoftLayer SnapshotID of
+        given OpenStack Snapshot.
+
+        :param vol_id: OpenStack Volume ID.
+
+        """
+        return self.get_all(vol_id).get(entry, None)
+
+    @traced('db.get_user_meta')
+    def get_user_meta(self, vol_id):
+        """
+        Retrive the user metadata of the volume.
+
+        :param vol_id: OpenStack Volume ID.
+        """
+        metadata = db.volume_metadata_get(self._context(), vol_id)
+        return metadata
+
+    def update_user_meta(self, vol_id, metadata, delete=False):
+        """
+        Update the user metadata of the given volume
+
+        :param vol_id: OpenStack volume ID.
+        :param metadata: dict containing metadata to be updated
+        :param delete: True if update should result in deletion of existing
+        """
+        db.volume_metadata_update(self._context(), vol_id,
+                                  metadata, delete)
+
+
+class SnapshotIndex(object):
+    """
+    Maps OpenStack snapshots to SoftLayer snapshots. The SoftLayer
+    snapshot ID is kept in the `provider_location` of the snapshot,
+    stored by Cinder along with the snapshot, so the admin metadata
+    of the volume does not grow with its snapshots.
+
+    Snapshots created before are found in the admin metadata of
+    their volume.
+    """
+
+    PREFIX = 'softlayer:snapshot:'
+
+    def __init__(self, meta_mgr):
+        """
+        :param meta_mgr: `MetadataManager` holding the older mappings.
+        """
+        self.meta_mgr = meta_mgr
+
+    def model_update(self, sl_snap):
+        """
+        Returns the snapshot model update recording the SoftLayer
+        snapshot.
+
+        :param sl_snap: SoftLayer snapshot object.
+        """
+        return {'provider_location': '%s%s' % (self.PREFIX, sl_snap['id'])}
+
+    def _location(self, snapshot):
+        location = snapshot.get('provider_location') or ''
+        if location.startswith(self.PREFIX):
+            return location[len(self.PREFIX):]
+        return None
+
+    def lookup(self, snapshot):
+        """
+        Finds the SoftLayer snapshot ID of the OpenStack snapshot.
+
+        :param snapshot: OpenStack Snapshot Object.
+        :returns: SoftLayer snapshot ID or None.
+        """
+        sl_snap_id = self._location(snapshot)
+        if sl_snap_id is not None:
+            return sl_snap_id
+        return self.meta_mgr.get(snapshot['volume']['id'], snapshot['id'])
+
+    def remove(self, snapshot):
+        """
+        Drops the mapping kept in the admin metadata of the volume,
+        the `provider_location` goes along with the snapshot.
+
+        :param snapshot: OpenStack Snapshot Object.
+        """
+        if self._location(snapshot) is None:
+            self.meta_mgr.delete_entry(snapshot['volume'], snapshot['id'])
@@ -0,0 +1,222 @@
+"""
+Tracing and latency metrics of the SoftLayer Driver
+"""
+import bisect
+import contextlib
+import functools
+import json
+import time
+import uuid
+
+from cinder.openstack.common.gettextutils import _
+from cinder.openstack.common import log as logging
+
+from eventlet import corolocal
+
+LOG = logging.getLogger(__name__)
+
+
+class Tracer(object):
+    """
+    Records the spans of the driver operations. A trace is started
+    by `trace` for an operation, the `span` blocks entered by the
+    same green thread until the operation completes are recorded as
+    its spans. The finished trace is passed to the sinks, each
+    driver passes its own.
+    """
+
+    def __init__(self):
+        self.sinks = []
+        self._local = corolocal.local()
+
+    def current(self):
+        """
+        Returns the context of the active span, used to continue the
+        trace in another green thread with `resume`.
+        """
+        return getattr(self._local, 'context', None)
+
+    @contextlib.contextmanager
+    def resume(self, context):
+        """
+        Continue the trace of the context in the current green thread.
+        """
+        previous = self.current()
+        self._local.context = context
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    @contextlib.contextmanager
+    def trace(self, operation, sinks=None, **tags):
+        """
+        Trace the operation, a span when a trace is already active.
+
+        :param sinks: callables the finished trace is passed to, the
+                      sinks of the tracer if not given.
+        """
+        if sinks is None:
+            sinks = self.sinks
+        if not sinks or self.current():
+            with self.span(operation, **tags):
+                yield
+            return
+        trace = {'trace_id': uuid.uuid4().hex,
+                 'operation': operation,
+                 'tags': tags,
+                 'start': time.time(),
+                 'error': None,
+                 'spans': []}
+        try:
+            with self.resume((trace, None)):
+                yield
+        except Exception as ex:
+            trace['error'] = repr(ex)
+            raise
+        finally:
+            trace['duration'] = time.time() - trace['start']
+            for sink in sinks:
+                try:
+                    sink(trace)
+                except Exception as ex:
+                    LOG.warn(_("Unable to export trace: %s" % ex))
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        """
+        Record the enclosed block as span of the active trace.
+        """
+        context = self.current()
+        if context is None:
+            yield
+            return
+        trace, parent = context
+        span = {'id': len(trace['spans']) + 1,
+                'parent': parent,
+                'name': name,
+                'tags': tags,
+                'error': None}
+        trace['spans'].append(span)
+        start = time.time()
+        span['start'] = start - trace['start']
+        try:
+            with self.resume((trace, span['id'])):
+                yield
+        except Exception as ex:
+            span['error'] = repr(ex)
+            raise
+        finally:
+            span['duration'] = time.time() - start
+
+
+# Tracer shared by the driver and the helpers
+TRACER = Tracer()
+
+
+def traced(name):
+    """
+    Decorator recording the calls of the method as `name` spans.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_trace(trace):
+    """
+    Trace sink writing the trace as a structured log line.
+    """
+    LOG.info(_("Trace: %s") % json.dumps(trace, sort_keys=True))
+
+
+class JsonLinesTraceSink(object):
+    """
+    Trace sink appending the traces to a file, one JSON document
+    per line, for a local collector to pick up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, trace):
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(json.dumps(trace, sort_keys=True) + '\n')
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies in seconds.
+    """
+
+    BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """
+        Add a latency sample.
+
+        :param value: latency in seconds.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        """
+        Returns the histogram as plain dict, buckets are keyed by
+        their upper bound.
+        """
+        bounds = [str(bound) for bound in self.buckets] + ['inf']
+        return {'count': self.count,
+                'sum': self.total,
+                'max': self.max,
+                'buckets': dict(zip(bounds, self.counts))}
+
+
+class PhaseTimer(object):
+    """
+    Records the time taken by the phases of an operation, the
+    phases are traced as spans as well.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    @contextlib.contextmanager
+    def time(self, phase, durations=None):
+        """
+        Context manager timing the enclosed block as `phase`,
+        failed attempts are timed as well.
+
+        :param durations: dict the seconds taken are added to under
+                          `phase`, to report a single operation.
+        """
+        start = time.time()
+        try:
+            with TRACER.span(phase):
+                yield
+        finally:
+            seconds = time.time() - start
+            self.histograms.setdefault(
+                phase, LatencyHistogram()).record(seconds)
+            if durations is not None:
+                durations[phase] = durations.get(phase, 0) + seconds
+
+    def stats(self):
+        """
+        Returns the recorded times per phase.
+        """
+        return dict((phase, histogram.to_dict())
+                    for phase, histogram in self.histograms.items())
@@ -1,3 +1,4 @@
+from mock import ANY
 from slos.cinder.driver.iscsi import SoftLayerISCSIDriver
 from slos.test import DriverTestBase
 
@@ -24,6 +25,7 @@ class TestSoftLayerOtherMethods(DriverTestBase):
             'free_capacity_gb':  'infinite',
             'reserved_percentage': 0,
             'QoS_support': False,
+            'api_stats': ANY,
         }
         self.assertEquals(result, stats)
         stats = self.driver.get_volume_stats(refresh=False)
@@ -0,0 +1,335 @@
+"""
+Stateful fake of the SoftLayer API and the Cinder database used by
+the benchmark. Every API call sleeps for a latency drawn from the
+configured distribution and fails with the configured error rate.
+
+Like the unit tests it runs against the modules in `slos/test/mocks`.
+"""
+import collections
+import copy
+import random
+import time
+
+import eventlet
+from SoftLayer.exceptions import SoftLayerAPIError, TransportError
+
+LOCATION = {'name': 'dal05', 'id': 1234}
+SIZES = (1, 2, 4, 8, 20, 40, 80, 100, 250, 500, 1000, 2000)
+SNAPSHOT_SIZES = (5, 10, 20, 40, 80, 100, 250, 500, 1000, 2000)
+
+
+class Latency(object):
+    """
+    Latency distribution in seconds.
+    """
+
+    def __init__(self, kind='lognormal', median=0.0, spread=0.5):
+        """
+        :param kind: constant, uniform or lognormal.
+        :param median: median latency.
+        :param spread: sigma of lognormal, +/- fraction of uniform.
+        """
+        if kind not in ('constant', 'uniform', 'lognormal'):
+            raise ValueError("Unknown latency distribution %s" % kind)
+        self.kind = kind
+        self.median = median
+        self.spread = spread
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parses `kind:median[:spread]`, e.g. `lognormal:0.2:0.5`.
+        """
+        parts = value.split(':')
+        return cls(parts[0], *[float(part) for part in parts[1:]])
+
+    def sample(self):
+        if self.median <= 0:
+            return 0
+        if self.kind == 'constant':
+            return self.median
+        if self.kind == 'uniform':
+            return random.uniform(self.median * (1 - self.spread),
+                                  self.median * (1 + self.spread))
+        return random.lognormvariate(0, self.spread) * self.median
+
+
+def _field(obj, path):
+    for name in path:
+        if not isinstance(obj, dict) or name not in obj:
+            return None
+        obj = obj[name]
+    return obj
+
+
+def _matches(value, operation):
+    if isinstance(operation, int):
+        return value is not None and int(value) == operation
+    op, _sep, arg = operation.partition(' ')
+    if value is None:
+        return False
+    if op in ('>=', '<=', '>', '<'):
+        value, arg = float(value), float(arg)
+        return {'>=': value >= arg, '<=': value <= arg,
+                '>': value > arg, '<': value < arg}[op]
+    value, arg = str(value).lower(), arg.lower()
+    if op == '^=':
+        return value.startswith(arg)
+    if op == '$=':
+        return value.endswith(arg)
+    if op == '*=':
+        return arg in value
+    return value == arg
+
+
+def matches(obj, object_filter, path=()):
+    """
+    Checks the object against the SoftLayer object filter.
+    """
+    if object_filter.get('operation') == 'in':
+        value = _field(obj, path)
+        options = dict((option['name'], option['value'])
+                       for option in object_filter['options'])
+        return value is not None and int(value) in options['data']
+    for key, value in object_filter.items():
+        if key == 'operation':
+            if not _matches(_field(obj, path), value):
+                return False
+        elif not matches(obj, value, path + (key,)):
+            return False
+    return True
+
+
+class FakeSoftLayer(object):
+    """
+    Stands in for `SoftLayer.Client`, keeping the volumes, billing
+    items and snapshots of one account.
+
+    Ordered volumes are provisioned `provision_delay` seconds after
+    the order is placed.
+    """
+
+    def __init__(self, latency=None, method_latency=None, error_rate=0.0,
+                 provision_delay=0.0):
+        """
+        :param latency: default `Latency` of the calls.
+        :param method_latency: `Latency` per `Service.method`.
+        :param error_rate: fraction of the calls failing with 503.
+        :param provision_delay: seconds until an order is provisioned.
+        """
+        self.latency = latency or Latency()
+        self.method_latency = method_latency or {}
+        self.error_rate = error_rate
+        self.provision_delay = provision_delay
+        self.volumes = {}
+        self.billing_items = {}
+        self.calls = collections.defaultdict(int)
+        self._next_id = 100
+        self.services = {
+            'Location_Datacenter': {
+                'getDatacenters': self.get_datacenters},
+            'Product_Package': {'getItems': self.get_items},
+            'Product_Order': {'verifyOrder': self.verify_order,
+                              'placeOrder': self.place_order},
+            'Billing_Order_Item': {'getBillingItem': self.get_billing_item},
+            'Billing_Item': {'cancelItem': self.cancel_item},
+            'Account': {
+                'getIscsiNetworkStorage': self.get_iscsi_network_storage},
+            'Network_Storage_Iscsi': {
+                'getObject': self.get_object,
+                'editObject': self.edit_object,
+                'createSnapshot': self.create_snapshot,
+                'restoreFromSnapshot': self.restore_from_snapshot,
+                'deleteObject': self.delete_object},
+        }
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getitem__(self, service):
+        return FakeService(self, service)
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def add_volume(self, capacity, notes=''):
+        """
+        Add a provisioned volume to the account.
+        """
+        sl_id = self._new_id()
+        self.volumes[sl_id] = {
+            'id': sl_id,
+            'capacityGb': capacity,
+            'snapshotCapacityGb': 0,
+            'username': 'SL%s' % sl_id,
+            'password': 'secret',
+            'notes': notes,
+            'activeTransactionCount': 0,
+            'serviceResourceBackendIpAddress': '10.0.0.2',
+            'billingItem': {'id': sl_id, 'location': {'id': LOCATION['id']}},
+            'snapshots': []}
+        return self.volumes[sl_id]
+
+    def call(self, service, method, *args, **kwargs):
+        key = '%s.%s' % (service, method)
+        self.calls[key] += 1
+        eventlet.sleep(self.method_latency.get(key, self.latency).sample())
+        if self.error_rate and random.random() < self.error_rate:
+            raise TransportError(503, 'Service Unavailable')
+        try:
+            handler = self.services[service][method]
+        except KeyError:
+            raise SoftLayerAPIError('%s is not implemented' % key)
+        return copy.deepcopy(handler(*args, **kwargs))
+
+    def _get(self, sl_id):
+        sl_vol = self.volumes.get(int(sl_id))
+        if sl_vol is None:
+            raise SoftLayerAPIError('Object %s not found' % sl_id)
+        return sl_vol
+
+    def get_datacenters(self, mask=None):
+        return [LOCATION]
+
+    def get_items(self, id=None, mask=None, filter=None):
+        code = filter['items']['categories']['categoryCode']['operation']
+        code = code.partition(' ')[2]
+        sizes = SNAPSHOT_SIZES if code == 'iscsi_snapshot_space' else SIZES
+        base = 20000 if code == 'iscsi_snapshot_space' else 10000
+        return [{'id': base + size, 'capacity': str(size),
+                 'prices': [{'id': base + size}]} for size in sizes]
+
+    def verify_order(self, order):
+        return order
+
+    def place_order(self, order):
+        if 'orderContainers' in order:
+            items = []
+            for container in order['orderContainers']:
+                items.extend(
+                    self.place_order(container)['placedOrder']['items'])
+            return {'placedOrder': {'items': items}}
+        price = order['prices'][0]['id']
+        if 'volumeId' in order:
+            sl_vol = self._get(order['volumeId'])
+            sl_vol['snapshotCapacityGb'] = price - 20000
+            return {'placedOrder': {'items': []}}
+        item_id = self._new_id()
+        self.billing_items[item_id] = {
+            'capacity': price - 10000,
+            'ready_at': time.time() + self.provision_delay,
+            'volume': None}
+        return {'placedOrder': {'items': [{'id': item_id}]}}
+
+    def get_billing_item(self, id=None):
+        item = self.billing_items[id]
+        if time.time() < item['ready_at']:
+            return {}
+        if item['volume'] is None:
+            item['volume'] = self.add_volume(item['capacity'])['id']
+        return {'id': id, 'notes': self.volumes[item['volume']]['username']}
+
+    def cancel_item(self, *args, **kwargs):
+        self.volumes.pop(int(kwargs['id']), None)
+        return True
+
+    def get_iscsi_network_storage(self, mask=None, filter=None):
+        object_filter = (filter or {}).get('iscsiNetworkStorage', {})
+        return [sl_vol for sl_vol in self.volumes.values()
+                if not sl_vol.get('snapshot') and
+                matches(sl_vol, object_filter)]
+
+    def get_object(self, id=None, mask=None):
+        return self._get(id)
+
+    def edit_object(self, template, id=None):
+        self._get(id).update(template)
+        return True
+
+    def create_snapshot(self, notes, id=None):
+        sl_vol = self._get(id)
+        space = int(sl_vol['snapshotCapacityGb']) // int(sl_vol['capacityGb'])
+        if len(sl_vol['snapshots']) >= space:
+            raise SoftLayerAPIError('Insufficient snapshot reserve '
+                                    'space to create a snapshot for the '
+                                    'volume')
+        snapshot = self.add_volume(sl_vol['capacityGb'])
+        snapshot['snapshot'] = True
+        sl_vol['snapshots'].append(snapshot['id'])
+        return snapshot
+
+    def restore_from_snapshot(self, snapshot_id, id=None):
+        self._get(snapshot_id)
+        self._get(id)
+        return True
+
+    def delete_object(self, id=None):
+        snapshot = self.volumes.pop(int(id), None)
+        for sl_vol in self.volumes.values():
+            if int(id) in sl_vol['snapshots']:
+                sl_vol['snapshots'].remove(int(id))
+        return snapshot is not None
+
+
+class FakeService(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getattr__(self, method):
+        def call_handler(*args, **kwargs):
+            return self.client.call(self.name, method, *args, **kwargs)
+        return call_handler
+
+
+class FakeDB(object):
+    """
+    In-memory volume admin metadata, replaces the functions of
+    `cinder.db` used by the driver.
+    """
+
+    FUNCTIONS = ('volume_get_all', 'volume_admin_metadata_get',
+                 'volume_admin_metadata_update',
+                 'volume_admin_metadata_delete', 'volume_metadata_get',
+                 'volume_metadata_update')
+
+    def __init__(self):
+        self.admin_meta = {}
+
+    def install(self, db):
+        """
+        Replace the functions of the db module, returns the originals.
+        """
+        originals = dict((name, getattr(db, name)) for name in self.FUNCTIONS)
+        for name in self.FUNCTIONS:
+            setattr(db, name, getattr(self, name))
+        return originals
+
+    def volume_get_all(self, context, **kwargs):
+        return [{'id': vol_id,
+                 'volume_admin_metadata': [{'key': key, 'value': value}
+                                           for key, value in meta.items()]}
+                for vol_id, meta in self.admin_meta.items()]
+
+    def volume_admin_metadata_get(self, context, vol_id):
+        return dict(self.admin_meta.get(vol_id, {}))
+
+    def volume_admin_metadata_update(self, context, vol_id, meta, delete):
+        if delete:
+            self.admin_meta[vol_id] = dict(meta)
+        else:
+            self.admin_meta.setdefault(vol_id, {}).update(meta)
+
+    def volume_admin_metadata_delete(self, context, vol_id, key):
+        meta = self.admin_meta.get(vol_id, {})
+        meta.pop(key, None)
+        if not meta:
+            self.admin_meta.pop(vol_id, None)
+
+    def volume_metadata_get(self, context, vol_id):
+        return {}
+
+    def volume_metadata_update(self, context, vol_id, meta, delete):
+        pass
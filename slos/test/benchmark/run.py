@@ -0,0 +1,230 @@
+"""
+Offline benchmark of the SoftLayer drivers.
+
+Runs concurrent `create_volume`, `create_snapshot` and `delete_volume`
+calls through the monthly and the pool driver against the fake
+SoftLayer service and reports throughput and latency percentiles.
+
+    python -m slos.test.benchmark.run --volumes 50 --concurrency 10 \\
+        --latency lognormal:0.2:0.5 \\
+        --method-latency Product_Order.placeOrder=constant:1.5
+"""
+import argparse
+import json
+import math
+import sys
+import time
+
+from eventlet import greenpool
+from mock import MagicMock
+
+import slos.test  # noqa, puts the mocks on the path
+import cinder.db
+import cinder.utils
+import SoftLayer
+
+from slos.cinder.driver.iscsi import SoftLayerISCSIDriver, \
+    SoftLayerISCSIPoolDriver
+from slos.test import config
+from slos.test.benchmark.fake_softlayer import FakeDB, FakeSoftLayer, Latency
+
+DRIVERS = {'monthly': SoftLayerISCSIDriver,
+           'pool': SoftLayerISCSIPoolDriver}
+DISCOVERY = ('10.0.0.2:3260,1 iqn.2001-05.com.equallogic:'
+             '0-8a0906-35b45ea0b-aa50043e7f9533bc-bench', '')
+
+
+def percentile(samples, pct):
+    """
+    Nearest rank percentile of the samples.
+    """
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(samples)))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+class Benchmark(object):
+    """
+    Runs the scenarios through one driver against its own fake
+    SoftLayer account and Cinder database.
+    """
+
+    def __init__(self, driver, volumes=20, concurrency=8, size=20,
+                 client=None, options=None):
+        """
+        :param driver: monthly or pool.
+        :param volumes: number of volumes used by each scenario.
+        :param concurrency: number of concurrent driver calls.
+        :param size: size of the volumes in GB.
+        :param client: `FakeSoftLayer` to run against.
+        :param options: driver configuration overrides.
+        """
+        self.driver_name = driver
+        self.volumes = volumes
+        self.concurrency = concurrency
+        self.size = size
+        self.client = client or FakeSoftLayer()
+        self.options = options or {}
+        self.db = FakeDB()
+        self._saved = None
+
+    def setup(self):
+        self._saved = (SoftLayer.Client, cinder.utils.execute,
+                       cinder.utils.brick_get_connector,
+                       self.db.install(cinder.db))
+        SoftLayer.Client = self.client
+        cinder.utils.execute = MagicMock(return_value=DISCOVERY)
+        cinder.utils.brick_get_connector = MagicMock()
+        if self.driver_name == 'pool':
+            for _i in range(self.volumes):
+                self.client.add_volume(self.size)
+        conf = config.Config()
+        conf.reset_all()
+        conf.sl_datacenter = 'dal05'
+        conf.sl_vol_active_retry = 1000
+        conf.sl_vol_active_wait = 0.05
+        conf.sl_snap_space_active_retry = 1000
+        conf.sl_snap_space_active_wait = 0.05
+        conf.sl_vol_order_ceil = True
+        conf.sl_order_snap_space = True
+        conf.sl_pool_volume_clear = 'none'
+        conf.sl_use_name = 'none'
+        for name, value in self.options.items():
+            setattr(conf, name, value)
+        self.driver = DRIVERS[self.driver_name](configuration=conf,
+                                                db=object())
+        self.driver.do_setup(None)
+        self.driver.check_for_setup_error()
+
+    def teardown(self):
+        SoftLayer.Client, cinder.utils.execute, \
+            cinder.utils.brick_get_connector, originals = self._saved
+        for name, func in originals.items():
+            setattr(cinder.db, name, func)
+        config.Config().reset_all()
+
+    def _measure(self, scenario, func, items):
+        """
+        Calls `func` for every item, `concurrency` at a time.
+        """
+        latencies = []
+        errors = []
+
+        def timed(item):
+            start = time.time()
+            try:
+                func(item)
+            except Exception as ex:
+                errors.append(ex)
+                return
+            latencies.append(time.time() - start)
+
+        calls = sum(self.client.calls.values())
+        start = time.time()
+        pool = greenpool.GreenPool(self.concurrency)
+        for item in items:
+            pool.spawn_n(timed, item)
+        pool.waitall()
+        seconds = time.time() - start
+        return {'driver': self.driver_name,
+                'scenario': scenario,
+                'count': len(latencies),
+                'errors': len(errors),
+                'seconds': seconds,
+                'throughput': len(latencies) / seconds if seconds else 0.0,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'api_calls': sum(self.client.calls.values()) - calls}
+
+    def run(self):
+        """
+        Runs the scenarios, returns their results.
+        """
+        volumes = [{'id': 'bench-%s-%04d' % (self.driver_name, index),
+                    'display_name': 'bench-%04d' % index,
+                    'size': self.size}
+                   for index in range(self.volumes)]
+        snapshots = [{'id': 'snap-%s' % volume['id'], 'volume': volume}
+                     for volume in volumes]
+        self.setup()
+        try:
+            return [
+                self._measure('create_volume', self.driver.create_volume,
+                              volumes),
+                self._measure('create_snapshot', self.driver.create_snapshot,
+                              snapshots),
+                self._measure('delete_volume', self.driver.delete_volume,
+                              volumes)]
+        finally:
+            self.teardown()
+
+
+def report(results, out=sys.stdout):
+    out.write('%-8s %-16s %6s %6s %9s %8s %8s %9s\n' % (
+        'driver', 'scenario', 'ok', 'errors', 'ops/s', 'p50 s', 'p99 s',
+        'api calls'))
+    for result in results:
+        out.write('%-8s %-16s %6d %6d %9.2f %8.3f %8.3f %9d\n' % (
+            result['driver'], result['scenario'], result['count'],
+            result['errors'], result['throughput'], result['p50'],
+            result['p99'], result['api_calls']))
+
+
+def _method_latency(value):
+    method, _sep, latency = value.partition('=')
+    return method, Latency.parse(latency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the SoftLayer drivers against a fake '
+                    'SoftLayer service.')
+    parser.add_argument('--driver', action='append', choices=sorted(DRIVERS),
+                        help='driver to benchmark, default all')
+    parser.add_argument('--volumes', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--size', type=int, default=20,
+                        help='volume size in GB')
+    parser.add_argument('--latency', type=Latency.parse,
+                        default=Latency('lognormal', 0.05, 0.5),
+                        help='kind:median[:spread] of every API call')
+    parser.add_argument('--method-latency', type=_method_latency,
+                        action='append', default=[],
+                        help='Service.method=kind:median[:spread]')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of API calls failing with 503')
+    parser.add_argument('--provision-delay', type=float, default=0.0,
+                        help='seconds until an ordered volume is active')
+    parser.add_argument('--option', action='append', default=[],
+                        help='driver option as name=value (JSON value)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    options = {}
+    for option in args.option:
+        name, _sep, value = option.partition('=')
+        try:
+            options[name] = json.loads(value)
+        except ValueError:
+            options[name] = value
+    results = []
+    for driver in args.driver or sorted(DRIVERS):
+        client = FakeSoftLayer(latency=args.latency,
+                               method_latency=dict(args.method_latency),
+                               error_rate=args.error_rate,
+                               provision_delay=args.provision_delay)
+        results.extend(Benchmark(driver, args.volumes, args.concurrency,
+                                 args.size, client, options).run())
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,11 @@
 
 class SoftLayerAPIError(Exception):
     pass
+
+
+class TransportError(SoftLayerAPIError):
+
+    def __init__(self, faultCode, faultString, *args):
+        SoftLayerAPIError.__init__(self, faultString, *args)
+        self.faultCode = faultCode
+        self.faultString = faultString
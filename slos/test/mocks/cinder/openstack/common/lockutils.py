@@ -1,7 +1,13 @@
 #!/usr/bin/env python
+import contextlib
 import functools
 
 
+@contextlib.contextmanager
+def lock(name, lock_file_prefix=None, external=False, lock_path=None):
+    yield
+
+
 def synchronized(name, lock_file_prefix, external=False, lock_path=None):
     def wrap(f):
         @functools.wraps(f)
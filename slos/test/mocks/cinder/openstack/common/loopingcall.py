@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+
+
+class FixedIntervalLoopingCall(object):
+    def __init__(self, f=None, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = None
+        self.running = False
+
+    def start(self, interval, initial_delay=None):
+        self.interval = interval
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def wait(self):
+        pass
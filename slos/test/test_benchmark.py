@@ -0,0 +1,56 @@
+import unittest
+
+import cinder.db
+import SoftLayer
+
+from slos.test.benchmark.fake_softlayer import FakeSoftLayer, Latency, \
+    matches
+from slos.test.benchmark.run import Benchmark, percentile
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        samples = [float(value) for value in range(1, 101)]
+        self.assertEquals(50.0, percentile(samples, 50))
+        self.assertEquals(99.0, percentile(samples, 99))
+        self.assertEquals(0.0, percentile([], 99))
+
+    def test_filter(self):
+        sl_vol = {'username': 'SL01', 'capacityGb': 20,
+                  'billingItem': {'location': {'id': 1234}}}
+        self.assertTrue(matches(sl_vol, {
+            'capacityGb': {'operation': 20},
+            'billingItem': {'location': {'id': {'operation': 1234}}}}))
+        self.assertTrue(matches(sl_vol, {
+            'capacityGb': {'operation': '>= 10'},
+            'username': {'operation': '_= sl01'}}))
+        self.assertFalse(matches(sl_vol, {'notes': {'operation': '_= x'}}))
+
+    def test_latency(self):
+        self.assertEquals(0, Latency.parse('lognormal:0').sample())
+        self.assertEquals(0.5, Latency.parse('constant:0.5').sample())
+        self.assertRaises(ValueError, Latency.parse, 'normal:1')
+
+    def _run(self, driver):
+        client = SoftLayer.Client
+        admin_meta_get = cinder.db.volume_admin_metadata_get
+        results = Benchmark(driver, volumes=4, concurrency=2,
+                            client=FakeSoftLayer()).run()
+        self.assertEquals(
+            ['create_volume', 'create_snapshot', 'delete_volume'],
+            [result['scenario'] for result in results])
+        for result in results:
+            self.assertEquals(4, result['count'])
+            self.assertEquals(0, result['errors'])
+        self.assertTrue(SoftLayer.Client is client)
+        self.assertTrue(cinder.db.volume_admin_metadata_get is admin_meta_get)
+        return results
+
+    def test_monthly(self):
+        results = self._run('monthly')
+        self.assertTrue(results[0]['api_calls'] > 0)
+
+    def test_pool(self):
+        results = self._run('pool')
+        self.assertEquals(0, results[2]['api_calls'])
@@ -1,8 +1,17 @@
 #!/usr/bin/env python
+import cinder.context
 import cinder.db
 import copy
+import eventlet
+import json
+import mmap
+import os
+import sys
+import types
+import stat
+import tempfile
 import SoftLayer
-from SoftLayer.exceptions import SoftLayerAPIError
+from SoftLayer.exceptions import SoftLayerAPIError, TransportError
 from cinder.exception import VolumeBackendAPIException
 from mock import patch, ANY, call, MagicMock
 from cinder import exception
@@ -11,6 +20,14 @@ from cinder.volume import utils as vol_utils
 import cinder.utils as c_utils
 from cinder.context import get_admin_context
 from cinder.openstack.common import processutils as proc_utils
+from slos.cinder.driver.api import object_mask
+from slos.cinder.driver.cache import LRUCache, TTLCache
+from slos.cinder.driver.client import ApiClient, BackoffWaiter
+from slos.cinder.driver.client import _SessionRequests, use_keepalive_transport
+from slos.cinder.driver.copier import BlockCopier
+from slos.cinder.driver.metadata import MetadataManager, VolumeRecord
+from slos.cinder.driver.tracing import TRACER, Tracer
+from slos.cinder.driver.iscsi import SoftLayerISCSIDriver
 from slos.test import DriverTestBase
 
 
@@ -57,10 +74,51 @@ class SoftLayerDriverTestCase(DriverTestBase):
         SoftLayer.Client['Product_Package'].getItems.assert_called_once_with(
             id=0, filter={'items':
                           {'categories':
-                              {'categoryCode': {'operation': '_= iscsi'}},
-                              'capacity': {'operation': '>= 1'}}},
+                              {'categoryCode': {'operation': '_= iscsi'}}}},
             mask=ANY)
 
+    def test_catalog_cached_after_setup(self):
+        self.config.sl_catalog_cache_ttl = 3600
+        self.driver.do_setup(None)
+        self.driver.check_for_setup_error()
+        get_items = SoftLayer.Client['Product_Package'].getItems
+        self.assertEquals(2, get_items.call_count)
+        self.driver.create_volume(self.volume)
+        self.driver.create_volume(self.volume)
+        self.assertEquals(2, get_items.call_count)
+        self.driver.vol_mgr.catalog.invalidate('iscsi')
+        self.driver.create_volume(self.volume)
+        self.assertEquals(3, get_items.call_count)
+        self.driver.vol_mgr.catalog.refresh()
+        self.assertEquals(3, get_items.call_count)
+        self.driver.vol_mgr.catalog.invalidate()
+        self.driver.create_volume(self.volume)
+        self.assertEquals(4, get_items.call_count)
+
+    def test_catalog_ceil_lookup(self):
+        SoftLayer.Client['Product_Package'].getItems.\
+            return_value = [{'id': 4, 'prices': [{'id': 4}], 'capacity': '4'},
+                            {'id': 1, 'prices': [{'id': 1}], 'capacity': '1'},
+                            {'id': 2, 'prices': [], 'capacity': '2'},
+                            {'id': 3, 'prices': [{'id': 3}], 'capacity': '3'}]
+        catalog = self.driver.vol_mgr.catalog
+        self.assertEquals(3, catalog.find(2, 'iscsi', True))
+        self.assertEquals(1, catalog.find(1, 'iscsi', True))
+        self.assertIsNone(catalog.find(2, 'iscsi', False))
+        self.assertIsNone(catalog.find(5, 'iscsi', True))
+
+    def test_catalog_refresh_keeps_stale_on_error(self):
+        self.config.sl_catalog_cache_ttl = 3600
+        self.driver.do_setup(None)
+        self.driver.check_for_setup_error()
+        catalog = self.driver.vol_mgr.catalog
+        catalog.ttl = -1
+        SoftLayer.Client['Product_Package'].getItems.side_effect = \
+            SoftLayerAPIError("")
+        self.driver.get_volume_stats(refresh=True)
+        catalog.ttl = 3600
+        self.assertEquals(2, catalog.find(1, 'iscsi', False))
+
     def test_volume_metadata_updated(self):
         self.config.sl_use_name = 'metadata'
         update = self.driver.create_volume(self.volume)
@@ -79,8 +137,7 @@ class SoftLayerDriverTestCase(DriverTestBase):
                 id=0, filter={'items':
                               {'categories':
                                {'categoryCode':
-                                {'operation': '_= iscsi'}},
-                                  'capacity': {'operation': volume['size']}}},
+                                {'operation': '_= iscsi'}}}},
                 mask=ANY)
         SoftLayer.Client['Product_Order'].verifyOrder.assert_called_once_with(
             self.expected_order)
@@ -114,6 +171,238 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.assertEquals({'size': 1, 'source_volid': 'source_vol_id'}, update)
         self.assertEquals(2, detach_vol.call_count)
         self.assertMetaUpdated(dest_vol['id'])
+        self.assertEquals(
+            set(['attach', 'attach_dest', 'attach_source', 'copy', 'detach']),
+            set(self.driver.clone_timer.stats()))
+
+    @patch('slos.cinder.driver.iscsi.LOG')
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_logs_own_phases(self, detach_vol, log):
+        source_vol, dest_vol = self.setup_two_vols()
+        self.setup_attach()
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        timings, = [args[0] for args, kwargs in log.debug.call_args_list
+                    if args[0].startswith('Clone phase timings')]
+        self.assertEquals(
+            ['attach', 'attach_dest', 'attach_source', 'copy', 'detach'],
+            [timing.split()[0] for timing in
+             timings.split(': ', 1)[1].split(', ')])
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    @patch.object(BlockCopier, 'copy')
+    def test_create_cloned_volume_native_copy(self, copy_data, detach_vol):
+        self.config.sl_copy_engine = 'native'
+        self.config.sl_copy_workers = 8
+        self.driver.do_setup(None)
+        copy_data.return_value = {'written': 0, 'skipped': 0, 'seconds': 0}
+        source_vol, dest_vol = self.setup_two_vols()
+        self.setup_attach()
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        copy_data.assert_called_once_with('valid_host', 'valid_host',
+                                          1024, None)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+        self.assertEquals(8, self.driver.copier.workers)
+
+    def setup_snapshot_clone(self, size=2):
+        source_vol, dest_vol = self.setup_two_vols()
+        for vol in (source_vol, dest_vol):
+            self.volume_map[vol['id']]['capacityGb'] = str(size)
+        self.config.sl_clone_strategy = 'snapshot'
+        getObject = SoftLayer.Client['Network_Storage_Iscsi'].getObject
+        sl_vol = copy.deepcopy(getObject.return_value)
+        sl_vol.update(capacityGb=size)
+        getObject.return_value = sl_vol
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            [sl_vol]
+        self.transactions = [1, 0]
+
+        def get_object(id=None, mask=None):
+            if mask == 'mask[activeTransactionCount]':
+                return {'activeTransactionCount': self.transactions.pop(0)}
+            return sl_vol
+        getObject.side_effect = get_object
+        self.config.sl_vol_active_wait = 0.001
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            return_value = {'username': 'test_snapshot', 'id': 9}
+        self.setup_attach()
+        return source_vol, dest_vol
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_create_cloned_volume_on_storage(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        update = self.driver.create_cloned_volume(dest_vol, source_vol)
+        self.assertEquals({'size': 2, 'source_volid': 'source_vol_id'}, update)
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi']
+        iscsi.createSnapshot.assert_called_once_with('', id=2)
+        iscsi.restoreFromSnapshot.assert_called_once_with(9, id=2)
+        iscsi.deleteObject.assert_called_once_with(id=9)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+        self.assertEquals(0, detach_vol.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_waits_for_restore_to_start(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        # the restore is not registered yet at the first poll
+        self.transactions = [0, 1, 1, 0]
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        self.assertEquals([], self.transactions)
+        SoftLayer.Client['Network_Storage_Iscsi'].deleteObject.\
+            assert_called_once_with(id=9)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_restore_never_started_fails(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        self.transactions = [0] * 100
+        self.config.sl_vol_active_retry = 1
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.create_cloned_volume,
+                          dest_vol, source_vol)
+        SoftLayer.Client['Network_Storage_Iscsi'].deleteObject.\
+            assert_any_call(id=9)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_does_not_order_snapshot_space(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        self.config.sl_order_snap_space = True
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            side_effect = SoftLayerAPIError("Insufficient snapshot reserve "
+                                            "space to create a snapshot "
+                                            "for the volume")
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        # only the new volume is ordered
+        SoftLayer.Client['Product_Order'].placeOrder.assert_called_once_with(
+            self.expected_order)
+        self.assertEquals(1, vol_utils.copy_volume.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_create_cloned_1gb_volume_copies(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone(size=1)
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi']
+        self.assertEquals(0, iscsi.createSnapshot.call_count)
+        self.assertEquals(1, vol_utils.copy_volume.call_count)
+        self.assertEquals(2, detach_vol.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_of_other_size_copies(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        self.volume_map[source_vol['id']]['capacityGb'] = '4'
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi']
+        self.assertEquals(0, iscsi.createSnapshot.call_count)
+        self.assertEquals(1, vol_utils.copy_volume.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_snapshot_delete_failure_ignored(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi']
+        iscsi.deleteObject.side_effect = SoftLayerAPIError('')
+        update = self.driver.create_cloned_volume(dest_vol, source_vol)
+        self.assertEquals({'size': 2, 'source_volid': 'source_vol_id'}, update)
+        iscsi.deleteObject.assert_called_once_with(id=9)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_restore_failure_copies(self, detach_vol):
+        source_vol, dest_vol = self.setup_snapshot_clone()
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi']
+        iscsi.restoreFromSnapshot.side_effect = SoftLayerAPIError('')
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        iscsi.deleteObject.assert_called_once_with(id=9)
+        self.assertEquals(1, vol_utils.copy_volume.call_count)
+        self.assertEquals(2, detach_vol.call_count)
+
+    def setup_trace_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'traces.json')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        self.config.sl_trace_file = path
+        self.driver.do_setup(None)
+        return path
+
+    def read_traces(self, path):
+        with open(path) as trace_file:
+            return [json.loads(line) for line in trace_file]
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_clone_traced(self, detach_vol):
+        path = self.setup_trace_file()
+        source_vol, dest_vol = self.setup_two_vols()
+        self.setup_attach()
+        self.driver.create_cloned_volume(dest_vol, source_vol)
+        trace, = self.read_traces(path)
+        self.assertEquals('create_cloned_volume', trace['operation'])
+        self.assertEquals({'id': dest_vol['id']}, trace['tags'])
+        spans = dict((span['name'], span) for span in trace['spans'])
+        for name in ('create_volume', 'order', 'wait', 'catalog', 'api',
+                     'db.serialize', 'attach_dest', 'attach_source',
+                     'login', 'discovery', 'copy', 'detach'):
+            self.assertIn(name, spans)
+        self.assertEquals(spans['create_volume']['id'],
+                          spans['order']['parent'])
+        # attached in other green threads
+        self.assertEquals(spans['attach']['id'],
+                          spans['attach_source']['parent'])
+
+    def test_trace_tagged_with_model_id(self):
+        path = self.setup_trace_file()
+
+        class VolumeModel(object):
+            def __init__(self, values):
+                self.values = values
+
+            def __getitem__(self, key):
+                return self.values[key]
+        self.driver.create_volume(VolumeModel(self.volume))
+        self.driver.get_volume_stats(refresh=True)
+        create, stats = self.read_traces(path)
+        self.assertEquals({'id': self.volume['id']}, create['tags'])
+        self.assertEquals({}, stats['tags'])
+
+    def test_trace_sinks_per_driver(self):
+        path = self.setup_trace_file()
+        self.config.sl_trace_file = None
+        other = SoftLayerISCSIDriver(configuration=self.config, db=self.db)
+        other.do_setup(None)
+        other.create_volume(self.volume)
+        self.driver.create_volume(self.volume)
+        trace, = self.read_traces(path)
+        self.assertEquals('create_volume', trace['operation'])
+        self.assertEquals([], TRACER.sinks)
+
+    def test_trace_logged(self):
+        self.config.sl_trace_log = True
+        self.driver.do_setup(None)
+        with patch('slos.cinder.driver.tracing.LOG') as log:
+            self.driver.create_volume(self.volume)
+        self.assertEquals(1, log.info.call_count)
+        self.assertIn('"operation": "create_volume"',
+                      log.info.call_args[0][0])
+
+    def test_tracer_sinks(self):
+        tracer = Tracer()
+        traces = []
+        failing = MagicMock(side_effect=IOError("disk full"))
+        tracer.sinks.extend([failing, traces.append])
+        with tracer.trace('operation', id=1):
+            with tracer.span('inner'):
+                pass
+        trace, = traces
+        self.assertEquals({'id': 1}, trace['tags'])
+        self.assertEquals(['inner'], [span['name'] for span in trace['spans']])
+        failing.assert_called_once_with(trace)
+
+    def test_failed_operation_traced(self):
+        path = self.setup_trace_file()
+        SoftLayer.Client['Product_Order'].placeOrder.side_effect = \
+            SoftLayerAPIError('')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        self.driver.get_volume_stats(refresh=True)
+        create, stats = self.read_traces(path)
+        self.assertIn('VolumeBackendAPIException', create['error'])
+        self.assertEquals('get_volume_stats', stats['operation'])
+        self.assertIsNone(stats['error'])
 
     def setup_two_vols(self):
         db_utils.volume_admin_metadata_get.side_effect = \
@@ -166,9 +455,7 @@ class SoftLayerDriverTestCase(DriverTestBase):
         SoftLayer.Client['Billing_Item'].cancelItem.\
             called_once_with(True, False, ANY, id=2)
 
-        db_utils.volume_admin_metadata_delete.assert_has_calls(
-            [call(ANY, dest_vol['id'], 'sl_id')])
-        self.assertMetaUpdated(dest_vol['id'])
+        self.assertMetadataDeleted(dest_vol['id'])
 
     def test_create_cloned_volume_old_vol_attach_fail(self):
         db_utils.volume_admin_metadata_get.side_effect = \
@@ -189,11 +476,10 @@ class SoftLayerDriverTestCase(DriverTestBase):
         SoftLayer.Client['Billing_Item'].cancelItem.\
             called_once_with(True, False, ANY, id=2)
 
-        db_utils.volume_admin_metadata_delete.assert_has_calls(
-            [call(ANY, dest_vol['id'], 'sl_id')])
-        self.assertMetaUpdated(dest_vol['id'])
+        self.assertMetadataDeleted(dest_vol['id'])
 
-    def test_create_cloned_volume_new_vol_attach_fail(self):
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_create_cloned_volume_new_vol_attach_fail(self, detach_vol):
         source_vol, dest_vol = self.setup_two_vols()
         self.setup_initialize()
         connector = MagicMock()
@@ -203,15 +489,17 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.assertRaises(exception.InvalidResults,
                           self.driver.create_cloned_volume,
                           dest_vol, source_vol)
-        self.assertEquals(4, c_utils.execute.call_count,
-                          "To attach volume properly, "
-                          "discovery and attach should follow each other")
+        self.assertEquals(7, c_utils.execute.call_count,
+                          "Both volumes are discovered and attached "
+                          "in parallel")
+        # the source attached in parallel is detached
+        self.assert_single_detach(detach_vol)
+        self.assertEquals(
+            1, self.driver.clone_timer.stats()['attach_source']['count'])
         SoftLayer.Client['Billing_Item'].cancelItem.\
             called_once_with(True, False, ANY, id=2)
 
-        db_utils.volume_admin_metadata_delete.assert_has_calls(
-            [call(ANY, dest_vol['id'], 'sl_id')])
-        self.assertMetaUpdated(dest_vol['id'])
+        self.assertMetadataDeleted(dest_vol['id'])
 
     def assertMetaUpdated(self, vol_id):
         self.assertEquals(1, db_utils.volume_admin_metadata_update.call_count)
@@ -322,9 +610,7 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.driver.delete_volume(self.volume)
         SoftLayer.Client['Billing_Item'].cancelItem.\
             called_once_with(True, False, ANY, id=2)
-        vol_id = self.volume['id']
-        db_utils.volume_admin_metadata_delete.assert_has_calls(
-            [call(self.fake_context, vol_id, 'sl_id')])
+        self.assertMetadataDeleted(self.volume['id'])
 
     def test_non_existent_delete_succeeds(self):
         SoftLayer.Client['Network_Storage_Iscsi'].getObject.\
@@ -334,25 +620,22 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.assertMetadataDeleted(vol_id)
 
     def assertMetadataDeleted(self, vol_id):
-        db_utils.volume_admin_metadata_delete.assert_has_calls(
-            [call(self.fake_context, vol_id, 'sl_id'),
-             call(self.fake_context, vol_id, 'billing_item_id'),
-             call(self.fake_context, vol_id, 'portal'),
-             call(self.fake_context, vol_id, 'capacityGb'),
-             call(self.fake_context, vol_id, 'password'),
-             call(self.fake_context, vol_id, 'username')],
-            any_order=True)
+        # all the keys are dropped with a single update, after the
+        # volume created by the operation is stored
+        update = db_utils.volume_admin_metadata_update
+        update.assert_called_with(self.fake_context, vol_id, {}, True)
+        self.assertEquals(1, update.call_args_list.count(
+            call(self.fake_context, vol_id, {}, True)))
+        self.assertEquals(0, db_utils.volume_admin_metadata_delete.call_count)
 
     def test_create_snapshot(self):
         self.setup_existing(size=2)
         snapshot = {'id': 'os-snap-id', 'volume': self.volume}
         f = SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot
         update = self.driver.create_snapshot(snapshot)
-        db_utils.volume_admin_metadata_update.\
-            assert_called_once_with(ANY,
-                                    self.volume['id'],
-                                    {'os-snap-id': 'sl-snap-id'}, False)
-        self.assertIsNone(update)
+        self.assertEquals(
+            {'provider_location': 'softlayer:snapshot:sl-snap-id'}, update)
+        self.assertEquals(0, db_utils.volume_admin_metadata_update.call_count)
         f = SoftLayer.Client['Product_Order'].placeOrder
         f.called_once_with({
             'complexType':
@@ -363,7 +646,8 @@ class SoftLayerDriverTestCase(DriverTestBase):
             'prices': [{'id': 2}],
             'quantity': 1,
             'volumeId': 2})
-        self.assertIsNone(update)
+        self.assertEquals(
+            {'provider_location': 'softlayer:snapshot:sl-snap-id'}, update)
 
     def test_1_gb_snapshot_create_fails(self):
         self.setup_existing()
@@ -476,10 +760,7 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.config.sl_snap_space_active_retry = 4
         self.config.sl_snap_space_active_wait = 0
         update = self.driver.create_snapshot(snapshot)
-        db_utils.volume_admin_metadata_update.\
-            assert_called_once_with(ANY,
-                                    self.volume['id'],
-                                    {'os-snap-id': 'sl-snap-id'}, False)
+        self.assertEquals(0, db_utils.volume_admin_metadata_update.call_count)
         f = SoftLayer.Client['Product_Order'].placeOrder
         f.called_once_with({
             'complexType':
@@ -490,7 +771,166 @@ class SoftLayerDriverTestCase(DriverTestBase):
             'prices': [{'id': 2}],
             'quantity': 1,
             'volumeId': 2})
-        self.assertIsNone(update)
+        self.assertEquals(
+            {'provider_location': 'softlayer:snapshot:sl-snap-id'}, update)
+
+    def sl_vols(self, *sizes):
+        iscsi = SoftLayer.Client['Network_Storage_Iscsi'].getObject.\
+            return_value
+        sl_vols = []
+        for sl_id, size in enumerate(sizes, 2):
+            sl_vol = copy.deepcopy(iscsi)
+            sl_vol.update({'id': sl_id, 'capacityGb': size,
+                           'snapshotCapacityGb': 0})
+            sl_vols.append(sl_vol)
+        return sl_vols
+
+    def test_create_snapshots(self):
+        f = SoftLayer.Client['Account'].getIscsiNetworkStorage
+        f.return_value = self.sl_vols(2, 1, 4)
+        create = SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot
+        create.side_effect = lambda notes, id: {'id': 'snap-%s' % id}
+        results = self.driver.vol_mgr.create_snapshots([2, 3, 4, 9])
+        # the volumes are read with a single query
+        f.assert_called_once_with(
+            mask=self.driver.vol_mgr.SNAPSHOT_MASK,
+            filter={'iscsiNetworkStorage': {'id': {
+                'operation': 'in',
+                'options': [{'name': 'data', 'value': [2, 3, 4, 9]}]}}})
+        self.assertEquals({'snapshot': {'id': 'snap-2'}, 'error': None},
+                          results[2])
+        self.assertEquals({'snapshot': {'id': 'snap-4'}, 'error': None},
+                          results[4])
+        self.assertEquals("1 GB Snapshot is not supported",
+                          results[3]['error'])
+        self.assertEquals(None, results[9]['snapshot'])
+        self.assertEquals(2, create.call_count)
+        self.assertEquals(
+            0, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_create_snapshots_orders_space_once(self):
+        self.config.sl_order_snap_space = True
+        self.config.sl_snap_space_active_retry = 4
+        self.config.sl_snap_space_active_wait = 0
+        sl_vols = self.sl_vols(2, 4)
+        with_space = copy.deepcopy(sl_vols)
+        for sl_vol in with_space:
+            sl_vol['snapshotCapacityGb'] = sl_vol['capacityGb']
+        f = SoftLayer.Client['Account'].getIscsiNetworkStorage
+        f.side_effect = [sl_vols, with_space]
+        spaces = set()
+
+        def create(notes, id):
+            if id not in spaces:
+                spaces.add(id)
+                raise SoftLayerAPIError("Insufficient snapshot reserve "
+                                        "space to create a snapshot "
+                                        "for the volume")
+            return {'id': 'snap-%s' % id}
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            side_effect = create
+        SoftLayer.Client['Product_Package'].getItems.return_value = [
+            {'id': 2, 'prices': [{'id': 2}], 'capacity': '2'},
+            {'id': 4, 'prices': [{'id': 4}], 'capacity': '4'}]
+        results = self.driver.vol_mgr.create_snapshots([2, 3])
+        self.assertEquals({'snapshot': {'id': 'snap-2'}, 'error': None},
+                          results[2])
+        self.assertEquals({'snapshot': {'id': 'snap-3'}, 'error': None},
+                          results[3])
+        order = SoftLayer.Client['Product_Order'].placeOrder
+        order.assert_called_once_with({'orderContainers': [
+            {'complexType':
+             'SoftLayer_Container_Product_Order_'
+             'Network_Storage_Iscsi_SnapshotSpace',
+             'location': 1234,
+             'packageId': 0,
+             'prices': [{'id': price}],
+             'quantity': 1,
+             'volumeId': sl_id} for sl_id, price in ((2, 2), (3, 4))]})
+        self.assertEquals(2, f.call_count)
+
+    def setup_snapshots_without_space(self, *sizes):
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            self.sl_vols(*sizes)
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            side_effect = SoftLayerAPIError("Insufficient snapshot reserve "
+                                            "space to create a snapshot "
+                                            "for the volume")
+
+    def test_create_snapshots_space_not_ordered(self):
+        self.config.sl_order_snap_space = False
+        self.setup_snapshots_without_space(2, 4)
+
+        def create(notes, id):
+            if id == 3:
+                raise SoftLayerAPIError("snapshot failed")
+            raise SoftLayerAPIError("Insufficient snapshot reserve "
+                                    "space to create a snapshot "
+                                    "for the volume")
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            side_effect = create
+        results = self.driver.vol_mgr.create_snapshots([2, 3])
+        self.assertEquals({'snapshot': None,
+                           'error': "Insufficient snapshot reserve space."},
+                          results[2])
+        self.assertEquals({'snapshot': None, 'error': "snapshot failed"},
+                          results[3])
+        self.assertEquals(
+            0, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_create_snapshots_space_not_found(self):
+        self.config.sl_order_snap_space = True
+        self.setup_snapshots_without_space(2)
+        SoftLayer.Client['Product_Package'].getItems.return_value = []
+        results = self.driver.vol_mgr.create_snapshots([2])
+        self.assertEquals("Snapshot space having size 2 not found.",
+                          results[2]['error'])
+        self.assertEquals(
+            0, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_create_snapshots_space_not_ready(self):
+        self.config.sl_order_snap_space = True
+        self.config.sl_snap_space_active_retry = 2
+        self.config.sl_snap_space_active_wait = 0
+        self.setup_snapshots_without_space(2)
+        SoftLayer.Client['Product_Package'].getItems.return_value = [
+            {'id': 2, 'prices': [{'id': 2}], 'capacity': '2'}]
+        results = self.driver.vol_mgr.create_snapshots([2])
+        self.assertEquals("Unable to reserve space for volume.",
+                          results[2]['error'])
+        self.assertEquals(
+            1, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_create_snapshots_space_order_fails(self):
+        self.config.sl_order_snap_space = True
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            self.sl_vols(2)
+        SoftLayer.Client['Network_Storage_Iscsi'].createSnapshot.\
+            side_effect = SoftLayerAPIError("Insufficient snapshot reserve "
+                                            "space to create a snapshot "
+                                            "for the volume")
+        SoftLayer.Client['Product_Package'].getItems.return_value = [
+            {'id': 2, 'prices': [{'id': 2}], 'capacity': '2'}]
+        SoftLayer.Client['Product_Order'].placeOrder.side_effect = \
+            SoftLayerAPIError("order failed")
+        results = self.driver.vol_mgr.create_snapshots([2])
+        self.assertEquals({'snapshot': None, 'error': 'order failed'},
+                          results[2])
+
+    def test_driver_create_snapshots(self):
+        self.setup_existing(size=2)
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            self.sl_vols(2)
+        snapshot = {'id': 'os-snap-id', 'volume': self.volume}
+        updates = self.driver.create_snapshots([snapshot])
+        self.assertEquals(
+            {'os-snap-id': {
+                'model_update': {
+                    'provider_location': 'softlayer:snapshot:sl-snap-id'},
+                'error': None}}, updates)
+        self.assertRaises(exception.InvalidInput,
+                          self.driver.create_snapshots,
+                          [snapshot, {'id': 'other', 'volume': self.volume}])
 
     def test_snapshot_non_existent_delete(self):
         snapshot = {'id': 'os-snap-id', 'volume': self.volume}
@@ -508,6 +948,168 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.assertRaises(VolumeBackendAPIException,
                           self.driver.delete_snapshot, snapshot)
 
+    def test_object_mask(self):
+        self.assertEquals(
+            'mask[id,billingItem[id,location[name]]]',
+            object_mask('id', 'billingItem.id', 'billingItem.location.name'))
+
+    def test_volume_record(self):
+        meta = db_utils.volume_admin_metadata_get.return_value
+        record = VolumeRecord(meta)
+        self.assertEquals(2, record['id'])
+        self.assertEquals({'id': 2}, record['billingItem'])
+        self.assertEquals(1, record['capacityGb'])
+        self.assertEquals('10.0.0.2',
+                          record['serviceResourceBackendIpAddress'])
+        self.assertFalse('sl_id' in record)
+        self.assertRaises(KeyError, record.__getitem__, 'sl_id')
+        self.assertEquals(None, record.get('sl_written'))
+        self.assertEquals('<VolumeRecord 2>', repr(record))
+        self.assertTrue(record.to_admin_meta() is meta)
+        self.assertRaises(AttributeError, setattr, record, 'id', 3)
+        self.assertEquals(meta, VolumeRecord.from_sl_vol(record).meta)
+
+    def test_deserialize_cached(self):
+        meta_mgr = MetadataManager(cache_size=2)
+        meta_get = db_utils.volume_admin_metadata_get
+        record = meta_mgr.deserialize('vol')
+        self.assertTrue(record is meta_mgr.deserialize('vol'))
+        self.assertEquals(1, meta_get.call_count)
+        meta_get.return_value = dict(meta_get.return_value, capacityGb='2')
+        meta_mgr.update_meta('vol', {'capacityGb': '2'})
+        self.assertEquals(2, meta_mgr.deserialize('vol')['capacityGb'])
+        self.assertEquals(2, meta_get.call_count)
+        with meta_mgr.unit_of_work():
+            meta_mgr.update_meta('vol', {'capacityGb': '4'})
+            self.assertEquals(4, meta_mgr.deserialize('vol')['capacityGb'])
+        self.assertEquals(None, meta_mgr._records.get('vol'))
+
+    def test_deserialize_all_reuses_records(self):
+        meta_mgr = MetadataManager(cache_size=2)
+        record = meta_mgr.deserialize('vol')
+        rows = [{'key': key, 'value': value}
+                for key, value in record.meta.items()]
+        db_utils.volume_get_all.return_value = [
+            {'id': 'vol', 'volume_admin_metadata': rows}]
+        self.assertTrue(record is meta_mgr.deserialize_all()['vol'])
+
+    def test_deserialize_during_write_not_cached(self):
+        meta_mgr = MetadataManager(cache_size=2)
+        meta = db_utils.volume_admin_metadata_get.return_value
+
+        def read_during_write(context, vol_id):
+            meta_mgr.update_meta(vol_id, {'capacityGb': '2'})
+            return meta
+
+        db_utils.volume_admin_metadata_get.side_effect = read_during_write
+        meta_mgr.deserialize('vol')
+        self.assertEquals(None, meta_mgr._records.get('vol'))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(3, cache.get('c'))
+        for _i in range(100):
+            cache.get('a')
+        cache.set('d', 4)
+        self.assertEquals(set(['a', 'd']), set(cache._entries))
+
+    def test_lru_cache_fills_after_invalidate(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.set('c', 3)
+        cache.set('d', 4)
+        self.assertEquals(set(['c', 'd']), set(cache._entries))
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(None, cache.get('b'))
+        cache.invalidate()
+        self.assertEquals(0, len(cache))
+        cache.set('e', 5)
+        self.assertEquals(5, cache.get('e'))
+
+    def test_metadata_unit_of_work(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        db_utils.volume_admin_metadata_get.return_value = {'a': '1', 'b': '2'}
+        with meta_mgr.unit_of_work():
+            meta_mgr.update_meta('vol', {'c': '3'})
+            with meta_mgr.unit_of_work():
+                meta_mgr.delete_entry({'id': 'vol'}, 'a')
+            self.assertEquals({'b': '2', 'c': '3'}, meta_mgr.get_all('vol'))
+            self.assertEquals(0, update.call_count)
+        update.assert_called_once_with(
+            self.fake_context, 'vol', {'b': '2', 'c': '3'}, True)
+        self.assertEquals(1, db_utils.volume_admin_metadata_get.call_count)
+        self.assertEquals(1, cinder.context.get_admin_context.call_count)
+
+    def test_metadata_unit_of_work_cleared(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        db_utils.volume_admin_metadata_get.return_value = {'a': '1'}
+        with meta_mgr.unit_of_work():
+            meta_mgr.delete_all('vol')
+            meta_mgr.update_meta('vol', {'b': '2'})
+            self.assertEquals({'b': '2'}, meta_mgr.get_all('vol'))
+        update.assert_called_once_with(
+            self.fake_context, 'vol', {'b': '2'}, True)
+
+    def test_metadata_delete_entry_without_unit(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        db_utils.volume_admin_metadata_get.return_value = {'a': '1', 'b': '2'}
+        meta_mgr.delete_entry({'id': 'vol'}, 'a')
+        update.assert_called_once_with(
+            self.fake_context, 'vol', {'b': '2'}, delete=True)
+        meta_mgr.delete_entry({'id': 'vol'}, 'c')
+        self.assertEquals(1, update.call_count)
+
+    def test_metadata_serialize_written_through(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        sl_vol = SoftLayer.Client['Network_Storage_Iscsi'].getObject()
+        with meta_mgr.unit_of_work():
+            meta_mgr.update_meta('vol', {'c': '3'})
+            meta_mgr.serialize('vol', sl_vol)
+            self.assertEquals(1, update.call_count)
+            self.assertEquals('3', update.call_args[0][2]['c'])
+            self.assertEquals('2', update.call_args[0][2]['sl_id'])
+        self.assertEquals(1, update.call_count)
+        meta_mgr.serialize('other', sl_vol)
+        self.assertEquals(2, update.call_count)
+
+    def test_metadata_flush_failure_raises(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        update.side_effect = Exception("DB failure")
+
+        def store():
+            with meta_mgr.unit_of_work():
+                meta_mgr.update_meta('vol', {'c': '3'})
+
+        self.assertRaises(Exception, store)
+        self.assertEquals(1, update.call_count)
+
+    def test_metadata_flushed_on_failure(self):
+        meta_mgr = self.driver.meta_mgr
+        update = db_utils.volume_admin_metadata_update
+        update.side_effect = Exception("DB failure")
+
+        def fail():
+            with meta_mgr.unit_of_work():
+                meta_mgr.update_meta('vol', {'c': '3'})
+                raise exception.InvalidVolume(reason="failed")
+
+        self.assertRaises(exception.InvalidVolume, fail)
+        update.assert_called_once_with(
+            self.fake_context, 'vol', {'c': '3'}, False)
+
     def test_snapshot_delete(self):
         self.setup_existing(size=2)
         db_utils.volume_admin_metadata_get.return_value = {'os-snap-id': 4234}
@@ -518,6 +1120,27 @@ class SoftLayerDriverTestCase(DriverTestBase):
         db_utils.volume_admin_metadata_delete.called_once_with(
             self.fake_context, 'os-snap-id')
 
+    def test_snapshot_delete_from_location(self):
+        snapshot = {'id': 'os-snap-id', 'volume': self.volume,
+                    'provider_location': 'softlayer:snapshot:4234'}
+        self.driver.delete_snapshot(snapshot)
+        deleteObject = SoftLayer.Client['Network_Storage_Iscsi'].deleteObject
+        deleteObject.assert_called_once_with(id=4234)
+        self.assertEquals(0, db_utils.volume_admin_metadata_get.call_count)
+        self.assertEquals(0, db_utils.volume_admin_metadata_update.call_count)
+
+    def test_legacy_snapshot_delete(self):
+        db_utils.volume_admin_metadata_get.return_value = {
+            'os-snap-id': 4234, 'other-snap-id': 4235}
+        snapshot = {'id': 'os-snap-id', 'volume': self.volume,
+                    'provider_location': None}
+        self.driver.delete_snapshot(snapshot)
+        deleteObject = SoftLayer.Client['Network_Storage_Iscsi'].deleteObject
+        deleteObject.assert_called_once_with(id=4234)
+        db_utils.volume_admin_metadata_update.assert_called_once_with(
+            self.fake_context, self.volume['id'],
+            {'other-snap-id': 4235}, True)
+
     def test_snap_space_disabled_fails(self):
         self.setup_existing(size=2)
         snapshot = {'id': 'os-snap-id', 'volume': self.volume}
@@ -535,6 +1158,8 @@ class SoftLayerDriverTestCase(DriverTestBase):
         new_vol = copy.deepcopy(self.volume)
         new_vol['size'] = 2
         new_vol['id'] = 'new-os-vol'
+        SoftLayer.Client['Product_Package'].getItems.return_value = \
+            [{'id': 2, 'prices': [{'id': 2}], 'capacity': '2'}]
         vol_data = db_utils.volume_admin_metadata_get.return_value
         vol_with_snap = copy.deepcopy(vol_data)
         vol_with_snap['os-snap-id'] = 34234
@@ -549,6 +1174,8 @@ class SoftLayerDriverTestCase(DriverTestBase):
         new_vol = copy.deepcopy(self.volume)
         new_vol['size'] = 2
         new_vol['id'] = 'new-os-vol'
+        SoftLayer.Client['Product_Package'].getItems.return_value = \
+            [{'id': 2, 'prices': [{'id': 2}], 'capacity': '2'}]
         vol_data = db_utils.volume_admin_metadata_get.return_value
         vol_with_snap = copy.deepcopy(vol_data)
         vol_with_snap['os-snap-id'] = 34234
@@ -562,7 +1189,6 @@ class SoftLayerDriverTestCase(DriverTestBase):
                           snapshot)
         SoftLayer.Client['Billing_Item'].cancelItem.\
             assert_called_once_with(True, False, ANY, id=2)
-        self.assertMetaUpdated('new-os-vol')
         self.assertMetadataDeleted('new-os-vol')
 
     def test_no_billing_delete_succeeds(self):
@@ -576,3 +1202,362 @@ class SoftLayerDriverTestCase(DriverTestBase):
         self.driver.delete_volume(self.volume)
         vol_id = self.volume['id']
         self.assertMetadataDeleted(vol_id)
+
+    @patch('time.sleep')
+    def test_order_wait_backs_off(self, sleep):
+        self.config.sl_vol_active_wait = 10
+        self.config.sl_vol_active_retry = 100
+        SoftLayer.Client['Billing_Order_Item'].getBillingItem.side_effect = \
+            [{}, {}, {}, {}, {}, {'notes': 'foo'}]
+        self.driver.vol_mgr.waiter.jitter = 0
+        self.driver.create_volume(self.volume)
+        self.assertEquals([call(1.0), call(2.0), call(4.0),
+                           call(8.0), call(10)],
+                          sleep.call_args_list)
+        stats = self.driver.vol_mgr.waiter.stats()
+        self.assertEquals(1, stats['order_active']['count'])
+
+    @patch('eventlet.greenthread.sleep')
+    def test_api_retries_transient_errors(self, sleep):
+        self.config.sl_api_retries = 2
+        self.driver.do_setup(None)
+        getObject = SoftLayer.Client['Network_Storage_Iscsi'].getObject
+        getObject.side_effect = [TransportError(503, 'unavailable'),
+                                 TransportError(0, 'timed out'),
+                                 {'id': 2}]
+        self.assertEquals({'id': 2}, self.driver.vol_mgr._get_vol(2))
+        self.assertEquals([call(1), call(2)], sleep.call_args_list)
+        stats = self.driver.vol_mgr.client.stats()['methods']
+        self.assertEquals(3, stats['Network_Storage_Iscsi.getObject']['count'])
+        self.assertEquals(
+            2, stats['Network_Storage_Iscsi.getObject']['errors'])
+
+    @patch('eventlet.greenthread.sleep')
+    def test_api_does_not_retry_orders(self, sleep):
+        self.config.sl_api_retries = 2
+        self.driver.do_setup(None)
+        placeOrder = SoftLayer.Client['Product_Order'].placeOrder
+        placeOrder.side_effect = TransportError(503, 'unavailable')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        self.assertEquals(1, placeOrder.call_count)
+        getObject = SoftLayer.Client['Network_Storage_Iscsi'].getObject
+        getObject.side_effect = TransportError(404, 'not found')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.vol_mgr._get_vol, 2)
+        self.assertEquals(1, getObject.call_count)
+        self.assertEquals(0, sleep.call_count)
+
+    def test_api_stats_per_operation(self):
+        self.driver.create_volume(self.volume)
+        stats = self.driver.get_volume_stats(refresh=True)['api_stats']
+        create = stats['operations']['create_volume']
+        self.assertEquals(1, create['count'])
+        self.assertEquals(5, create['calls'])
+        self.assertEquals(
+            1, stats['methods']['Product_Order.placeOrder']['count'])
+        self.assertEquals(
+            0, stats['methods']['Product_Order.placeOrder']['errors'])
+        self.assertEquals(1, stats['waits']['order_active']['count'])
+
+    def test_api_stats_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'api-stats.json')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        self.config.sl_api_stats_file = path
+        self.driver.create_volume(self.volume)
+        self.driver.get_volume_stats(refresh=True)
+        with open(path) as stats_file:
+            stats = json.load(stats_file)
+        self.assertEquals(1, stats['operations']['create_volume']['count'])
+        self.assertEquals(1, stats['waits']['order_active']['count'])
+
+    def test_api_stats_file_not_writable(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, path)
+        self.config.sl_api_stats_file = os.path.join(path, 'missing', 'api')
+        with patch('slos.cinder.driver.iscsi.LOG') as log:
+            stats = self.driver.get_volume_stats(refresh=True)
+        self.assertIn('methods', stats['api_stats'])
+        self.assertEquals(1, log.warn.call_count)
+
+    def test_volume_stats_before_setup(self):
+        driver = SoftLayerISCSIDriver(configuration=self.config, db=self.db)
+        stats = driver.get_volume_stats(refresh=True)
+        self.assertNotIn('api_stats', stats)
+
+    def test_api_concurrency_limit(self):
+        in_flight = []
+        peak = []
+
+        def slow_call(*args, **kwargs):
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            eventlet.sleep(0)
+            in_flight.pop()
+
+        getObject = SoftLayer.Client['Network_Storage_Iscsi'].getObject
+        getObject.side_effect = slow_call
+        client = ApiClient(SoftLayer.Client, concurrency=2)
+        pool = eventlet.GreenPool()
+        for i in range(5):
+            pool.spawn(client['Network_Storage_Iscsi'].getObject, id=2)
+        pool.waitall()
+        self.assertEquals(5, getObject.call_count)
+        self.assertEquals(2, max(peak))
+
+    def setup_transport(self, name):
+        requests = MagicMock()
+        transport = types.ModuleType(name)
+        transport.requests = requests
+        modules = patch.dict(sys.modules, {'requests': requests,
+                                           name: transport})
+        modules.start()
+        self.addCleanup(modules.stop)
+        return requests, transport
+
+    def test_keepalive_transport(self):
+        requests, transport = self.setup_transport('SoftLayer.transports')
+        self.assertTrue(use_keepalive_transport(4))
+        session = requests.Session.return_value
+        self.assertTrue(isinstance(transport.requests, _SessionRequests))
+        self.assertEquals(session.post, transport.requests.post)
+        self.assertEquals(requests.HTTPError, transport.requests.HTTPError)
+        requests.adapters.HTTPAdapter.assert_called_once_with(
+            pool_connections=1, pool_maxsize=4)
+        session.mount.assert_any_call(
+            'https://', requests.adapters.HTTPAdapter.return_value)
+        # the session is installed once
+        self.assertTrue(use_keepalive_transport(4))
+        self.assertEquals(1, requests.Session.call_count)
+
+    def test_keepalive_transport_module_names(self):
+        requests, transport = self.setup_transport('SoftLayer.transport')
+        self.assertTrue(use_keepalive_transport(4))
+        self.assertTrue(isinstance(transport.requests, _SessionRequests))
+
+    def test_keepalive_transport_unavailable(self):
+        self.setup_transport('other')
+        self.assertFalse(use_keepalive_transport(4))
+        requests, transport = self.setup_transport('SoftLayer.transports')
+        del transport.requests
+        self.assertFalse(use_keepalive_transport(4))
+        self.config.sl_api_keepalive_pool = 4
+        with patch('slos.cinder.driver.api.LOG') as log:
+            self.driver.do_setup(None)
+        log.warn.assert_called_once_with(
+            "Unable to enable keep-alive for SoftLayer API.")
+
+    def test_keepalive_transport_without_requests(self):
+        self.setup_transport('SoftLayer.transports')
+        with patch.dict(sys.modules, {'requests': None}):
+            self.assertFalse(use_keepalive_transport(4))
+
+    @patch('time.time')
+    @patch('time.sleep')
+    def test_wait_deadline(self, sleep, now):
+        now.side_effect = [0, 0, 9, 21, 21]
+        poll = MagicMock(return_value=None)
+        waiter = BackoffWaiter(initial=10, jitter=0)
+        self.assertIsNone(waiter.wait('phase', poll, 20, 10))
+        self.assertEquals([call(10), call(10)], sleep.call_args_list)
+        self.assertEquals(3, poll.call_count)
+        self.assertEquals(21, waiter.stats()['phase']['max'])
+
+    def setup_devices(self, data):
+        fd, src = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        fd, dest = tempfile.mkstemp()
+        os.write(fd, b'\xff' * len(data))
+        os.close(fd)
+        self.addCleanup(os.remove, src)
+        self.addCleanup(os.remove, dest)
+        return src, dest
+
+    def test_block_copier_copies_ranges(self):
+        data = os.urandom(1024 * 1024)
+        src, dest = self.setup_devices(data)
+        copier = BlockCopier(block_size_kb=12, workers=3)
+        stats = copier.copy(src, dest, 1)
+        self.assertEquals(1024 * 1024, stats['written'])
+        with open(dest, 'rb') as f:
+            self.assertEquals(data, f.read())
+        self.assertEquals(3, len(copier._buffers))
+
+    def test_block_copier_skips_zero_blocks(self):
+        data = b'\0' * 512 * 1024 + b'\1' * 512 * 1024
+        src, dest = self.setup_devices(data)
+        stats = BlockCopier(block_size_kb=64, workers=2,
+                            skip_zero=True).copy(src, dest, 1)
+        self.assertEquals(512 * 1024, stats['skipped'])
+        with open(dest, 'rb') as f:
+            self.assertEquals(b'\xff' * 512 * 1024 + b'\1' * 512 * 1024,
+                              f.read())
+
+    def test_block_copier_direct_io_from_dev_zero(self):
+        src, dest = self.setup_devices(b'\1' * 1024 * 1024)
+        stats = BlockCopier(block_size_kb=64,
+                            direct_io=True).copy('/dev/zero', dest, 1)
+        self.assertEquals(1024 * 1024, stats['written'])
+        with open(dest, 'rb') as f:
+            self.assertEquals(b'\0' * 1024 * 1024, f.read())
+
+    def test_block_copier_direct_io_block_devices(self):
+        src, dest = self.setup_devices(b'\1' * 1024 * 1024)
+        copier = BlockCopier(direct_io=True)
+        fd = os.open(dest, os.O_RDONLY)
+        with patch('os.stat') as stat_mock:
+            with patch('os.open', return_value=fd) as open_mock:
+                stat_mock.return_value.st_mode = stat.S_IFBLK | 0o660
+                copier._open(dest, 'r').close()
+        open_mock.assert_called_once_with(dest, os.O_RDONLY | os.O_DIRECT)
+
+    def test_block_copier_copy_range(self):
+        data = b'\1' * 64 * 1024 + b'\0' * 64 * 1024 + b'\2' * 64 * 1024
+        src, dest = self.setup_devices(data)
+        copier = BlockCopier(block_size_kb=64)
+        buf = mmap.mmap(-1, copier.block_size)
+        self.assertEquals(
+            (64 * 1024, 64 * 1024),
+            copier._copy_range(src, dest, 64 * 1024, 128 * 1024, buf, True))
+        with open(dest, 'rb') as f:
+            self.assertEquals(b'\xff' * 128 * 1024 + b'\2' * 64 * 1024,
+                              f.read())
+
+    def test_block_copier_short_source(self):
+        src, dest = self.setup_devices(b'\1' * 64 * 1024)
+        copier = BlockCopier(block_size_kb=64)
+        buf = mmap.mmap(-1, copier.block_size)
+        self.assertRaises(IOError, copier._copy_range,
+                          src, dest, 0, 128 * 1024, buf, False)
+
+    def test_block_copier_unaligned_block_size(self):
+        self.assertRaises(exception.InvalidConfigurationValue,
+                          BlockCopier, block_size_kb=6)
+
+    def test_initialize_connection_uses_discovery_cache(self):
+        self.config.sl_discovery_cache_ttl = 600
+        self.driver.do_setup(None)
+        self.setup_initialize()
+        self.driver.initialize_connection(self.volume, None)
+        connection = self.driver.initialize_connection(self.volume, None)
+        self.assertConnectionValue(connection)
+        self.assertEquals(4, c_utils.execute.call_count)
+
+    @patch('time.time')
+    def test_ttl_cache(self, now):
+        cache = TTLCache(ttl=10)
+        now.return_value = 100
+        cache.set('a', 1)
+        cache.set('b', 2)
+        now.return_value = 109
+        self.assertEquals(1, cache.get('a'))
+        cache.invalidate()
+        self.assertEquals(None, cache.get('b'))
+        cache.set('c', 3)
+        now.return_value = 119
+        self.assertEquals(None, cache.get('c'))
+
+    def test_discovery_failure_not_cached(self):
+        self.config.sl_discovery_cache_ttl = 600
+        self.driver.do_setup(None)
+        c_utils.execute.return_value = ('details', 'error')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.ensure_export, None, self.volume)
+        self.setup_initialize()
+        self.driver.ensure_export(None, self.volume)
+        self.assertEquals(7, c_utils.execute.call_count)
+
+    def test_attach_failure_invalidates_discovery(self):
+        self.config.sl_discovery_cache_ttl = 600
+        self.driver.do_setup(None)
+        source_vol, dest_vol = self.setup_two_vols()
+        self.setup_initialize()
+        connector = MagicMock()
+        connector.connect_volume.return_value = {'path': 'valid_host'}
+        connector.check_valid_device.return_value = False
+        c_utils.brick_get_connector.return_value = connector
+        self.assertRaises(exception.InvalidResults,
+                          self.driver.create_cloned_volume,
+                          dest_vol, source_vol)
+        self.driver.initialize_connection(dest_vol, None)
+        self.assertEquals(10, c_utils.execute.call_count)
+
+    def test_bulk_ensure_export(self):
+        self.config.sl_startup_export = 'bulk'
+        self.setup_initialize()
+        rows = [{'key': key, 'value': value} for key, value in
+                db_utils.volume_admin_metadata_get.return_value.items()]
+        db_utils.volume_get_all.return_value = [
+            {'id': self.volume['id'], 'volume_admin_metadata': rows},
+            {'id': 'other-vol', 'volume_admin_metadata': []}]
+        attach_details = self.driver.ensure_export(None, self.volume)
+        self.assertEquals({'provider_location':
+                           '10.0.0.2:3260,1 '
+                           'iqn.2001-05.com.equallogic:'
+                           '0-8a0906-35b45ea0b-aa50043e7f9533bc'
+                           '-ibmi278184-227'}, attach_details)
+        self.assertEquals(1, db_utils.volume_get_all.call_count)
+        self.assertEquals(4, c_utils.execute.call_count)
+        self.assertEquals(0, db_utils.volume_admin_metadata_get.call_count)
+
+    @patch('slos.cinder.driver.iscsi.greenpool.GreenPool',
+           wraps=eventlet.GreenPool)
+    def test_bulk_ensure_export_concurrency(self, pool):
+        self.config.sl_startup_export = 'bulk'
+        self.config.sl_discovery_concurrency = 4
+        self.setup_initialize()
+        self.driver.ensure_export(None, self.volume)
+        pool.assert_called_once_with(1)
+        self.driver._startup_exports = None
+        self.config.sl_discovery_mode = 'discoverydb'
+        self.driver.ensure_export(None, self.volume)
+        pool.assert_called_with(4)
+
+    def test_bulk_ensure_export_failure_skipped(self):
+        self.config.sl_startup_export = 'bulk'
+        c_utils.execute.return_value = ('details', 'error')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.ensure_export, None, self.volume)
+        self.assertEquals(7, c_utils.execute.call_count)
+
+    def test_lazy_ensure_export(self):
+        self.config.sl_startup_export = 'lazy'
+        self.assertIsNone(self.driver.ensure_export(None, self.volume))
+        self.assertEquals(1, c_utils.execute.call_count)
+
+    def test_invalid_startup_export(self):
+        self.config.sl_startup_export = 'invalid'
+        self.assertRaises(exception.InvalidConfigurationValue,
+                          self.driver.ensure_export, None, self.volume)
+
+    def test_discoverydb_initialize_connection(self):
+        self.config.sl_discovery_mode = 'discoverydb'
+        self.driver.check_for_setup_error()
+        self.assertEquals(1, c_utils.execute.call_count)
+        self.setup_initialize()
+        connection = self.driver.initialize_connection(self.volume, None)
+        self.assertConnectionValue(connection)
+        db_cmd = ('iscsiadm', '-m', 'discoverydb', '-t', 'sendtargets',
+                  '-p', '10.0.0.2')
+        c_utils.execute.assert_has_calls([
+            call(*(db_cmd + ('-o', 'new')), run_as_root=True),
+            call(*(db_cmd + ('-o', 'update', '-n',
+                             'discovery.sendtargets.auth.authmethod',
+                             '-v', 'CHAP')), run_as_root=True),
+            call(*(db_cmd + ('-o', 'update', '-n',
+                             'discovery.sendtargets.auth.username',
+                             '-v', 'foo')), run_as_root=True),
+            call(*(db_cmd + ('-o', 'update', '-n',
+                             'discovery.sendtargets.auth.password',
+                             '-v', 'bar')), run_as_root=True),
+            call(*(db_cmd + ('--discover', '-o', 'new')),
+                 run_as_root=True)])
+        self.assertEquals(6, c_utils.execute.call_count)
+
+    def test_discoverydb_fails(self):
+        self.config.sl_discovery_mode = 'discoverydb'
+        c_utils.execute.return_value = ('details', 'error')
+        self.assertRaises(VolumeBackendAPIException,
+                          self.driver.create_export, None, self.volume)
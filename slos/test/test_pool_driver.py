@@ -1,4 +1,7 @@
 import copy
+import os
+import shutil
+import tempfile
 import cinder.db as db_utils
 import cinder.utils as c_utils
 
@@ -6,6 +9,7 @@ from cinder import exception
 from cinder.volume import utils as vol_utils
 from cinder.openstack.common.processutils import ProcessExecutionError
 
+from eventlet import greenthread
 from mock import call, patch, ANY
 
 import SoftLayer
@@ -123,7 +127,11 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
             assert_called_once_with(filter={'iscsiNetworkStorage': {
                 'billingItem': {'location': {'id': {'operation': 1234}}},
                 'capacityGb': {'operation': 1}}},
-                mask=ANY)
+                mask='mask[id,capacityGb,username,password,'
+                     'serviceResourceBackendIpAddress,billingItem[id],'
+                     'notes]')
+        self.assertEquals(
+            0, SoftLayer.Client['Network_Storage_Iscsi'].getObject.call_count)
 
     def test_pool_full_create_fails(self):
         self.config.sl_pool_real_order = False
@@ -135,14 +143,21 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
         f = SoftLayer.Client['Product_Package'].getItems
         f.return_value = [{'id': 2, 'prices': [{'id': 2}], 'capacity': '1'}]
         db_utils.volume_get_all.return_value = [{'id': '123'}]
+        pool_vol = SoftLayer.Client['Account'].getIscsiNetworkStorage.\
+            return_value[0]
+        ordered_vol = copy.deepcopy(pool_vol)
+        ordered_vol['id'] = 3
+        ordered_vol['billingItem'] = {'id': 3}
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.side_effect = \
+            [[pool_vol], [ordered_vol]]
         update = self.driver.create_volume(self.volume)
         self.assertEquals({'size': 1}, update)
         SoftLayer.Client['Product_Order'].placeOrder.\
             assert_called_once_with(self.expected_order)
         db_utils.volume_admin_metadata_update.\
             assert_called_once_with(self.fake_context, self.volume['id'], {
-                'sl_id': '2',
-                'billing_item_id': '2',
+                'sl_id': '3',
+                'billing_item_id': '3',
                 'portal': '10.0.0.2',
                 'capacityGb': '1',
                 'username': 'foo',
@@ -179,12 +194,8 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
         self.config.sl_pool_volume_clear = 'none'
         self.driver.delete_volume(self.volume)
         self.assertEquals(c_utils.execute.call_count, 4)
-        db_utils.volume_admin_metadata_delete.\
-            assert_has_calls(
-                [call(self.fake_context,
-                      self.volume['id'],
-                      'sl_id')],
-                any_order=True)
+        db_utils.volume_admin_metadata_update.assert_called_once_with(
+            self.fake_context, self.volume['id'], {}, True)
         self.assert_single_detach(detach_volume)
 
     @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
@@ -195,12 +206,8 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
         vol_utils.copy_volume.assert_called_once_with('/dev/zero',
                                                       'valid_host',
                                                       1024)
-        db_utils.volume_admin_metadata_delete.\
-            assert_has_calls(
-                [call(self.fake_context,
-                      self.volume['id'],
-                      'sl_id')],
-                any_order=True)
+        db_utils.volume_admin_metadata_update.assert_called_once_with(
+            self.fake_context, self.volume['id'], {}, True)
         self.assert_single_detach(detach_volume)
 
     @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
@@ -215,6 +222,122 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
                                         run_as_root=True)
         self.assert_single_detach(detach_volume)
 
+    def setup_written(self, written):
+        meta = copy.deepcopy(db_utils.volume_admin_metadata_get.return_value)
+        if written is not None:
+            meta['sl_written'] = written
+        db_utils.volume_admin_metadata_get.return_value = meta
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_discarded(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'discard'
+        self.driver.delete_volume(self.volume)
+        # discarded blocks are not known to read as zeros
+        c_utils.execute.assert_any_call('blkdiscard', '--zeroout',
+                                        'valid_host', run_as_root=True)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+        self.assert_single_detach(detach_volume)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_discarded_zeroes_data(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'discard'
+        sys_block = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sys_block)
+        os.makedirs(os.path.join(sys_block, 'valid_host', 'queue'))
+        with open(os.path.join(sys_block, 'valid_host', 'queue',
+                               'discard_zeroes_data'), 'w') as sys_file:
+            sys_file.write('1\n')
+        self.driver.SYS_BLOCK = sys_block
+        with patch('os.path.realpath', return_value='/dev/valid_host'):
+            self.driver.delete_volume(self.volume)
+        c_utils.execute.assert_any_call('blkdiscard', 'valid_host',
+                                        run_as_root=True)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_discard_unsupported_zeroed_out(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'discard'
+        execute = c_utils.execute.side_effect
+
+        def no_discard(*args, **kwargs):
+            if args[0] == 'blkdiscard':
+                raise ProcessExecutionError()
+            return c_utils.execute.return_value
+
+        c_utils.execute.side_effect = no_discard
+        try:
+            self.driver.delete_volume(self.volume)
+        finally:
+            c_utils.execute.side_effect = execute
+        vol_utils.copy_volume.assert_called_once_with('/dev/zero',
+                                                      'valid_host',
+                                                      1024)
+        self.assert_single_detach(detach_volume)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_written_zeroed_out(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'zero-written'
+        self.setup_written('all')
+        self.driver.delete_volume(self.volume)
+        vol_utils.copy_volume.assert_called_once_with('/dev/zero',
+                                                      'valid_host',
+                                                      1024)
+        self.assert_single_detach(detach_volume)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_unwritten_not_zeroed(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'zero-written'
+        self.setup_written('none')
+        self.driver.delete_volume(self.volume)
+        self.assertEquals(4, c_utils.execute.call_count)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_unknown_written_zeroed_out(self, detach_volume):
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'zero-written'
+        self.setup_written(None)
+        self.driver.delete_volume(self.volume)
+        vol_utils.copy_volume.assert_called_once_with('/dev/zero',
+                                                      'valid_host',
+                                                      1024)
+
+    def test_create_tracks_written_regions(self):
+        self.config.sl_pool_volume_clear = 'zero-written'
+        db_utils.volume_get_all.return_value = []
+        db_utils.volume_metadata_get.return_value = \
+            {'softlayer_volume_id': '2'}
+        self.driver.create_volume(self.volume)
+        db_utils.volume_admin_metadata_update.\
+            assert_called_once_with(self.fake_context, self.volume['id'], {
+                'sl_id': '2',
+                'billing_item_id': '2',
+                'portal': '10.0.0.2',
+                'capacityGb': '1',
+                'username': 'foo',
+                'password': 'bar',
+                'sl_written': 'none'
+            }, False)
+
+    def test_attach_marks_written(self):
+        self.setup_initialize()
+        self.setup_written('none')
+        self.driver.initialize_connection(self.volume, {})
+        db_utils.volume_admin_metadata_update.\
+            assert_called_once_with(self.fake_context, self.volume['id'],
+                                    {'sl_written': 'all'}, False)
+
+    def test_attach_written_not_marked_again(self):
+        self.setup_initialize()
+        self.setup_written('all')
+        self.driver.initialize_connection(self.volume, {})
+        self.assertEquals(0, db_utils.volume_admin_metadata_update.call_count)
+
     @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
     def test_zero_out_fails(self, detach_volume):
         self.setup_attach()
@@ -238,3 +361,436 @@ class SoftLayerPoolDriverTestCase(DriverTestBase):
         self.assertRaises(
             ProcessExecutionError, self.driver.delete_volume, self.volume)
         self.assert_single_detach(detach_volume)
+
+    def test_imported_read_from_volume_rows(self):
+        db_utils.volume_get_all.return_value = [
+            {'id': 'vol-1',
+             'volume_admin_metadata': [{'key': 'sl_id', 'value': '2'},
+                                       {'key': 'portal',
+                                        'value': '10.0.0.2'}]},
+            {'id': 'vol-2', 'volume_admin_metadata': []}]
+        db_utils.volume_metadata_get.return_value = \
+            {'softlayer_volume_id': '2'}
+        self.assertRaises(exception.InvalidVolume,
+                          self.driver.create_volume, self.volume)
+        self.assertEquals(1, db_utils.volume_get_all.call_count)
+        self.assertEquals(0, db_utils.volume_admin_metadata_get.call_count)
+
+    def test_imported_index_follows_serialize_and_delete(self):
+        db_utils.volume_get_all.return_value = []
+        self.assertFalse(self.driver.meta_mgr.is_imported(2))
+        self.driver.create_volume(self.volume)
+        self.assertTrue(self.driver.meta_mgr.is_imported(2))
+        self.driver.meta_mgr.delete_all(self.volume['id'])
+        self.assertFalse(self.driver.meta_mgr.is_imported(2))
+        self.assertEquals(1, db_utils.volume_get_all.call_count)
+
+    def test_serialized_during_index_load(self):
+        meta_mgr = self.driver.meta_mgr
+        sl_vol = SoftLayer.Client['Network_Storage_Iscsi'].getObject()
+
+        def get_all(*args, **kwargs):
+            # stored by another green thread after the rows were read
+            meta_mgr.serialize('other', sl_vol)
+            return []
+        db_utils.volume_get_all.side_effect = get_all
+        self.assertEquals(set([2]), meta_mgr.all_imported(refresh=True))
+
+    def test_reserved_volume_skipped(self):
+        db_utils.volume_get_all.return_value = []
+        self.config.sl_pool_real_order = False
+        self.assertTrue(self.driver.meta_mgr.reserve(2))
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        self.driver.meta_mgr.release(2)
+        update = self.driver.create_volume(self.volume)
+        self.assertEquals({'size': 1}, update)
+
+    def test_reservation_released_on_failure(self):
+        db_utils.volume_get_all.return_value = []
+        db_utils.volume_admin_metadata_update.side_effect = \
+            Exception("DB failure")
+        self.assertRaises(Exception,
+                          self.driver.create_volume, self.volume)
+        self.assertTrue(self.driver.meta_mgr.reserve(2))
+
+    def test_reservation_kept_until_stored(self):
+        self.setup_pool(1, 1)
+        meta_mgr = self.driver.meta_mgr
+        with meta_mgr.unit_of_work():
+            self.driver.create_volume(self.volume)
+            # the index is rebuilt before the operation completes
+            self.driver.vol_mgr.free_pool.loaded_at = 0
+            stats = self.driver.get_volume_stats(refresh=True)
+            self.assertEquals({'1': 1}, stats['free_volumes'])
+            self.assertFalse(meta_mgr.reserve(10))
+        self.assertTrue(meta_mgr.reserve(10))
+
+    def test_ordered_volume_in_use_fails(self):
+        self.config.sl_pool_real_order = True
+        db_utils.volume_get_all.return_value = [{'id': '123'}]
+        f = SoftLayer.Client['Product_Package'].getItems
+        f.return_value = [{'id': 2, 'prices': [{'id': 2}], 'capacity': '1'}]
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        self.assertEquals(0, db_utils.volume_admin_metadata_update.call_count)
+
+    def setup_pool(self, *capacities):
+        pool = []
+        for sl_id, capacity in enumerate(capacities, 10):
+            pool.append({'id': sl_id,
+                         'capacityGb': capacity,
+                         'username': 'foo%s' % sl_id,
+                         'password': 'bar',
+                         'serviceResourceBackendIpAddress': '10.0.0.2',
+                         'billingItem': {'id': sl_id}})
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            pool
+        db_utils.volume_get_all.return_value = []
+        self.config.sl_pool_index_ttl = 300
+        self.driver.do_setup(None)
+        self.driver.check_for_setup_error()
+
+    def test_free_pool_index(self):
+        self.setup_pool(1, 1, 2)
+        list_vols = SoftLayer.Client['Account'].getIscsiNetworkStorage
+        update = db_utils.volume_admin_metadata_update
+        self.driver.create_volume(self.volume)
+        self.assertEquals('10', update.call_args[0][2]['sl_id'])
+        self.driver.create_volume(self.volume)
+        self.assertEquals('11', update.call_args[0][2]['sl_id'])
+        self.config.sl_pool_real_order = False
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        self.assertEquals(1, list_vols.call_count)
+        list_vols.assert_called_once_with(filter={'iscsiNetworkStorage': {
+            'billingItem': {'location': {'id': {'operation': 1234}}}}},
+            mask=ANY)
+        free_pool = self.driver.vol_mgr.free_pool
+        self.assertEquals({2: 1}, free_pool.free_count())
+        free_pool.put(free_pool._buckets[2][0])
+        self.assertEquals({2: 1}, free_pool.free_count())
+
+    def test_free_pool_index_ceil(self):
+        self.setup_pool(4, 2, 8)
+        self.config.sl_vol_order_ceil = True
+        update = self.driver.create_volume({'id': 'vol', 'size': 3,
+                                            'display_name': 'vol'})
+        self.assertEquals({'size': 4}, update)
+        self.assertEquals({2: 1, 8: 1},
+                          self.driver.vol_mgr.free_pool.free_count())
+
+    def test_free_pool_index_skips_imported(self):
+        self.setup_pool(1, 1)
+        db_utils.volume_get_all.return_value = [
+            {'id': 'vol', 'volume_admin_metadata': [
+                {'key': 'sl_id', 'value': '10'}]}]
+        self.driver.create_volume(self.volume)
+        db_utils.volume_admin_metadata_update.assert_called_once_with(
+            ANY, self.volume['id'], {'sl_id': '11',
+                                     'billing_item_id': '11',
+                                     'portal': '10.0.0.2',
+                                     'capacityGb': '1',
+                                     'username': 'foo11',
+                                     'password': 'bar'}, False)
+        self.assertEquals(
+            0, SoftLayer.Client['Network_Storage_Iscsi'].getObject.call_count)
+
+    def test_create_does_not_rescan_volumes(self):
+        self.setup_pool(1, 1)
+        self.driver.create_volume(self.volume)
+        self.driver.create_volume({'id': 'other', 'display_name': 'other',
+                                   'size': 1})
+        # read once, when the index is built
+        self.assertEquals(1, db_utils.volume_get_all.call_count)
+
+    def test_index_rebuild_reloads_imported(self):
+        self.setup_pool(1, 1)
+        self.driver.get_volume_stats(refresh=True)
+        self.assertFalse(self.driver.meta_mgr.is_imported(10))
+        db_utils.volume_get_all.return_value = [
+            {'id': 'other', 'volume_admin_metadata': [
+                {'key': 'sl_id', 'value': '10'}]}]
+        self.driver.vol_mgr.free_pool.loaded_at = 0
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEquals({'1': 1}, stats['free_volumes'])
+        self.assertTrue(self.driver.meta_mgr.is_imported(10))
+
+    def setup_stored_meta(self, stored):
+        """Keeps the admin metadata written in stored, by volume ID."""
+        def update(context, vol_id, meta, delete):
+            if delete:
+                stored[vol_id] = dict(meta)
+            else:
+                stored.setdefault(vol_id, {}).update(meta)
+
+        def get_all(context, **kwargs):
+            return [{'id': vol_id, 'volume_admin_metadata': [
+                {'key': key, 'value': value}
+                for key, value in meta.items()]}
+                for vol_id, meta in stored.items()]
+        db_utils.volume_admin_metadata_update.side_effect = update
+        db_utils.volume_get_all.side_effect = get_all
+        db_utils.volume_admin_metadata_get.side_effect = \
+            lambda context, vol_id: dict(stored.get(vol_id, {}))
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_create_during_clone_skips_clone_volume(self, detach_volume):
+        self.setup_pool(1, 1)
+        self.setup_attach()
+        stored = {'source': {'sl_id': '2', 'username': 'foo',
+                             'password': 'bar', 'portal': '10.0.0.2',
+                             'capacityGb': '1', 'billing_item_id': '2'}}
+        self.setup_stored_meta(stored)
+        other = {'id': 'other', 'display_name': 'other', 'size': 1}
+
+        def copy_volume(src_path, dest_path, size_in_mb):
+            # the index is rebuilt from the database while copying
+            self.driver.vol_mgr.free_pool.loaded_at = 0
+            greenthread.spawn(self.driver.create_volume, other).wait()
+        vol_utils.copy_volume.side_effect = copy_volume
+        self.driver.create_cloned_volume(self.volume,
+                                         {'id': 'source', 'size': 1})
+        self.assertEquals('10', stored[self.volume['id']]['sl_id'])
+        self.assertEquals('11', stored['other']['sl_id'])
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_returns_volume_to_index(self, detach_volume):
+        self.setup_pool()
+        self.setup_attach()
+        self.config.sl_pool_volume_clear = 'none'
+        self.driver.get_volume_stats(refresh=True)
+        self.driver.delete_volume(self.volume)
+        self.assertEquals({1: 1}, self.driver.vol_mgr.free_pool.free_count())
+        self.driver.create_volume(self.volume)
+        self.assertEquals(
+            1, SoftLayer.Client['Account'].getIscsiNetworkStorage.call_count)
+
+    def test_stats_refresh_free_pool_error(self):
+        self.setup_pool()
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.side_effect = \
+            SoftLayerAPIError("")
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEquals('SoftLayer', stats['vendor_name'])
+        self.assertTrue(self.driver.vol_mgr.free_pool.expired())
+
+    def test_stats_report_pool_capacity(self):
+        self.setup_pool(1, 1, 4)
+        db_utils.volume_get_all.return_value = [
+            {'id': 'vol', 'volume_admin_metadata': [
+                {'key': 'sl_id', 'value': '10'}]}]
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEquals(6, stats['total_capacity_gb'])
+        self.assertEquals(5, stats['free_capacity_gb'])
+        self.assertEquals({'1': 1, '4': 1}, stats['free_volumes'])
+        self.assertEquals({'1': 2, '4': 1}, stats['total_volumes'])
+        self.assertEquals(4, stats['largest_free_volume_gb'])
+        self.driver.create_volume(self.volume)
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEquals(4, stats['free_capacity_gb'])
+        self.assertEquals({'4': 1}, stats['free_volumes'])
+        self.assertEquals(
+            1, SoftLayer.Client['Account'].getIscsiNetworkStorage.call_count)
+
+    def test_stats_capacity_infinite_with_real_order(self):
+        self.setup_pool(1)
+        self.config.sl_pool_real_order = True
+        stats = self.driver.get_volume_stats(refresh=True)
+        self.assertEquals('infinite', stats['free_capacity_gb'])
+        self.assertEquals({'1': 1}, stats['free_volumes'])
+        self.driver.create_volume(self.volume)
+        # pool exhausted, the volume is ordered
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = [
+            {'id': 3, 'capacityGb': 1, 'username': 'foo', 'password': 'bar',
+             'serviceResourceBackendIpAddress': '10.0.0.2',
+             'billingItem': {'id': 3}}]
+        self.driver.create_volume(dict(self.volume, id='other'))
+        self.assertEquals({1: 2},
+                          self.driver.vol_mgr.free_pool.total_count())
+
+    def setup_warm_pool(self, stock):
+        self.config.sl_pool_warm_stock = stock
+        self.setup_pool(1)
+        list_vols = SoftLayer.Client['Account'].getIscsiNetworkStorage
+        pool = list_vols.return_value
+
+        def list_or_order(mask, filter):
+            if 'username' not in filter['iscsiNetworkStorage']:
+                return pool
+            sl_id = 20 + list_vols.call_count
+            return [{'id': sl_id, 'capacityGb': 1, 'username': 'foo',
+                     'password': 'bar', 'billingItem': {'id': sl_id},
+                     'serviceResourceBackendIpAddress': '10.0.0.2'}]
+        list_vols.side_effect = list_or_order
+        SoftLayer.Client['Product_Package'].getItems.return_value = \
+            [{'id': 2, 'prices': [{'id': 2}], 'capacity': '1'}]
+        return self.driver.warm_pool
+
+    def test_warm_pool_replenish(self):
+        warm_pool = self.setup_warm_pool(['1:2:3'])
+        self.assertEquals(60, warm_pool._timer.interval)
+        warm_pool.replenish()
+        self.assertEquals({1: 2}, warm_pool.pending)
+        greenthread.sleep(0)
+        self.assertEquals({1: 0}, warm_pool.pending)
+        self.assertEquals(
+            2, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+        self.assertEquals({1: 3}, self.driver.vol_mgr.free_pool.free_count())
+        warm_pool.replenish()
+        self.assertEquals({1: 0}, warm_pool.pending)
+
+    def test_warm_pool_stocked(self):
+        warm_pool = self.setup_warm_pool(['1:1'])
+        warm_pool.replenish()
+        self.assertEquals({1: 0}, warm_pool.pending)
+        self.assertEquals(
+            0, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_warm_pool_order_failure(self):
+        warm_pool = self.setup_warm_pool(['1:2'])
+        SoftLayer.Client['Product_Order'].placeOrder.side_effect = \
+            SoftLayerAPIError("")
+        warm_pool.replenish()
+        greenthread.sleep(0)
+        self.assertEquals({1: 0}, warm_pool.pending)
+        self.assertEquals({1: 1}, self.driver.vol_mgr.free_pool.free_count())
+
+    def test_warm_pool_waits_for_slow_order(self):
+        warm_pool = self.setup_warm_pool(['1:2'])
+        place_order = SoftLayer.Client['Product_Order'].placeOrder
+        get_billing_item = \
+            SoftLayer.Client['Billing_Order_Item'].getBillingItem
+        billing_item = {'notes': 'foo'}
+        replenished = []
+
+        def poll(id):
+            if get_billing_item.call_count < 3:
+                return None
+            # the active wait of a create would have timed out
+            warm_pool.replenish()
+            replenished.append(dict(warm_pool.pending))
+            return billing_item
+        get_billing_item.side_effect = poll
+        warm_pool.replenish()
+        greenthread.sleep(0)
+        self.assertEquals([{1: 1}], replenished)
+        self.assertEquals(1, place_order.call_count)
+        self.assertEquals({1: 0}, warm_pool.pending)
+        self.assertEquals({1: 2}, self.driver.vol_mgr.free_pool.free_count())
+
+    def test_warm_pool_refresh_failure(self):
+        warm_pool = self.setup_warm_pool(['1:2'])
+        self.driver.vol_mgr.free_pool.loaded_at = None
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.side_effect = \
+            SoftLayerAPIError("")
+        warm_pool.replenish()
+        self.assertEquals({1: 0}, warm_pool.pending)
+        self.assertEquals(
+            0, SoftLayer.Client['Product_Order'].placeOrder.call_count)
+
+    def test_warm_pool_requires_index(self):
+        self.config.sl_pool_warm_stock = ['1:1']
+        self.driver.check_for_setup_error()
+        self.assertIsNone(self.driver.warm_pool)
+
+    def test_warm_pool_invalid_stock(self):
+        self.config.sl_pool_warm_stock = ['1:a']
+        self.assertRaises(exception.InvalidConfigurationValue,
+                          self.driver.check_for_setup_error)
+
+    def test_warm_pool_restart(self):
+        warm_pool = self.setup_warm_pool(['1:1'])
+        self.driver.check_for_setup_error()
+        self.assertFalse(warm_pool._timer)
+        self.assertTrue(self.driver.warm_pool._timer.running)
+
+    def setup_scrub(self, dirty=(), notes=''):
+        self.setup_attach()
+        getObject = SoftLayer.Client['Network_Storage_Iscsi'].getObject
+        sl_vol = copy.deepcopy(getObject.return_value)
+        sl_vol['notes'] = notes
+        getObject.return_value = sl_vol
+        SoftLayer.Client['Network_Storage_Iscsi'].editObject.side_effect = \
+            lambda template, id: sl_vol.update(template)
+        self.config.sl_pool_scrub_workers = 2
+        self.config.sl_pool_index_ttl = 300
+        self.config.sl_pool_volume_clear = 'zero'
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            list(dirty)
+        self.driver.do_setup(None)
+        self.driver.check_for_setup_error()
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_delete_scrubs_in_background(self, detach_volume):
+        self.setup_scrub()
+        edit = SoftLayer.Client['Network_Storage_Iscsi'].editObject
+        self.driver.delete_volume(self.volume)
+        edit.assert_called_once_with({'notes': 'cinder:scrub-pending'}, id=2)
+        self.assertEquals(0, vol_utils.copy_volume.call_count)
+        db_utils.volume_admin_metadata_update.assert_called_once_with(
+            self.fake_context, self.volume['id'], {}, True)
+        self.assertTrue(self.driver.vol_mgr.dirty)
+        greenthread.sleep(0)
+        vol_utils.copy_volume.assert_called_once_with('/dev/zero',
+                                                      'valid_host',
+                                                      1024)
+        edit.assert_called_with({'notes': ''}, id=2)
+        self.assertFalse(self.driver.vol_mgr.dirty)
+        self.assertEquals({1: 1}, self.driver.vol_mgr.free_pool.free_count())
+        self.assert_single_detach(detach_volume)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_scrub_keeps_notes(self, detach_volume):
+        self.setup_scrub(notes='reserved for db tier')
+        edit = SoftLayer.Client['Network_Storage_Iscsi'].editObject
+        self.driver.delete_volume(self.volume)
+        edit.assert_called_once_with(
+            {'notes': 'reserved for db tier cinder:scrub-pending'}, id=2)
+        self.assertTrue(self.driver.vol_mgr.is_dirty(
+            {'id': 3, 'notes': 'reserved for db tier cinder:scrub-pending'}))
+        greenthread.sleep(0)
+        edit.assert_called_with({'notes': 'reserved for db tier'}, id=2)
+        self.assertFalse(self.driver.vol_mgr.dirty)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_dirty_volume_not_allocated(self, detach_volume):
+        self.setup_scrub()
+        self.config.sl_pool_real_order = False
+        db_utils.volume_get_all.return_value = []
+        self.driver.delete_volume(self.volume)
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.return_value = \
+            [{'id': 2, 'capacityGb': 1, 'notes': 'cinder:scrub-pending'}]
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.driver.create_volume, self.volume)
+        db_utils.volume_metadata_get.return_value = \
+            {'softlayer_volume_id': '2'}
+        self.assertRaises(exception.InvalidVolume,
+                          self.driver.create_volume, self.volume)
+        greenthread.sleep(0)
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_scrub_failure_keeps_volume_dirty(self, detach_volume):
+        self.setup_scrub()
+        vol_utils.copy_volume.side_effect = ProcessExecutionError()
+        self.driver.delete_volume(self.volume)
+        greenthread.sleep(0)
+        self.assertEquals(set([2]), self.driver.vol_mgr.dirty)
+        self.assertEquals({}, self.driver.vol_mgr.free_pool.free_count())
+
+    @patch('cinder.volume.driver.ISCSIDriver._detach_volume')
+    def test_dirty_volumes_scrubbed_at_startup(self, detach_volume):
+        dirty = [{'id': sl_id, 'capacityGb': 2, 'username': 'foo',
+                  'password': 'bar', 'billingItem': {'id': sl_id},
+                  'serviceResourceBackendIpAddress': '10.0.0.2',
+                  'notes': 'cinder:scrub-pending'} for sl_id in (5, 6, 7)]
+        self.setup_scrub(dirty)
+        SoftLayer.Client['Account'].getIscsiNetworkStorage.\
+            assert_called_once_with(mask=ANY, filter={
+                'iscsiNetworkStorage': {
+                    'notes': {'operation': '*= cinder:scrub-pending'},
+                    'billingItem': {'location': {
+                        'id': {'operation': 1234}}}}})
+        self.assertEquals(set([5, 6, 7]), self.driver.vol_mgr.dirty)
+        greenthread.sleep(0)
+        self.assertEquals(3, vol_utils.copy_volume.call_count)
+        self.assertEquals(set(), self.driver.vol_mgr.dirty)